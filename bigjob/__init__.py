@@ -1,4 +1,6 @@
 import os
+import sys
+import types
 import logging
 logging.basicConfig(level=logging.DEBUG, datefmt='%m/%d/%Y %I:%M:%S %p',
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -31,17 +33,24 @@ except:
     logger.error("bjgjob.conf could not be read") 
 
 # define external-facing API
-from bigjob.bigjob_manager import bigjob as myBigjob
-from bigjob.bigjob_manager import subjob as mySubjob
-from bigjob.bigjob_manager import description as myDescription
-
-class subjob(mySubjob):
-    pass
-
-
-class bigjob(myBigjob):
-    pass
-
-
-class description(myDescription):
-    pass
+# The API (bigjob_manager) is imported on first access of bigjob.bigjob, 
+# bigjob.subjob or bigjob.description: it imports SAGA, which is slow to import 
+# and not available on all resources, but is not used by the agent 
+# (bigjob.bigjob_agent) and the coordination backends
+_API_CLASSES=["bigjob", "subjob", "description"]
+
+class _api_module(types.ModuleType):
+    
+    def __getattr__(self, name):
+        if not name in _API_CLASSES:
+            raise AttributeError("'module' object has no attribute '%s'"%name)
+        from bigjob import bigjob_manager
+        for i in _API_CLASSES:
+            setattr(self, i, getattr(bigjob_manager, i))
+        return getattr(self, name)
+
+_module = _api_module(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# globals of the replaced module are cleared if it is garbage collected
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -10,22 +10,23 @@ import bigjob.state
 import socket
 import threading
 import time
-import pdb
 import traceback
 import ConfigParser
 import types
+import errno
+import signal
+import json
 import logging
-logging.basicConfig(level=logging.DEBUG)
-
-try:
-    import saga
-except:
-    logging.warning("SAGA could not be found. Not all functionalities working")
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../../ext/threadpool-1.2.7/src/")
 logging.debug(str(sys.path))
 from threadpool import *
 from bigjob import logger
+from bigjob import job_description_codec
+from bigjob.slot_allocator import slot_allocator
+from bigjob.job_state_buffer import job_state_buffer
+from bigjob.bigjob_launcher import launcher_client, decode_status
+from coordination import backend_registry
 
 if sys.version_info < (2, 5):
     sys.path.append(os.path.dirname( __file__ ) + "/../../ext/uuid-1.30/")
@@ -43,6 +44,22 @@ import subprocess
 CONFIG_FILE="bigjob_agent.conf"
 THREAD_POOL_SIZE=4
 APPLICATION_NAME="bigjob"
+# max. time (in sec) the dispatcher blocks waiting for free slots before
+# re-checking the pilot state
+SLOT_WAIT_TIMEOUT=5
+STATE_UPDATE_WINDOW=0.05
+# timeout (in sec) for probing the availability of a launch method (ssh, aprun)
+LAUNCH_PROBE_TIMEOUT=10
+# max. age (in sec) of the cached pilot state (see is_stopped)
+PILOT_STATE_CACHE_TIME=1
+# the reaper polls the processes of running jobs (waitpid); the interval is 
+# doubled from REAP_INTERVAL up to MAX_REAP_INTERVAL (sec) while none terminates
+REAP_INTERVAL=0.005
+MAX_REAP_INTERVAL=0.1
+# characters requiring a shell for launching a sub-job 
+SHELL_CHARACTERS=set(" \t\n|&;<>()$`\\\"'*?[]#~{}")
+# results of launch method probes are cached per host in this directory
+LAUNCH_PROBE_CACHE_DIR=os.path.join(os.path.expanduser("~"), ".bigjob")
 
 class bigjob_agent:
     
@@ -54,13 +71,27 @@ class bigjob_agent:
     """Constructor"""
     def __init__(self, args):
         
+        # duration of startup phases (phase name, time in sec)
+        self.startup_times = []
+        startup_time = time.time()
+        phase_start = startup_time
         self.coordination_url = args[1]
         # objects to store running jobs and processes
-        self.jobs = []
+        self.jobs = set()
         self.processes = {}
-        self.freenodes = []
-        self.busynodes = []
+        # pid => job_url of running processes
+        self.pids = {}
         self.restarted = {}
+        # job_url => allocated nodes (one entry per slot)
+        self.allocations = {}
+        # job_url => machinefile (MPI jobs only)
+        self.machinefiles = {}
+        # job_url => job description of dequeued jobs (evicted on termination)
+        self.job_descriptions = {}
+        # cached pilot state (time, stopped)
+        self.pilot_state_cache = (0, True)
+        # number of reads from the coordination backend / started sub-jobs
+        self.counters = {"get_job":0, "get_pilot_state":0, "started_jobs":0}
 
         # read config file
         # conf_file = os.path.dirname(args[0]) + "/" + CONFIG_FILE
@@ -73,13 +104,44 @@ class bigjob_agent:
         self.CPR = default_dict["cpr"]
         self.SHELL=default_dict["shell"]
         self.MPIRUN=default_dict["mpirun"]
+        phase_start = self.__startup_phase("config", phase_start)
         self.LAUNCH_METHOD=self.__get_launch_method(default_dict["launch_method"])
+        phase_start = self.__startup_phase("launch method", phase_start)
+        # placement of sub-jobs: pack or spread; whole nodes for MPI jobs
+        slot_policy = "pack"
+        if default_dict.has_key("slot_policy"):
+            slot_policy = default_dict["slot_policy"]
+        self.MPI_WHOLE_NODE = False
+        if default_dict.has_key("mpi_whole_node"):
+            self.MPI_WHOLE_NODE = (default_dict["mpi_whole_node"].lower()=="true")
+        self.slots = slot_allocator(slot_policy)
+        # node-local directory for machinefiles of MPI jobs
+        self.SCRATCH_DIR = os.environ.get("TMPDIR", "/tmp")
+        if default_dict.has_key("scratch_dir"):
+            self.SCRATCH_DIR = os.path.expandvars(default_dict["scratch_dir"])
+        # launching sub-jobs on remote nodes: daemon (persistent launcher per node) or ssh
+        self.REMOTE_LAUNCHER = "daemon"
+        if default_dict.has_key("remote_launcher"):
+            self.REMOTE_LAUNCHER = default_dict["remote_launcher"]
+        # host => launcher_client
+        self.launchers = {}
+        # environment of sub-jobs without job specific environment
+        self.environment = os.environ.copy()
+        # time window (in sec) for batching sub-job state updates 
+        self.STATE_UPDATE_WINDOW = STATE_UPDATE_WINDOW
+        if default_dict.has_key("state_update_window"):
+            self.STATE_UPDATE_WINDOW = float(default_dict["state_update_window"])
+        # steal sub-jobs from other pilots (sharing the coordination server) if idle
+        self.WORK_STEALING = False
+        if default_dict.has_key("work_stealing"):
+            self.WORK_STEALING = (default_dict["work_stealing"].lower()=="true")
         
         logging.debug("Launch Method: " + self.LAUNCH_METHOD + " mpi: " + self.MPIRUN + " shell: " + self.SHELL)
         
         # init rms (SGE/PBS)
         self.init_rms()
         self.failed_polls = 0
+        phase_start = self.__startup_phase("rms", phase_start)
         
         ##############################################################################
         # initialization of coordination and communication subsystem
@@ -98,39 +160,38 @@ class bigjob_agent:
             logger.debug("Directory already exists.")
         
         os.chdir(self.bj_dir)
+        phase_start = self.__startup_phase("working directory", phase_start)
         
-        if(self.coordination_url.startswith("advert://") or self.coordination_url.startswith("sqlasyncadvert://")):
-            try:
-                from coordination.bigjob_coordination_advert import bigjob_coordination
-                logging.debug("Utilizing ADVERT Backend: " + self.coordination_url)
-            except:
-                logger.error("Advert Backend could not be loaded")
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_exc(file=sys.stderr)
-                traceback.print_tb(exc_traceback, file=sys.stderr)
-        elif (self.coordination_url.startswith("redis://")):
-            try:
-                from coordination.bigjob_coordination_redis import bigjob_coordination      
-                logger.debug("Utilizing Redis Backend: " + self.coordination_url + ". Please make sure Redis server is configured in bigjob_coordination_redis.py")
-            except:
-                logger.error("Error loading pyredis.")
-        elif (self.coordination_url.startswith("tcp://")):
-            try:
-                from coordination.bigjob_coordination_zmq import bigjob_coordination
-                logger.debug("Utilizing ZMQ Backend")
-            except:
-                logger.error("ZMQ Backend not found. Please install ZeroMQ (http://www.zeromq.org/intro:get-the-software) and " 
-                      +"PYZMQ (http://zeromq.github.com/pyzmq/)")
-
-        self.coordination = bigjob_coordination(server_connect_url=self.coordination_url)
+        # backend module is imported on first use of its url scheme
+        bigjob_coordination = backend_registry.get_backend(self.coordination_url)
+        if backend_registry.get_scheme(self.coordination_url) == "redis":
+            # connection pool sized by the threads of the agent (dispatcher, monitoring, state updates and 
+            # thread pool), up to 2 connections per thread
+            self.coordination = bigjob_coordination(server_connect_url=self.coordination_url, 
+                                                    max_connections=2*(THREAD_POOL_SIZE+3))
+        else:
+            self.coordination = bigjob_coordination(server_connect_url=self.coordination_url)
+        # sub-job state updates are batched 
+        self.job_states = job_state_buffer(self.coordination, self.STATE_UPDATE_WINDOW)
     
         # update state of pilot job to running
         self.coordination.set_pilot_state(self.base_url, str(bigjob.state.Running), False)
+        if self.WORK_STEALING:
+            self.coordination.join_pilot_group(self.base_url)
+        phase_start = self.__startup_phase("coordination", phase_start)
 
         
         ##############################################################################
         # start background thread for polling new jobs and monitoring current jobs
         self.resource_lock=threading.RLock()
+        # signaled whenever slots are freed (wakes up the dispatcher)
+        self.slot_condition=threading.Condition(self.resource_lock)
+        # set if the allocation of a sub-job failed (the sub-job is requeued and 
+        # the dispatcher waits for free slots instead of dequeuing it again); 
+        # reset whenever slots are released (see allocate_nodes/free_nodes)
+        self.slots_exhausted = False
+        # signaled whenever a new process is started (wakes up the reaper)
+        self.reaper_condition=threading.Condition(self.resource_lock)
         self.threadpool = ThreadPool(THREAD_POOL_SIZE)
         
         self.launcher_thread=threading.Thread(target=self.dequeue_new_jobs)
@@ -139,6 +200,13 @@ class bigjob_agent:
         self.monitoring_thread=threading.Thread(target=self.start_background_thread)
         self.monitoring_thread.start()
         
+        self.reaper_thread=threading.Thread(target=self.reap_processes)
+        self.reaper_thread.daemon=True
+        self.reaper_thread.start()
+        self.__startup_phase("threads", phase_start)
+        logger.info("Agent startup: " + ", ".join(["%s: %.3f s"%(i[0], i[1]) for i in self.startup_times]) 
+                    + ", total: %.3f s"%(time.time()-startup_time))
+        
     
     def __get_bj_id(self, url):
         logger.debug("parsing ID out of URL: %s"%url)
@@ -161,10 +229,9 @@ class bigjob_agent:
         """ initialize free nodes list with dummy (for fork jobs)"""
         try:
             num_cpus = self.get_num_cpus()
-            for i in range(0, num_cpus): 
-                self.freenodes.append("localhost\n")
+            self.slots.add_host("localhost", num_cpus)
         except IOError:
-            self.freenodes=["localhost\n"]
+            self.slots.add_host("localhost", 1)
 
     def init_sge(self):
         """ initialize free nodes list from SGE environment """
@@ -178,12 +245,11 @@ class bigjob_agent:
         
             columns = i.split()                
             try:
-                for j in range(0, int(columns[1])):
-                    logger.debug("add host: " + columns[0].strip())
-                    self.freenodes.append(columns[0]+"\n")
+                logger.debug("add host: " + columns[0].strip() + " slots: " + columns[1])
+                self.slots.add_host(columns[0].strip(), int(columns[1]))
             except:
                     pass
-        return self.freenodes            
+        return self.slots            
 
     def init_pbs(self):
         """ initialize free nodes list from PBS environment """
@@ -194,33 +260,30 @@ class bigjob_agent:
             # number of slots
             # aprun does not rely on the nodefile for job launching
             number_nodes =  os.environ.get("PBS_NNODES")
-            self.freenodes=[]
             for i in range(0, int(number_nodes)):
-                slot = "slot-%d\n"%i
-                logger.debug("add slot: " + slot)
-                self.freenodes.append(slot)            
+                self.slots.add_host("slot-%d"%i, 1)
+            logger.debug("added %s aprun slots"%number_nodes)
         else:
             pbs_node_file = os.environ.get("PBS_NODEFILE")    
             if pbs_node_file == None:
                 return
             f = open(pbs_node_file)
-            self.freenodes = f.readlines()
+            pbsnodes = f.readlines()
             f.close()
     
             # check whether pbs node file contains the correct number of nodes
             num_cpus = self.get_num_cpus()
             node_dict={}
-            for i in set(self.freenodes):
-                node_dict[i] = self.freenodes.count(i)
-                if node_dict[i] < num_cpus:
-                    node_dict[i] = num_cpus
+            for i in pbsnodes:
+                host = i.strip()
+                if host != "":
+                    node_dict[host] = node_dict.get(host, 0) + 1
         
-            self.freenodes=[]
             for i in node_dict.keys():
+                if node_dict[i] < num_cpus:
+                    node_dict[i] = num_cpus
                 logger.debug("host: " + i + " nodes: " + str(node_dict[i]))
-                for j in range(0, node_dict[i]):
-                    logger.debug("add host: " + i.strip())
-                    self.freenodes.append(i)
+                self.slots.add_host(i, node_dict[i])
 
     def get_num_cpus(self):
         cpuinfo = open("/proc/cpuinfo", "r")
@@ -234,7 +297,10 @@ class bigjob_agent:
         
      
     def execute_job(self, job_url, job_dict):
-        """ obtain job attributes from c&c and execute process """
+        """ obtain job attributes from c&c and execute process 
+            returns True if the job was started or failed (state Failed, nodes 
+            freed) and False if job was requeued (not enough free slots)
+        """
         state=str(job_dict["state"])
        
         #try:
@@ -266,24 +332,18 @@ class bigjob_agent:
                     pass  # ignore in particular if Bliss is used
                 
                 arguments = ""
+                arguments_list = []
                 if (job_dict.has_key("Arguments") == True):
-                    arguments_raw = job_dict['Arguments'];
-                    if type(arguments_raw) == types.ListType:
-                        arguments_list = arguments_raw
-                    else:
-                        arguments_list = eval(job_dict["Arguments"])                    
+                    arguments_list = job_dict['Arguments']
                     for i in arguments_list:
                         arguments = arguments + " " + i
                         
-                environment = os.environ
                 envi = ""
+                env_list = []
+                job_environment = {}
                 self.number_subjobs=1
                 if (job_dict.has_key("Environment") == True):
-                    env_raw = job_dict['Environment']
-                    if type(env_raw) == types.ListType:
-                        env_list = env_raw
-                    else:
-                        env_list = eval(job_dict["Environment"])
+                    env_list = job_dict['Environment']
 
                     logger.debug("Environment: " + str(env_list))
                     for i in env_list:
@@ -295,6 +355,8 @@ class bigjob_agent:
                             envi_1 = "export " + i +"; "
                             envi = envi + envi_1
                             logger.debug(envi) 
+                            if i.find("=")>0:
+                                job_environment[i[:i.find("=")].strip()] = i[i.find("=")+1:]
                 
                 executable = job_dict["Executable"]
                 
@@ -320,15 +382,9 @@ class bigjob_agent:
                 if not os.path.isabs(error):
                     error=os.path.join(workingdirectory, error)
                 
-                # append job to job list
-                self.jobs.append(job_url)
-                
-                # create stdout/stderr file descriptors
                 output_file = os.path.abspath(output)
                 error_file = os.path.abspath(error)
                 logger.debug("stdout: " + output_file + " stderr: " + error_file)
-                stdout = open(output_file, "w")
-                stderr = open(error_file, "w")
                 if self.LAUNCH_METHOD=="aprun":
                     env_strip = envi.strip()
                     env_command = env_strip[:(len(env_strip)-1)]
@@ -345,89 +401,131 @@ class bigjob_agent:
                     command =  envi + executable + " " + arguments
                 else:
                     command =  executable + " " + arguments
-                #pdb.set_trace()
                 # special setup for MPI NAMD jobs
-                machinefile = self.allocate_nodes(job_dict)
-                host = "localhost"
-                try:
-                    machine_file_handler = open(machinefile, "r")
-                    node= machine_file_handler.readlines()
-                    machine_file_handler.close()
-                    host = node[0].strip()
-                except:
-                    pass
-
-
-                if(machinefile==None):
+                nodes = self.allocate_nodes(job_url, job_dict)
+                if(nodes==None):
                     logger.debug("Not enough resources to run: " + job_url)
-                    self.coordination.queue_job(self.base_url, job_url)
-                    return # job cannot be run at the moment
+                    self.requeue_job(job_url)
+                    return False # job cannot be run at the moment
+                try:
+                    host = nodes[0]
                 
-                # build execution command
-                if self.LAUNCH_METHOD == "aprun":
-                    command ="cd " + workingdirectory + "; " + command
-                else:
-                    if (spmdvariation.lower( )=="mpi"):
-                        command = "cd " + workingdirectory + "; " + envi +  self.MPIRUN + " -np " + numberofprocesses + " -machinefile " + machinefile + " " + command
-                    elif host == "localhost":
-                        command ="cd " + workingdirectory + "; " + command
-                    else:    
-                        command ="ssh  " + host + " \"cd " + workingdirectory + "; " + command +"\""
-                        
+                    # direct execution (w/o shell) if no shell features are used
+                    argv = None
+                    if (self.LAUNCH_METHOD != "aprun" and spmdvariation.lower()!="mpi" 
+                        and self.__is_direct_exec(executable, arguments_list, job_environment)):
+                        argv = [executable] + [i for i in arguments_list if i != ""]
+                
+                    if (host != "localhost" and self.LAUNCH_METHOD != "aprun" 
+                        and spmdvariation.lower()!="mpi" and self.REMOTE_LAUNCHER=="daemon"):
+                        launcher = self.get_launcher(host)
+                        p = None
+                        try:
+                            if launcher != None and argv != None:
+                                logger.debug("execute: " + str(argv) + " at: " + host + " (launcher)")
+                                p = launcher.launch(job_url, argv, job_environment, workingdirectory, 
+                                                    output_file, error_file)
+                            elif launcher != None:
+                                logger.debug("execute: " + command + " at: " + host + " (launcher)")
+                                p = launcher.launch(job_url, [command], None, workingdirectory, 
+                                                    output_file, error_file, True, self.SHELL)
+                        except:
+                            logger.error("Launch via launcher at " + host + " failed - using ssh")
+                            traceback.print_exc(file=sys.stderr)
+                        if p != None:
+                            # state is set to Running when the launcher reports the pid (see remote_job_started)
+                            self.register_remote_process(job_url, p)
+                            return True
                 
-                # start application process                    
-                shell = self.SHELL 
-                logger.debug("execute: " + command + " in " + workingdirectory + " from: " + str(socket.gethostname()) + " (Shell: " + shell +")")
-                # bash works fine for launching on QB but fails for Abe :-(
-                p = subprocess.Popen(args=command, executable=shell, stderr=stderr,
-                                     stdout=stdout, cwd=workingdirectory, 
-                                     env=environment, shell=True)
-                logger.debug("started " + command)
-                self.processes[job_url] = p
-                self.coordination.set_job_state(job_url, str(bigjob.state.Running))
+                    # create stdout/stderr file descriptors
+                    stdout = open(output_file, "w")
+                    stderr = None
+                    try:
+                        stderr = open(error_file, "w")
+                        if argv != None and host == "localhost":
+                            environment = self.environment
+                            if len(job_environment) > 0:
+                                environment = self.environment.copy()
+                                environment.update(job_environment)
+                            logger.debug("execute: " + str(argv) + " in " + workingdirectory)
+                            p = subprocess.Popen(args=argv, stderr=stderr, stdout=stdout, 
+                                                 cwd=workingdirectory, env=environment)
+                        else:
+                            # build execution command
+                            if self.LAUNCH_METHOD == "aprun":
+                                command ="cd " + workingdirectory + "; " + command
+                            else:
+                                if (spmdvariation.lower( )=="mpi"):
+                                    machinefile = self.write_machine_file(job_url, job_dict, nodes)
+                                    command = "cd " + workingdirectory + "; " + envi +  self.MPIRUN + " -np " + numberofprocesses + " -machinefile " + machinefile + " " + command
+                                elif host == "localhost":
+                                    command ="cd " + workingdirectory + "; " + command
+                                else:    
+                                    command ="ssh  " + host + " \"cd " + workingdirectory + "; " + command +"\""
+                    
+                            # start application process                    
+                            shell = self.SHELL 
+                            logger.debug("execute: " + command + " in " + workingdirectory + " from: " + str(socket.gethostname()) + " (Shell: " + shell +")")
+                            # bash works fine for launching on QB but fails for Abe :-(
+                            p = subprocess.Popen(args=command, executable=shell, stderr=stderr,
+                                                 stdout=stdout, cwd=workingdirectory, 
+                                                 env=self.environment, shell=True)
+                    finally:
+                        stdout.close()
+                        if stderr != None:
+                            stderr.close()
+                    logger.debug("started " + job_url)
+                    self.counters["started_jobs"] = self.counters["started_jobs"] + 1
+                    self.job_states.set_job_state(job_url, str(bigjob.state.Running))
+                    self.register_process(job_url, p)
+                except:
+                    # nodes are allocated => must be freed
+                    logger.error("Failed to start job: " + job_url)
+                    traceback.print_exc(file=sys.stderr)
+                    self.start_failed(job_url)
+                return True
             except:
+                logger.error("Invalid job description: " + job_url)
                 traceback.print_exc(file=sys.stderr)
+                self.job_states.set_job_state(job_url, str(bigjob.state.Failed))
+                return True
+        return True
     
    
             
-    def allocate_nodes(self, job_dict):
+    def allocate_nodes(self, job_url, job_dict):
         """ allocate nodes
-            allocated nodes will be written to machinefile advert-launcher-machines-<jobid>
+            allocated nodes are kept in memory (see free_nodes)
+            returns list of nodes (one entry per slot) or None if not enough nodes are free
         """
         self.resource_lock.acquire()
         number_nodes = int(job_dict["NumberOfProcesses"])
-        nodes = []
-        machine_file_name = None
-        if (len(self.freenodes)>=number_nodes):
-            unique_nodes=set(self.freenodes)
-            for i in unique_nodes:
-                number = self.freenodes.count(i)
-                logger.debug("allocate: " + i + " number nodes: " + str(number) 
-                              + " current busy nodes: " + str(self.busynodes) 
-                              + " free nodes: " + str(self.freenodes))
-                for j in range(0, number):
-                    if(number_nodes > 0):
-                        nodes.append(i)
-                        self.freenodes.remove(i)                
-                        self.busynodes.append(i)
-                        number_nodes = number_nodes - 1
-                    else:
-                        break
-
-            machine_file_name = self.get_machine_file_name(job_dict)
-            machine_file = open(machine_file_name, "w")
-            #machine_file.writelines(self.freenodes[:number_nodes])
-            machine_file.writelines(nodes)
-            machine_file.close() 
-            logger.debug("wrote machinefile: " + machine_file_name + " Nodes: " + str(nodes))
-            # update node structures
-            #self.busynodes.extend(self.freenodes[:number_nodes])
-            #del(self.freenodes[:number_nodes])            
-        
+        whole_node = False
+        if job_dict.has_key("SPMDVariation") and job_dict["SPMDVariation"].lower()=="mpi":
+            whole_node = self.MPI_WHOLE_NODE
+        nodes = self.slots.allocate(number_nodes, whole_node)
+        if nodes != None:
+            self.allocations[job_url] = nodes
+            logger.debug("allocated for: " + job_url + " #Nodes: " + str(len(nodes)) 
+                         + " " + str(self.slots))
+        else:
+            # set under the same lock as the failed allocation => a release of 
+            # slots after this point resets the flag (no lost wakeup)
+            self.slots_exhausted = True
         self.resource_lock.release()
-        return machine_file_name
+        return nodes
         
     
+    def write_machine_file(self, job_url, job_dict, nodes):
+        """ write machinefile for MPI job to node-local scratch directory """
+        machine_file_name = self.get_machine_file_name(job_dict)
+        machine_file = open(machine_file_name, "w")
+        machine_file.writelines([i + "\n" for i in nodes])
+        machine_file.close() 
+        self.machinefiles[job_url] = machine_file_name
+        logger.debug("wrote machinefile: " + machine_file_name + " Nodes: " + str(nodes))
+        return machine_file_name
+    
     
     def setup_charmpp_nodefile(self, allocated_nodes):
         """ Setup charm++ nodefile to use for executing NAMD  
@@ -447,6 +545,8 @@ class bigjob_agent:
                 nodefile_string=nodefile_string + "host "+ i["hostname"] + " ++cpus " + str(i["cpu_count"]) + " ++shell ssh\n"
             
         # copy nodefile to rank 0 node
+        # SAGA is only imported if required (slow import, not available on all resources)
+        import saga
         jd = saga.job.description()
         jd.executable = "echo"
         jd.number_of_processes = "1"
@@ -471,53 +571,55 @@ class bigjob_agent:
        
          
     def free_nodes(self, job_url):
-        job_dict = self.coordination.get_job(job_url)
         self.resource_lock.acquire()
-        number_nodes = int(job_dict["NumberOfProcesses"])
-        machine_file_name = self.get_machine_file_name(job_dict)
-        logger.debug("Machine file: " + machine_file_name)
-        allocated_nodes = ["localhost\n"]
-        try:
-            machine_file = open(machine_file_name, "r")
-            allocated_nodes = machine_file.readlines()
-            machine_file.close()
-        except:	
-            traceback.print_exc(file=sys.stderr)
-
-        logger.debug("Free nodes: " + str(allocated_nodes))         
-
-        for i in allocated_nodes:
-            logger.debug("free node: " + str(i) + " current busy nodes: " + str(self.busynodes) 
-                          + " free nodes: " + str(self.freenodes))       
-            self.busynodes.remove(i)
-            self.freenodes.append(i)
-        logger.debug("Delete " + machine_file_name)
-        if os.path.exists(machine_file_name):
-            os.remove(machine_file_name)
+        allocated_nodes = self.allocations.pop(job_url, [])
+        self.slots.release(allocated_nodes)
+        logger.debug("Free nodes: " + str(len(allocated_nodes)) + " " + str(self.slots))
+        machine_file_name = self.machinefiles.pop(job_url, None)
+        if machine_file_name != None:
+            logger.debug("Delete " + machine_file_name)
+            try:
+                os.remove(machine_file_name)
+            except OSError:
+                traceback.print_exc(file=sys.stderr)
+        # wake up dispatcher waiting for free slots (or about to wait)
+        self.slots_exhausted = False
+        self.slot_condition.notifyAll()
         self.resource_lock.release()
                
             
     def get_machine_file_name(self, job_dict):
         """create machinefile based on jobid"""
         job_id = job_dict["job-id"]                
-        homedir = os.path.expanduser('~')
-        return homedir  + "/advert-launcher-machines-"+ job_id
+        return os.path.join(self.SCRATCH_DIR, "bigjob-machines-"+ job_id)
         
     def dequeue_new_jobs(self):	    
         """Subscribe to new jobs from Redis. """ 
         job_counter = 0               
         while self.is_stopped(self.base_url)==False:     
-            if len(self.freenodes)==0:
-                time.sleep(3)
-                continue
+            self.slot_condition.acquire()
+            try:
+                if self.slots.get_number_free()==0 or self.slots_exhausted:
+                    # block until a sub-job terminates and frees its slots
+                    self.slots_exhausted = False
+                    self.slot_condition.wait(SLOT_WAIT_TIMEOUT)
+                    continue
+                free_slots = self.slots.get_number_free()
+            finally:
+                self.slot_condition.release()
+            # backends pushing jobs (ZMQ) deliver up to free_slots jobs ahead
+            self.coordination.set_job_credits(self.base_url, free_slots)
             logger.debug("Dequeue sub-job from: " + self.base_url)       
-            job_url=self.coordination.dequeue_job(self.base_url)
+            # blocking dequeue (backend waits for new queue entries); the Redis 
+            # backend returns the description (marked New) with the queue entry
+            job_url, stored_job_dict = self.coordination.dequeue_job_description(self.base_url)
             logger.debug("Dequed:%s"%str(job_url))
             if job_url==None:
-                time.sleep(3)
                 continue
             if job_url=="STOP":
                 break
+            if stored_job_dict != None and len(stored_job_dict) > 0:
+                self.job_descriptions[job_url] = job_description_codec.decode(stored_job_dict)
             
             job_counter = job_counter + 1            
             if (job_counter % (THREAD_POOL_SIZE))==0: # ensure that threadpool is not too overloaded
@@ -526,6 +628,8 @@ class bigjob_agent:
             request = WorkRequest(self.start_new_job_in_thread, [job_url])
             self.threadpool.putRequest(request)
             
+        if self.WORK_STEALING:
+            self.coordination.leave_pilot_group(self.base_url)
         # wait for termination of Worker Threads
         self.threadpool.wait()   
         logger.debug("Terminating Agent - Dequeue Sub-Jobs Thread")   
@@ -541,63 +645,215 @@ class bigjob_agent:
         
     def start_new_job_in_thread(self, job_url):
         """evaluates job dir, sanity checks, executes job """
-        #pdb.set_trace()
         if job_url != None:
-            failed = False;
+            job_dict = None
             try:
                 logger.debug("Get job description")
-                job_dict = self.coordination.get_job(job_url)
+                job_dict = self.get_job_description(job_url)
             except:
                 logger.error("Failed to get job description")
-                failed=True
                 
-            if job_dict==None or failed==True:
-                self.coordination.queue_job(self.pilot_url, job_url)
+            if job_dict==None:
+                self.coordination.requeue_job(self.base_url, job_url)
+                return
                 
             logger.debug("start job: " + job_url + " data: " + str(job_dict))
             if(job_dict["state"]==str(bigjob.state.Unknown)):
                 job_dict["state"]=str(bigjob.state.New)
-                self.coordination.set_job_state(job_url, str(bigjob.state.New))
-            self.execute_job(job_url, job_dict)
+                self.job_states.set_job_state(job_url, str(bigjob.state.New))
+            if self.execute_job(job_url, job_dict):
+                # job started (or failed) => remove from in-flight jobs of queue 
+                # (sent with the next batch of state updates)
+                self.job_states.ack_job(self.base_url, job_url)
+            # else: job was requeued (not enough free slots)
             #print "Execute: " + str(job_dict)
     
+    def requeue_job(self, job_url):
+        """ return job to the head of the queue (the dispatcher waits until slots 
+            are freed, see allocate_nodes) """
+        self.coordination.requeue_job(self.base_url, job_url)
+    
+    def get_job_description(self, job_url):
+        """ returns job description of job_url
+            descriptions are read once from the coordination backend and cached 
+            until the job terminates (see job_finished)
+        """
+        job_dict = self.job_descriptions.get(job_url)
+        if job_dict == None:
+            self.counters["get_job"] = self.counters["get_job"] + 1
+            job_dict = job_description_codec.decode(self.coordination.get_job(job_url))
+            if job_dict != None:
+                self.job_descriptions[job_url] = job_dict
+        return job_dict
+    
+    def register_process(self, job_url, p):
+        """ hands started process over to the reaper """
+        self.resource_lock.acquire()
+        try:
+            self.jobs.add(job_url)
+            self.processes[job_url] = p
+            self.pids[p.pid] = job_url
+            self.reaper_condition.notify()
+        finally:
+            self.resource_lock.release()
+    
+    def register_remote_process(self, job_url, p):
+        """ registers process started by a launcher daemon 
+            (termination is reported via job_finished) """
+        self.resource_lock.acquire()
+        try:
+            self.jobs.add(job_url)
+            self.processes[job_url] = p
+        finally:
+            self.resource_lock.release()
+        if p.returncode != None: # terminated before registration
+            self.job_finished(job_url, p)
+    
+    def remote_job_started(self, job_url, p):
+        """ process of job was started by a launcher daemon """
+        logger.debug("started " + job_url + " (launcher)")
+        self.counters["started_jobs"] = self.counters["started_jobs"] + 1
+        self.job_states.set_job_state(job_url, str(bigjob.state.Running))
+    
+    def get_launcher(self, host):
+        """ returns launcher daemon for host (started on first use) 
+            or None if the launcher cannot be started """
+        self.resource_lock.acquire()
+        try:
+            launcher = self.launchers.get(host)
+            if launcher == None or not launcher.is_alive():
+                try:
+                    launcher = launcher_client(host, self.job_finished, start_callback=self.remote_job_started)
+                except:
+                    logger.error("Launcher could not be started at: " + host + " - using ssh")
+                    traceback.print_exc(file=sys.stderr)
+                    launcher = None
+                self.launchers[host] = launcher
+            return launcher
+        finally:
+            self.resource_lock.release()
+    
+    def __is_direct_exec(self, executable, arguments_list, job_environment):
+        """ True if sub-job can be executed without shell """
+        for i in [executable] + arguments_list + job_environment.values():
+            for c in i:
+                if c in SHELL_CHARACTERS:
+                    return False
+        return True
+    
+    def reap_processes(self):
+        """ waits for terminated processes of running jobs and updates the 
+            state of the respective jobs. Only jobs that terminated are touched.
+            Only the pids of registered processes are waited for (waitpid(-1) 
+            would reap other child processes, e.g. the ssh processes of the 
+            launchers). Waits on reaper_condition if no process is running.
+        """
+        interval = REAP_INTERVAL
+        while True:
+            self.reaper_condition.acquire()
+            try:
+                if len(self.pids)==0:
+                    self.reaper_condition.wait(SLOT_WAIT_TIMEOUT)
+                    interval = REAP_INTERVAL
+                pids = self.pids.keys()
+            finally:
+                self.reaper_condition.release()
+            number_exited = 0
+            for pid in pids:
+                try:
+                    result = os.waitpid(pid, os.WNOHANG)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    # ECHILD: process was reaped by someone else => status unknown
+                    logger.error("Could not get exit status of process %d: %s"%(pid, str(e)))
+                    result = (pid, None)
+                if result[0] == 0:
+                    continue
+                number_exited = number_exited + 1
+                try:
+                    self.process_exited(pid, result[1])
+                except:
+                    traceback.print_exc(file=sys.stderr)
+            if number_exited > 0:
+                interval = REAP_INTERVAL
+            else:
+                self.reaper_condition.acquire()
+                try:
+                    # woken up by the start of a new process
+                    self.reaper_condition.wait(interval)
+                finally:
+                    self.reaper_condition.release()
+                interval = min(interval*2, MAX_REAP_INTERVAL)
+    
+    def process_exited(self, pid, status):
+        """ status: waitpid status or None if unknown (job failed) """
+        self.resource_lock.acquire()
+        try:
+            job_url = self.pids.pop(pid, None)
+            if job_url == None:
+                return
+            p = self.processes[job_url]
+        finally:
+            self.resource_lock.release()
+        if status == None:
+            p.returncode = -1
+        else:
+            p.returncode = decode_status(status)
+        self.job_finished(job_url, p)
+    
+    def start_failed(self, job_url):
+        """ job could not be started: set state to Failed and free its nodes """
+        self.resource_lock.acquire()
+        try:
+            self.job_descriptions.pop(job_url, None)
+        finally:
+            self.resource_lock.release()
+        self.job_states.set_job_state(job_url, str(bigjob.state.Failed))
+        self.free_nodes(job_url)
+    
+    def job_finished(self, job_url, p):
+        """ update state of terminated job, free its nodes and remove it from 
+            the list of running jobs
+        """
+        self.resource_lock.acquire()
+        try:
+            if self.processes.get(job_url)!=p:
+                return # already handled
+            del self.processes[job_url]
+            self.jobs.discard(job_url)
+            self.job_descriptions.pop(job_url, None)
+        finally:
+            self.resource_lock.release()
+        p_state = p.returncode
+        if p_state==0 or p_state==255:
+            logger.debug("Job successful: " + job_url + " - set state to Done")
+            self.job_states.set_job_state(job_url, str(bigjob.state.Done))
+        else:
+            logger.debug("Job failed: " + job_url + " return code: " + str(p_state))
+            self.job_states.set_job_state(job_url, str(bigjob.state.Failed))
+        self.free_nodes(job_url)
+    
     def monitor_jobs(self):
-        """Monitor running processes. """   
-        #pdb.set_trace()
+        """Monitor running processes. 
+           Process terminations are handled by the reaper thread (see reap_processes).
+        """   
         logger.debug("Monitor jobs - # current jobs: %d"%len(self.jobs))
-        for i in self.jobs:
-            if self.processes.has_key(i): # only if job has already been starteds
-                p = self.processes[i]
-                p_state = p.poll()
-                logger.debug(self.print_job(i) + " state: " + str(p_state) + " return code: " + str(p.returncode))
-                if (p_state != None and (p_state==0 or p_state==255)):
-                    logger.debug("Job successful: " + self.print_job(i) + " - set state to Done")
-                    self.coordination.set_job_state(i, str(bigjob.state.Done))
-                    self.free_nodes(i)
-                    del self.processes[i]
-                elif p_state!=0 and p_state!=255 and p_state != None:
-                    logger.debug(self.print_job(i) + " failed.  ")
-                    # do not free nodes => very likely the job will fail on these nodes
-                    # self.free_nodes(i)                    
-                    #if self.restarted.has_key(i)==False:
-                    #    logger.debug("Try to restart job " + self.print_job(i))
-                    #    self.restarted[i]=True
-                    #    self.execute_job(i)                        
-                    #else:
-                    logger.debug("Job failed " + self.print_job(i))                    
-                    self.coordination.set_job_state(i, str(bigjob.state.Failed))
-                    self.free_nodes(i)
-                    del self.processes[i]
-    
-    def print_job(self, job_url):
-        job_dict = self.coordination.get_job(job_url)
-        return  ("Job: " + job_url  + " Excutable: " + job_dict["Executable"])
+        self.print_counters()
+    
+    def print_counters(self):
+        """ log reads from coordination backend per started sub-job """
+        started_jobs = max(self.counters["started_jobs"], 1)
+        logger.debug("Started jobs: %d, backend reads: get_job: %d (%.2f/job), get_pilot_state: %d (%.2f/job)"%
+                     (self.counters["started_jobs"], 
+                      self.counters["get_job"], float(self.counters["get_job"])/started_jobs,
+                      self.counters["get_pilot_state"], float(self.counters["get_pilot_state"])/started_jobs))
                                 
                             
     def start_background_thread(self):        
         self.stop=False                
         logger.debug("##################################### New POLL/MONITOR cycle ##################################")
-        logger.debug("Free nodes: " + str(len(self.freenodes)) + " Busy Nodes: " + str(len(self.busynodes)))
+        logger.debug("Free nodes: " + str(self.slots.get_number_free()) + " Busy Nodes: " + str(self.slots.get_number_busy()))
         while True and self.stop==False:
             if self.is_stopped(self.base_url)==True:
                 logger.debug("Pilot job entry deleted - terminate agent")
@@ -607,6 +863,8 @@ class bigjob_agent:
             try:
                 #self.poll_jobs()                
                 self.monitor_jobs()            
+                # requeue jobs dequeued but never started (e.g. by a crashed agent)
+                self.coordination.requeue_expired_jobs(self.base_url)
                 time.sleep(5)
                 self.failed_polls=0
             except:
@@ -614,53 +872,120 @@ class bigjob_agent:
                 self.failed_polls=self.failed_polls+1
                 if self.failed_polls>3: # after 3 failed attempts exit
                     break
+        # ensure that all state updates are written
+        self.job_states.close()
+        # write data buffered by the coordination backend (e.g. queue metrics)
+        if hasattr(self.coordination, "close"):
+            self.coordination.close()
+        self.print_counters()
         logger.debug("Terminating Agent - Background Thread")
         
     
     def is_stopped(self, base_url):
+        """ pilot state is read at most every PILOT_STATE_CACHE_TIME seconds """
+        last_read, stopped = self.pilot_state_cache
+        if time.time() - last_read < PILOT_STATE_CACHE_TIME:
+            return stopped
         state = None
         try:
+            self.counters["get_pilot_state"] = self.counters["get_pilot_state"] + 1
             state = self.coordination.get_pilot_state(base_url)
         except:
             pass
         logger.debug("Pilot State: " + str(state))
         if state==None or state.has_key("stopped")==False or state["stopped"]==True:
-            return True
+            stopped = True
         else:
-            return False
+            stopped = False
+        self.pilot_state_cache = (time.time(), stopped)
+        return stopped
         
 
     def stop_background_thread(self):        
         self.stop=True
         
     
+    def __startup_phase(self, phase, phase_start):
+        """ record duration of startup phase; returns start time of next phase """
+        now = time.time()
+        self.startup_times.append((phase, now-phase_start))
+        return now
+    
+    
     def __get_launch_method(self, requested_method):
-        """ returns desired execution method: ssh, aprun """
-        
-        aprun_available = False
-        try:
-            aprun_available = (subprocess.call("aprun -n 1 /bin/date", shell=True)==0)
-        except:
-            pass
+        """ returns desired execution method: ssh, aprun 
+            an explicitly configured launch method is used without probing. 
+            For launch_method=auto the availability of aprun and ssh is probed 
+            (results are cached per host on disk). 
+        """
+        if requested_method=="ssh" or requested_method=="aprun":
+            logger.debug("Launch method: " + requested_method + " (configured)")
+            return requested_method
         
-        ssh_available = False
-        try:
-            ssh_available = (subprocess.call("ssh localhost /bin/date", shell=True)==0)
-        except:
-            pass
+        available = self.__read_launch_probe_cache()
+        if available == None:
+            available = {}
+            available["aprun"] = self.__probe_command(["aprun", "-n", "1", "/bin/date"])
+            available["ssh"] = self.__probe_command(["ssh", "-o", "BatchMode=yes", 
+                                                     "-o", "ConnectTimeout=%d"%LAUNCH_PROBE_TIMEOUT, 
+                                                     "localhost", "/bin/date"])
+            self.__write_launch_probe_cache(available)
         
         launch_method = "ssh"
-        if requested_method=="aprun" and aprun_available == True:
-            launch_method="aprun"
-        elif requested_method=="ssh" and ssh_available == True:
-            launch_method="ssh"
         # aprun fallback
-        elif ssh_available==False and aprun_available==True:
+        if available["ssh"]==False and available["aprun"]==True:
             launch_method="aprun"
-        logger.debug("aprun: " + str(aprun_available) + " ssh: " + str(ssh_available) 
+        logger.debug("aprun: " + str(available["aprun"]) + " ssh: " + str(available["ssh"]) 
                      + " Launch method: " + str(launch_method))
         return launch_method
     
+    
+    def __probe_command(self, command):
+        """ returns True if command succeeds within LAUNCH_PROBE_TIMEOUT """
+        try:
+            devnull = open(os.devnull, "w")
+            try:
+                p = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+                deadline = time.time() + LAUNCH_PROBE_TIMEOUT
+                while p.poll()==None:
+                    if time.time() > deadline:
+                        logger.warn("Probe timed out: " + " ".join(command))
+                        os.kill(p.pid, signal.SIGKILL)
+                        p.wait()
+                        return False
+                    time.sleep(0.05)
+                return p.returncode==0
+            finally:
+                devnull.close()
+        except:
+            return False
+    
+    
+    def __get_launch_probe_cache_file(self):
+        return os.path.join(LAUNCH_PROBE_CACHE_DIR, "launch-method-" + socket.gethostname())
+    
+    
+    def __read_launch_probe_cache(self):
+        try:
+            cache_file = open(self.__get_launch_probe_cache_file(), "r")
+            available = json.loads(cache_file.read())
+            cache_file.close()
+            logger.debug("Read launch method probe results from: " + self.__get_launch_probe_cache_file())
+            return available
+        except:
+            return None
+    
+    
+    def __write_launch_probe_cache(self, available):
+        try:
+            if not os.path.exists(LAUNCH_PROBE_CACHE_DIR):
+                os.makedirs(LAUNCH_PROBE_CACHE_DIR)
+            cache_file = open(self.__get_launch_probe_cache_file(), "w")
+            cache_file.write(json.dumps(available))
+            cache_file.close()
+        except:
+            logger.warn("Could not write launch method cache: " + self.__get_launch_probe_cache_file())
+    
   
 #########################################################
 #  main                                                 #
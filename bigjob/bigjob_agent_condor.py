@@ -34,6 +34,8 @@ if sys.version_info < (2, 3):
     sys.exit(-1)
 
 import subprocess
+from bigjob import job_description_codec
+from coordination import backend_registry
 
 """ Config parameters (will move to config file in future) """
 CONFIG_FILE="bigjob_agent.conf"
@@ -84,27 +86,19 @@ class bigjob_agent:
         logging.debug("Initialize C&C subsystem to pilot-url: " + self.base_url)
         
         
-        if(self.coordination_url.startswith("advert://")):
-            try:
-                from coordination.bigjob_coordination_advert import bigjob_coordination
-                logging.debug("Utilizing ADVERT Backend: " + self.coordination_url)
-            except:
-                logging.error("Advert Backend could not be loaded")
-        elif (self.coordination_url.startswith("redis://")):
-            try:
-                from coordination.bigjob_coordination_redis import bigjob_coordination      
-                logging.debug("Utilizing Redis Backend: " + self.coordination_url + ". Please make sure Redis server is configured in bigjob_coordination_redis.py")
-            except:
-                logging.error("Error loading pyredis.")
-        elif (self.coordination_url.startswith("tcp://")):
-            try:
-                from coordination.bigjob_coordination_zmq import bigjob_coordination
-                logging.debug("Utilizing ZMQ Backend")
-            except:
-                logging.error("ZMQ Backend not found. Please install ZeroMQ (http://www.zeromq.org/intro:get-the-software) and " 
-                      +"PYZMQ (http://zeromq.github.com/pyzmq/)")
-
-        self.coordination = bigjob_coordination(server_connect_url=self.coordination_url)
+        # backend module is imported on first use of its url scheme
+        bigjob_coordination = backend_registry.get_backend(self.coordination_url)
+        if backend_registry.get_scheme(self.coordination_url) == "redis":
+            # connection pool sized by the threads of the agent (dispatcher, monitoring and 
+            # thread pool), up to 2 connections per thread
+            self.coordination = bigjob_coordination(server_connect_url=self.coordination_url, 
+                                                    max_connections=2*(THREAD_POOL_SIZE+2))
+        else:
+            self.coordination = bigjob_coordination(server_connect_url=self.coordination_url)
+        # this agent does not acknowledge dequeued jobs (ack_job) => reliable queue 
+        # disabled for this consumer, i.e. jobs are removed from the queue on dequeue 
+        # (otherwise requeue_expired_jobs would start them a second time)
+        self.coordination.reliable_queue = False
     
         # update state of pilot job to running
         self.coordination.set_pilot_state(self.base_url, str(bigjob.state.Running), False)
@@ -222,11 +216,7 @@ class bigjob_agent:
                 
                 arguments = ""
                 if (job_dict.has_key("Arguments") == True):
-                    arguments_raw = job_dict['Arguments'];
-                    if type(arguments_raw) == types.ListType:
-                        arguments_list = arguments_raw
-                    else:
-                        arguments_list = eval(job_dict["Arguments"])                    
+                    arguments_list = job_dict['Arguments']
                     for i in arguments_list:
                         arguments = arguments + " " + i
                         
@@ -388,7 +378,7 @@ class bigjob_agent:
         logging.debug("Machinefile: " + filename + " Hosts: " + str(lines))
          
     def free_nodes(self, job_url):
-        job_dict = self.coordination.get_job(job_url)
+        job_dict = job_description_codec.decode(self.coordination.get_job(job_url))
         self.resource_lock.acquire()
         number_nodes = int(job_dict["NumberOfProcesses"])
         machine_file_name = self.get_machine_file_name(job_dict)
@@ -461,7 +451,7 @@ class bigjob_agent:
         if job_url != None:
             failed = False;
             try:
-                job_dict = self.coordination.get_job(job_url)
+                job_dict = job_description_codec.decode(self.coordination.get_job(job_url))
             except:
                 failed=True
                 
@@ -505,7 +495,7 @@ class bigjob_agent:
                     del self.processes[i]
     
     def print_job(self, job_url):
-        job_dict = self.coordination.get_job(job_url)
+        job_dict = job_description_codec.decode(self.coordination.get_job(job_url))
         return  ("Job: " + job_url 
                  + " Excutable: " + job_dict["Executable"])
                                 
@@ -530,6 +520,9 @@ class bigjob_agent:
                 self.failed_polls=self.failed_polls+1
                 if self.failed_polls>3: # after 3 failed attempts exit
                     break
+        # write data buffered by the coordination backend (e.g. queue metrics)
+        if hasattr(self.coordination, "close"):
+            self.coordination.close()
         logging.debug("Terminating Agent - Background Thread")
         
     
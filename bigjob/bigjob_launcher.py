@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""bigjob_launcher: persistent per-node launcher for sub-jobs
+
+The launcher daemon is started once per node by the bigjob agent (via ssh)
+and receives launch requests over the stdin/stdout of the ssh connection.
+Sub-jobs on remote nodes therefore do not pay an ssh handshake per task.
+
+Protocol (one JSON object per line):
+    agent => launcher: {"id":<id>, "argv":[...], "env":{...}, "cwd":<dir>,
+                        "stdout":<file>, "stderr":<file>, "shell":<bool>, 
+                        "executable":<shell>}
+    launcher => agent: {"id":<id>, "pid":<pid>} (process started)
+                       {"id":<id>, "returncode":<returncode>} (process terminated)
+
+This module must only depend on the Python standard library (it is executed
+on the nodes as a standalone script).
+"""
+
+import sys
+import os
+import errno
+import json
+import logging
+import threading
+import traceback
+import subprocess
+
+logger = logging.getLogger(name='bigjob')
+
+# return code reported for processes that could not be started
+LAUNCH_FAILED=127
+
+
+class launcher_daemon(object):
+    """ executes launch requests read from stdin, reports to stdout """
+
+    def __init__(self, input=sys.stdin, output=sys.stdout):
+        self.input = input
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.condition = threading.Condition()
+        # pid => (request id, Popen object); the Popen object must be referenced 
+        # until the process is reaped (Popen.__del__ would reap it otherwise)
+        self.pids = {}
+        self.exited = {}    # pid => status (reaped before registration)
+        # environment is merged once; requests only contain job specific variables
+        self.environment = os.environ.copy()
+
+
+    def run(self):
+        reaper_thread = threading.Thread(target=self.__reap)
+        reaper_thread.daemon = True
+        reaper_thread.start()
+        while True:
+            line = self.input.readline()
+            if line == "":
+                break # agent terminated
+            request = None
+            try:
+                request = json.loads(line)
+                self.launch(request)
+            except:
+                traceback.print_exc(file=sys.stderr)
+                # e.g. invalid request => agent must not wait for the process
+                if isinstance(request, dict) and request.has_key("id"):
+                    self.__send({"id":request["id"], "returncode":LAUNCH_FAILED})
+
+
+    def launch(self, request):
+        """ start process of request; the agent is always notified: pid 
+            (started) or returncode LAUNCH_FAILED (e.g. working directory or 
+            output file not accessible) """
+        env = self.environment
+        if request.get("env"):
+            env = self.environment.copy()
+            env.update(request["env"])
+        stdout = None
+        stderr = None
+        try:
+            stdout = open(request["stdout"], "w")
+            stderr = open(request["stderr"], "w")
+            if request.get("shell", False):
+                p = subprocess.Popen(args=request["argv"][0], executable=request.get("executable", "/bin/bash"),
+                                     stdout=stdout, stderr=stderr, cwd=request["cwd"], env=env, shell=True)
+            else:
+                p = subprocess.Popen(args=request["argv"], stdout=stdout, stderr=stderr,
+                                     cwd=request["cwd"], env=env)
+        except EnvironmentError:
+            traceback.print_exc(file=stderr or sys.stderr)
+            self.__send({"id":request["id"], "returncode":LAUNCH_FAILED})
+            return
+        finally:
+            if stdout != None:
+                stdout.close()
+            if stderr != None:
+                stderr.close()
+        self.__send({"id":request["id"], "pid":p.pid})
+        self.condition.acquire()
+        self.pids[p.pid] = (request["id"], p)
+        status = self.exited.pop(p.pid, None)
+        self.condition.notify()
+        self.condition.release()
+        if status != None:
+            self.__exited(p.pid, status)
+
+
+    def __reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    # no child process => wait for start of next process (also if 
+                    # processes are registered, i.e. were reaped already)
+                    self.condition.acquire()
+                    self.condition.wait(1)
+                    self.condition.release()
+                continue
+            self.__exited(pid, status)
+
+
+    def __exited(self, pid, status):
+        self.condition.acquire()
+        process = self.pids.pop(pid, None)
+        if process == None:
+            self.exited[pid] = status
+        self.condition.release()
+        if process != None:
+            request_id, p = process
+            p.returncode = decode_status(status)
+            self.__send({"id":request_id, "returncode":p.returncode})
+
+
+    def __send(self, response):
+        self.output_lock.acquire()
+        try:
+            self.output.write(json.dumps(response) + "\n")
+            self.output.flush()
+        finally:
+            self.output_lock.release()
+
+
+
+class remote_process(object):
+    """ handle for a process started by a launcher daemon
+        (duck typing of the subprocess.Popen attributes used by the agent) """
+
+    def __init__(self, job_url):
+        self.job_url = job_url
+        self.pid = None
+        self.returncode = None
+
+
+
+class launcher_client(object):
+    """ agent side of a launcher daemon running on host """
+
+    def __init__(self, host, exit_callback, python=sys.executable, start_callback=None):
+        """ exit_callback(job_url, remote_process) is called on process termination
+            start_callback(job_url, remote_process) is called when the process 
+            was started (pid reported by the launcher)
+            host None starts the launcher locally (without ssh)
+        """
+        self.host = host
+        self.exit_callback = exit_callback
+        self.start_callback = start_callback
+        self.lock = threading.Lock()
+        self.processes = {} # request id => remote_process
+        self.counter = 0
+        command = [python, os.path.abspath(__file__).replace(".pyc", ".py")]
+        if host != None:
+            command = ["ssh", "-o", "BatchMode=yes", host] + command
+        logger.debug("Start launcher: " + " ".join(command))
+        self.launcher = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.reader_thread = threading.Thread(target=self.__read_responses)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+
+    def is_alive(self):
+        return self.reader_thread.isAlive()
+
+
+    def launch(self, job_url, argv, env, cwd, stdout, stderr, shell=False, executable="/bin/bash"):
+        """ launch process on host; returns remote_process handle
+            env: job specific environment variables (merged with launcher environment)
+            shell: argv[0] is a command line executed by executable
+        """
+        p = remote_process(job_url)
+        self.lock.acquire()
+        try:
+            self.counter = self.counter + 1
+            request_id = self.counter
+            self.processes[request_id] = p
+            self.launcher.stdin.write(json.dumps({"id":request_id, "argv":argv, "env":env, "cwd":cwd,
+                                                  "stdout":stdout, "stderr":stderr,
+                                                  "shell":shell, "executable":executable}) + "\n")
+            self.launcher.stdin.flush()
+        except:
+            del self.processes[request_id]
+            raise
+        finally:
+            self.lock.release()
+        return p
+
+
+    def close(self):
+        try:
+            self.launcher.stdin.close()
+        except:
+            pass
+
+
+    def __read_responses(self):
+        while True:
+            line = self.launcher.stdout.readline()
+            if line == "":
+                break
+            response = json.loads(line)
+            self.lock.acquire()
+            p = self.processes.get(response["id"])
+            if response.has_key("returncode"):
+                self.processes.pop(response["id"], None)
+            self.lock.release()
+            if p == None:
+                continue
+            if response.has_key("pid"):
+                p.pid = response["pid"]
+                if self.start_callback != None:
+                    try:
+                        self.start_callback(p.job_url, p)
+                    except:
+                        traceback.print_exc(file=sys.stderr)
+            if response.has_key("returncode"):
+                p.returncode = response["returncode"]
+                try:
+                    self.exit_callback(p.job_url, p)
+                except:
+                    traceback.print_exc(file=sys.stderr)
+        # launcher terminated => processes are lost
+        logger.error("Launcher at %s terminated"%self.host)
+        self.lock.acquire()
+        processes = self.processes.values()
+        self.processes = {}
+        self.lock.release()
+        for p in processes:
+            p.returncode = LAUNCH_FAILED
+            self.exit_callback(p.job_url, p)
+
+
+
+def decode_status(status):
+    """ return code of waitpid status (negative signal number if signaled) """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+if __name__ == "__main__":
+    launcher_daemon().run()
@@ -19,6 +19,7 @@ import sys
 from bigjob import logger
 import time
 import os
+import threading
 import traceback
 import logging
 import textwrap
@@ -56,6 +57,8 @@ else:
 # import other BigJob packages
 # import API
 import api.base
+from bigjob import job_description_codec
+from coordination import backend_registry
 sys.path.append(os.path.dirname(__file__))
 
 from pbsssh import pbsssh
@@ -80,6 +83,15 @@ def get_uuid():
 
 """ Config parameters (will move to config file in future) """
 CLEANUP=True
+# number of sub-jobs written to the coordination backend per batch (see add_subjobs)
+SUBMISSION_BATCH_SIZE=1000
+# max. time (in sec) the state monitor blocks waiting for sub-job state changes
+STATE_CHANGE_TIMEOUT=5
+# polling interval (in sec) for sub-job states if the coordination backend 
+# provides no state change stream
+SUBJOB_POLL_INTERVAL=2
+# final states of sub-jobs
+FINAL_STATES=[str(Done), str(Failed), "Canceled"]
 
 #for legacy purposes and support for old BJ API
 pilot_url_dict={} # stores a mapping of pilot_url to bigjob
@@ -103,6 +115,7 @@ class bigjob(api.base.bigjob):
             advert://advert.cct.lsu.edu:8080 (SAGA/Advert POSTGRESQL)
             redis://localhost:6379 (Redis at localhost)
             tcp://localhost (ZMQ)
+            sqlite:///tmp/bigjob.db (SQLite database file, single host/shared file system)
         """  
         
         self.uuid = "bj-" + str(get_uuid())
@@ -117,31 +130,23 @@ class bigjob(api.base.bigjob):
         self.pilot_url=""
         self.job = None
         self.working_directory = None
+        
+        # sub-job states reported by the state change stream of the 
+        # coordination backend (see __monitor_subjob_states)
+        self.subjob_states = {}     # job_url => state
+        self.state_callbacks = []
+        self.state_condition = threading.Condition()
+        self.state_monitor_thread = None
+        self.state_changes_supported = True
         logger.debug("initialized BigJob: " + self.app_url)
         
         
     def __init_coordination(self, coordination_url):        
-        if(coordination_url.startswith("advert://") or coordination_url.startswith("sqlasyncadvert://")):
-            try:
-                from coordination.bigjob_coordination_advert import bigjob_coordination
-                logger.debug("Utilizing ADVERT Backend")
-            except:
-                logger.error("Advert Backend could not be loaded")
-        elif (coordination_url.startswith("redis://")):
-            try:
-                from coordination.bigjob_coordination_redis import bigjob_coordination      
-                logger.debug("Utilizing Redis Backend")
-            except:
-                logger.error("Error loading pyredis.")
-        elif (coordination_url.startswith("tcp://")):
-            try:
-                from coordination.bigjob_coordination_zmq import bigjob_coordination
-                logger.debug("Utilizing ZMQ Backend")
-            except:
-                logger.error("ZMQ Backend not found. Please install ZeroMQ (http://www.zeromq.org/intro:get-the-software) and " 
-                      +"PYZMQ (http://zeromq.github.com/pyzmq/)")
-        else:
-            logger.error("No suitable coordination backend found.")
+        # backend module is imported on first use of its url scheme
+        bigjob_coordination = backend_registry.get_backend(coordination_url)
+        if (coordination_url.startswith("sqlite://")):
+            # url contains path of database file (not host/port)
+            return bigjob_coordination(server_connect_url=coordination_url)
         
         logger.debug("Parsing URL: " + coordination_url)
         scheme, username, password, host, port, dbtype  = self.__parse_url(coordination_url) 
@@ -363,53 +368,139 @@ bigjob_agent = bigjob.bigjob_agent.bigjob_agent(args)
      
      
     def add_subjob(self, jd, job_url, job_id):
-        logger.debug("Stage input files for sub-job")
-        if jd.attribute_exists ("filetransfer"):
-            try:
-                self.__stage_files(jd.filetransfer, self.__get_subjob_working_dir(job_id))
-            except:
-                logger.error("File Stagein failed. Is Paramiko installed?")
+        self.__stage_subjob_files(jd, job_id)
         logger.debug("add subjob to queue of PJ: " + str(self.pilot_url))        
         for i in range(0,3):
             try:
                 logger.debug("create dictionary for job description. Job-URL: " + job_url)
                 # put job description attributes to Redis
-                job_dict = {}
-                #to accomendate current bug in bliss (Number of processes is not returned from list attributes)
-                job_dict["NumberOfProcesses"] = "1" 
-                attributes = jd.list_attributes()   
-                logger.debug("SJ Attributes: " + str(jd))             
-                for i in attributes:          
-                        if jd.attribute_is_vector(i):
-                            #logger.debug("Add attribute: " + str(i) + " Value: " + str(jd.get_vector_attribute(i)))
-                            vector_attr = []
-                            for j in jd.get_vector_attribute(i):
-                                vector_attr.append(j)
-                            job_dict[i]=vector_attr
-                        else:
-                            #logger.debug("Add attribute: " + str(i) + " Value: " + jd.get_attribute(i))
-                            job_dict[i] = jd.get_attribute(i)
-                
-                job_dict["state"] = str(Unknown)
-                job_dict["job-id"] = str(job_id)
+                job_dict = self.__create_job_dict(jd, job_id)
                 
                 #logger.debug("update job description at communication & coordination sub-system")
-                self.coordination.set_job(job_url, job_dict)                                                
-                self.coordination.queue_job(self.pilot_url, job_url)
+                self.coordination.submit_job(self.pilot_url, job_url, job_description_codec.encode(job_dict))
                 break
             except:
                 traceback.print_exc(file=sys.stdout)
                 time.sleep(2)
                 #raise Exception("Unable to submit job")
+    
+    
+    def add_subjobs(self, jds):
+        """ bulk submission of sub-jobs 
+            job descriptions and queue entries are written to the coordination 
+            backend in batches of SUBMISSION_BATCH_SIZE sub-jobs
+            returns list of subjob objects (in the order of jds)
+            raises BigJobError if a batch cannot be submitted (3 attempts); the 
+            attribute subjobs of the error lists the sub-jobs of the batches 
+            submitted before (the remaining sub-jobs are not submitted)
+        """
+        subjobs = []
+        for jd in jds:
+            sj = subjob(self.coordination_url)
+            sj.pilot_url = self.pilot_url
+            sj.bj = self
+            sj.get_job_url(self.pilot_url)
+            self.__stage_subjob_files(jd, sj.uuid)
+            subjobs.append(sj)
+        logger.debug("add %d subjobs to queue of PJ: %s"%(len(subjobs), str(self.pilot_url)))
+        for start in range(0, len(subjobs), SUBMISSION_BATCH_SIZE):
+            batch = subjobs[start:start+SUBMISSION_BATCH_SIZE]
+            jobs = [(sj.job_url, job_description_codec.encode(self.__create_job_dict(jd, sj.uuid))) 
+                        for sj, jd in zip(batch, jds[start:start+SUBMISSION_BATCH_SIZE])]
+            for i in range(0,3):
+                try:
+                    self.coordination.submit_jobs(self.pilot_url, jobs)
+                    break
+                except:
+                    logger.error("Failed to submit sub-jobs %d-%d of %d (attempt %d/3): %s"
+                                 %(start, start+len(batch)-1, len(subjobs), i+1, str(sys.exc_info()[1])))
+                    if i == 2:
+                        error = BigJobError("Failed to submit sub-jobs %d-%d of %d"
+                                            %(start, len(subjobs)-1, len(subjobs)))
+                        error.subjobs = subjobs[:start]
+                        raise error
+                    time.sleep(2)
+        return subjobs
+    
+    
+    def __stage_subjob_files(self, jd, job_id):
+        logger.debug("Stage input files for sub-job")
+        if jd.attribute_exists ("filetransfer"):
+            try:
+                self.__stage_files(jd.filetransfer, self.__get_subjob_working_dir(job_id))
+            except:
+                logger.error("File Stagein failed. Is Paramiko installed?")
+    
+    
+    def __create_job_dict(self, jd, job_id):
+        """ create dictionary with job description attributes """
+        job_dict = {}
+        #to accomendate current bug in bliss (Number of processes is not returned from list attributes)
+        job_dict["NumberOfProcesses"] = "1" 
+        attributes = jd.list_attributes()   
+        logger.debug("SJ Attributes: " + str(jd))             
+        for i in attributes:          
+                if jd.attribute_is_vector(i):
+                    #logger.debug("Add attribute: " + str(i) + " Value: " + str(jd.get_vector_attribute(i)))
+                    vector_attr = []
+                    for j in jd.get_vector_attribute(i):
+                        vector_attr.append(j)
+                    job_dict[i]=vector_attr
+                else:
+                    #logger.debug("Add attribute: " + str(i) + " Value: " + jd.get_attribute(i))
+                    job_dict[i] = jd.get_attribute(i)
+        
+        job_dict["state"] = str(Unknown)
+        job_dict["job-id"] = str(job_id)
+        return job_dict
+    
                      
     def delete_subjob(self, job_url):
         self.coordination.delete_job(job_url) 
+        self.state_condition.acquire()
+        self.subjob_states.pop(job_url, None)
+        self.state_condition.release()
     
     def get_subjob_state(self, job_url):
+        self.state_condition.acquire()
+        state = self.subjob_states.get(job_url)
+        self.state_condition.release()
+        if state != None:
+            return state
         return self.coordination.get_job_state(job_url) 
     
+    def wait_subjob(self, job_url):
+        """ block until sub-job is in a final state; returns final state """
+        if not self.__start_state_monitor():
+            state = self.coordination.get_job_state(job_url)
+            while not state in FINAL_STATES:
+                time.sleep(SUBJOB_POLL_INTERVAL)
+                state = self.coordination.get_job_state(job_url)
+            return state
+        # state changes before the start of the monitor might not be reported
+        state = self.get_subjob_state(job_url)
+        self.state_condition.acquire()
+        try:
+            while not state in FINAL_STATES:
+                self.state_condition.wait(STATE_CHANGE_TIMEOUT)
+                state = self.subjob_states.get(job_url, state)
+        finally:
+            self.state_condition.release()
+        return state
+    
+    def add_subjob_state_callback(self, callback):
+        """ callback(job_url, state) is called (by the state monitor thread) for 
+            every state change of a sub-job of this pilot
+            returns False if the coordination backend provides no state change 
+            stream, i.e. sub-job states must be polled
+        """
+        self.state_condition.acquire()
+        self.state_callbacks.append(callback)
+        self.state_condition.release()
+        return self.__start_state_monitor()
+    
     def get_subjob_details(self, job_url):
-        return self.coordination.get_job(job_url) 
+        return job_description_codec.decode(self.coordination.get_job(job_url))
      
     def get_state(self):        
         """ duck typing for get_state of saga.job.job  
@@ -431,7 +522,7 @@ bigjob_agent = bigjob.bigjob_agent.bigjob_agent(args)
         jobs = self.coordination.get_jobs_of_pilot(self.pilot_url)
         number_used_nodes=0
         for i in jobs:
-            job_detail = self.coordination.get_job(i)            
+            job_detail = job_description_codec.decode(self.coordination.get_job(i))
             if job_detail != None and job_detail.has_key("state") == True\
                 and job_detail["state"]==str(Running):
                 job_np = "1"
@@ -447,6 +538,7 @@ bigjob_agent = bigjob.bigjob_agent.bigjob_agent(args)
             logger.debug("stop pilot job: " + self.pilot_url)
             self.coordination.set_pilot_state(self.pilot_url, str(Done), True)            
             self.job=None
+            self.state_monitor_thread=None
         except:
             pass
     
@@ -471,6 +563,50 @@ bigjob_agent = bigjob.bigjob_agent.bigjob_agent(args)
     ###########################################################################
     # internal methods
     
+    def __start_state_monitor(self):
+        """ start thread consuming the sub-job state change stream of the pilot
+            returns False if the coordination backend provides no stream
+        """
+        self.state_condition.acquire()
+        try:
+            if self.state_monitor_thread == None and self.state_changes_supported:
+                changes = self.coordination.get_job_state_changes(self.pilot_url)
+                if changes == None:
+                    self.state_changes_supported = False
+                else:
+                    self.state_monitor_thread = threading.Thread(target=self.__monitor_subjob_states,
+                                                                 args=(changes,))
+                    self.state_monitor_thread.daemon = True
+                    self.state_monitor_thread.start()
+            return self.state_changes_supported
+        finally:
+            self.state_condition.release()
+    
+    def __monitor_subjob_states(self, changes):
+        """ single subscriber to the state changes of all sub-jobs of the pilot 
+            (replaces polling of the state of every sub-job) """
+        thread = threading.currentThread()
+        while self.state_monitor_thread == thread:
+            self.state_condition.acquire()
+            for job_url, state in changes:
+                self.subjob_states[job_url] = state
+            callbacks = self.state_callbacks[:]
+            self.state_condition.notifyAll()
+            self.state_condition.release()
+            for job_url, state in changes:
+                for callback in callbacks:
+                    try:
+                        callback(job_url, state)
+                    except:
+                        traceback.print_exc(file=sys.stderr)
+            try:
+                changes = self.coordination.get_job_state_changes(self.pilot_url, STATE_CHANGE_TIMEOUT)
+            except:
+                logger.error("Failed to get sub-job state changes")
+                changes = []
+                time.sleep(1)
+        logger.debug("Terminating sub-job state monitor of: " + str(self.pilot_url))
+    
     def __parse_url(self, url):
         try:
             if is_bliss==True:
@@ -681,6 +817,21 @@ class subjob(api.base.subjob):
         self.bj.add_subjob(jd, self.job_url, self.uuid)
 
 
+    def wait(self, pilot_url=None):
+        """ block until sub-job is finished; returns final state """
+        if self.pilot_url==None:
+            self.pilot_url = pilot_url
+            self.bj=pilot_url_dict[pilot_url]                
+        return self.bj.wait_subjob(self.job_url)
+
+
+    @staticmethod
+    def submit_jobs(pilot_url, jds):
+        """ bulk submission of sub-jobs to referenced bigjob 
+            returns list of subjob objects """
+        return pilot_url_dict[pilot_url].add_subjobs(jds)
+
+
     def get_state(self, pilot_url=None):        
         """ duck typing for saga.job  """
         if self.pilot_url==None:
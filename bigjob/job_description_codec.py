@@ -0,0 +1,78 @@
+"""job_description_codec: serialization of sub-job descriptions
+
+Sub-job descriptions are stored in the coordination backend as a flat
+dictionary of strings (e.g. a Redis hash):
+    "jd":     versioned, JSON encoded job description ("v1:<json>")
+    "state":  state of the sub-job (updated separately by set_job_state)
+    "job-id": id of the sub-job
+
+Decoding is O(size of the description) and does not evaluate Python code.
+Descriptions written by earlier BigJob versions (one field per attribute,
+vector attributes as Python list representation) are still decoded.
+"""
+
+import json
+import ast
+
+CODEC_VERSION="v1"
+DESCRIPTION_FIELD="jd"
+
+# attributes stored as separate fields (outside of the encoded description)
+_PLAIN_FIELDS=["state", "job-id"]
+# vector attributes of the legacy format
+_VECTOR_ATTRIBUTES=["Arguments", "Environment", "filetransfer", "JobProject", "CandidateHosts"]
+
+
+def encode(job_dict):
+    """ encode job description dictionary for storage in coordination backend """
+    description = {}
+    stored = {}
+    for key, value in job_dict.items():
+        if key in _PLAIN_FIELDS:
+            stored[key] = str(value)
+        else:
+            description[key] = value
+    stored[DESCRIPTION_FIELD] = CODEC_VERSION + ":" + json.dumps(description, separators=(',', ':'))
+    return stored
+
+
+def decode(stored):
+    """ decode job description dictionary read from coordination backend
+        returns None if stored is None
+    """
+    if stored == None:
+        return None
+    if not stored.has_key(DESCRIPTION_FIELD):
+        return _decode_legacy(stored)
+    encoded = stored[DESCRIPTION_FIELD]
+    version, separator, data = encoded.partition(":")
+    if version != CODEC_VERSION:
+        raise ValueError("Unsupported job description version: %s"%version)
+    job_dict = _to_str(json.loads(data))
+    for key in _PLAIN_FIELDS:
+        if stored.has_key(key):
+            job_dict[key] = str(stored[key])
+    return job_dict
+
+
+def _decode_legacy(stored):
+    job_dict = dict(stored)
+    for key in _VECTOR_ATTRIBUTES:
+        value = job_dict.get(key)
+        if isinstance(value, basestring) and value.startswith("["):
+            # literal_eval only accepts literals (no code execution)
+            job_dict[key] = ast.literal_eval(value)
+    return job_dict
+
+
+def _to_str(job_dict):
+    """ json returns unicode strings => convert to str 
+        (values are strings or lists of strings) """
+    result = {}
+    for key, value in job_dict.iteritems():
+        if type(value) == unicode:
+            value = value.encode("utf-8")
+        elif type(value) == list:
+            value = [type(i) == unicode and i.encode("utf-8") or i for i in value]
+        result[key.encode("utf-8")] = value
+    return result
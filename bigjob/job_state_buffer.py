@@ -0,0 +1,111 @@
+"""job_state_buffer: batches sub-job state updates of the bigjob agent
+
+State transitions are buffered for a short window and written to the
+coordination backend with a single bulk call (set_job_states). Transitions
+of the same job within one window are coalesced, i.e. only the latest state
+is written. Acknowledgements of dequeued jobs (ack_job) are sent with the
+state updates of the window (no extra round-trip per job).
+"""
+
+import sys
+import time
+import threading
+import traceback
+
+from bigjob import logger
+
+
+class job_state_buffer(object):
+
+    def __init__(self, coordination, window=0.05):
+        """ window: time (in sec) state updates are buffered; 0 disables buffering """
+        self.coordination = coordination
+        self.window = window
+        self.pending = {}   # job_url => state
+        self.pending_acks = [] # (pilot_url, job_url)
+        self.condition = threading.Condition()
+        # serializes flushes => updates of a job are written in order
+        self.flush_lock = threading.Lock()
+        self.stopped = False
+        if self.window > 0:
+            self.flush_thread = threading.Thread(target=self.__flush_loop)
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+
+
+    def set_job_state(self, job_url, new_state):
+        self.condition.acquire()
+        try:
+            if self.window > 0 and not self.stopped:
+                self.pending[job_url] = str(new_state)
+                self.condition.notify()
+                return
+        finally:
+            self.condition.release()
+        self.coordination.set_job_state(job_url, str(new_state))
+
+
+    def ack_job(self, pilot_url, job_url):
+        """ acknowledge dequeued job with the next flush (see set_job_states) """
+        self.condition.acquire()
+        try:
+            if self.window > 0 and not self.stopped:
+                self.pending_acks.append((pilot_url, job_url))
+                self.condition.notify()
+                return
+        finally:
+            self.condition.release()
+        self.coordination.ack_job(pilot_url, job_url)
+
+
+    def flush(self):
+        """ write all buffered state updates with one bulk call """
+        self.flush_lock.acquire()
+        try:
+            self.condition.acquire()
+            job_states = self.pending
+            self.pending = {}
+            acks = self.pending_acks
+            self.pending_acks = []
+            self.condition.release()
+            if len(job_states) > 0 or len(acks) > 0:
+                logger.debug("Flush %d job state updates, %d acks"%(len(job_states), len(acks)))
+                try:
+                    self.coordination.set_job_states(job_states, acks)
+                except:
+                    # keep updates for next flush (unless superseded)
+                    self.condition.acquire()
+                    for job_url, state in job_states.items():
+                        if not self.pending.has_key(job_url):
+                            self.pending[job_url] = state
+                    self.pending_acks = acks + self.pending_acks
+                    self.condition.release()
+                    raise
+        finally:
+            self.flush_lock.release()
+
+
+    def close(self):
+        """ flush outstanding updates; subsequent updates are written directly """
+        self.condition.acquire()
+        self.stopped = True
+        self.condition.notify()
+        self.condition.release()
+        self.flush()
+
+
+    def __flush_loop(self):
+        while True:
+            self.condition.acquire()
+            while len(self.pending) == 0 and len(self.pending_acks) == 0 and not self.stopped:
+                self.condition.wait()
+            stopped = self.stopped
+            self.condition.release()
+            if stopped:
+                break
+            # collect further updates for the length of the window
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except:
+                traceback.print_exc(file=sys.stderr)
@@ -0,0 +1,150 @@
+"""slot_allocator: bookkeeping of the slots (cores) managed by a bigjob agent
+
+Slots are indexed by host. For every host the number of free slots is kept
+in a counter; hosts with free slots are kept in insertion ordered dictionaries,
+i.e. allocating and freeing a slot is O(1) independent of the size of the
+allocation.
+
+Placement policies:
+    pack: fill a host before moving on to the next host (default)
+    spread: distribute slots round-robin across hosts
+    whole_node: reserve complete (idle) hosts, e.g. for MPI jobs
+"""
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python < 2.7: no placement order guarantees
+    OrderedDict = dict
+
+from bigjob import logger
+
+PACK="pack"
+SPREAD="spread"
+
+
+class slot_allocator(object):
+
+    def __init__(self, policy=PACK):
+        if policy!=PACK and policy!=SPREAD:
+            logger.warn("Unknown placement policy: %s. Using %s."%(policy, PACK))
+            policy=PACK
+        self.policy = policy
+        self.total = {}     # host => number of slots
+        self.free = {}      # host => number of free slots
+        self.available = OrderedDict() # hosts with at least one free slot
+        self.idle = OrderedDict()      # hosts with all slots free
+        self.number_slots = 0
+        self.number_free = 0
+
+
+    def add_host(self, host, slots=1):
+        """ add slots of host (slots of known hosts are accumulated) """
+        if slots <= 0:
+            return
+        self.total[host] = self.total.get(host, 0) + slots
+        self.free[host] = self.free.get(host, 0) + slots
+        self.number_slots = self.number_slots + slots
+        self.number_free = self.number_free + slots
+        self.__update(host)
+
+
+    def get_number_free(self):
+        return self.number_free
+
+
+    def get_number_busy(self):
+        return self.number_slots - self.number_free
+
+
+    def get_hosts(self):
+        return self.total.keys()
+
+
+    def allocate(self, number_slots, whole_node=False):
+        """ allocate number_slots slots
+            returns list with one host entry per allocated slot or None if not
+            enough slots are free
+        """
+        if number_slots > self.number_free:
+            return None
+        if whole_node:
+            return self.__allocate_whole_nodes(number_slots)
+        nodes = []
+        while number_slots > 0:
+            host = self.__first(self.available)
+            if self.policy == SPREAD:
+                count = 1
+                # move host to the end of the round-robin order
+                del self.available[host]
+            else:
+                count = min(self.free[host], number_slots)
+            self.__take(host, count)
+            nodes.extend([host]*count)
+            number_slots = number_slots - count
+        return nodes
+
+
+    def release(self, nodes):
+        """ free slots (list with one host entry per slot as returned by allocate) """
+        counts = {}
+        for host in nodes:
+            counts[host] = counts.get(host, 0) + 1
+        for host, count in counts.items():
+            if not self.free.has_key(host):
+                logger.warn("Free slots of unknown host: %s"%host)
+                continue
+            count = min(count, self.total[host]-self.free[host])
+            self.free[host] = self.free[host] + count
+            self.number_free = self.number_free + count
+            self.__update(host)
+
+
+    def __allocate_whole_nodes(self, number_slots):
+        """ reserve idle hosts until number_slots is satisfied. All slots
+            of the reserved hosts are returned """
+        hosts = []
+        slots = 0
+        for host in self.idle:
+            if slots >= number_slots:
+                break
+            hosts.append(host)
+            slots = slots + self.total[host]
+        if slots < number_slots:
+            return None
+        nodes = []
+        for host in hosts:
+            count = self.free[host]
+            self.__take(host, count)
+            nodes.extend([host]*count)
+        return nodes
+
+
+    def __take(self, host, count):
+        self.free[host] = self.free[host] - count
+        self.number_free = self.number_free - count
+        self.__update(host)
+
+
+    def __update(self, host):
+        """ update indexes of host """
+        free = self.free[host]
+        if free > 0:
+            if not self.available.has_key(host):
+                self.available[host] = True
+        elif self.available.has_key(host):
+            del self.available[host]
+        if free == self.total[host]:
+            if not self.idle.has_key(host):
+                self.idle[host] = True
+        elif self.idle.has_key(host):
+            del self.idle[host]
+
+
+    def __first(self, ordered_dict):
+        return iter(ordered_dict).next()
+
+
+    def __repr__(self):
+        return "Slots: %d Free: %d Hosts: %d Policy: %s"%(self.number_slots, self.number_free,
+                                                         len(self.total), self.policy)
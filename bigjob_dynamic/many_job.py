@@ -51,6 +51,8 @@ class many_job_service(object):
         # state variable storing state of sub-jobs 
         self.active_subjob_list = []
         self.subjob_bigjob_dict = {}
+        # job_url => subjob (sub-jobs on bigjobs with state change notifications)
+        self.job_url_subjob_dict = {}
 
         # queue contains unscheduled subjobs        
         self.subjob_queue = Queue.Queue()
@@ -107,6 +109,9 @@ class many_job_service(object):
         bj_dict["to_be_terminated"]=False
         # lock for modifying the number of free nodes
         bj_dict["lock"] = threading.Lock()
+        # sub-job completions are reported via callback (if supported by the 
+        # coordination backend) instead of polling the state of each sub-job
+        bj_dict["state_changes"] = bj.add_subjob_state_callback(self.__subjob_state_changed)
 
     def add_resource(self, resource_dictionary):
         """ adds bigjob described in resource_dictionary to resources """
@@ -173,12 +178,17 @@ class many_job_service(object):
         # create subjob on bigjob
         bj = bigjob_info["bigjob"]
         
+        # store reference of subjob for further bookkeeping (before submission, 
+        # state changes can be reported as soon as the subjob is queued)
+        self.subjob_bigjob_dict[subjob] = bigjob_info
+        if bigjob_info["state_changes"]:
+            self.job_url_subjob_dict[job.get_job_url(bj.pilot_url)] = subjob
+        else:
+            self.active_subjob_list.append(subjob)
+        
         job.submit_job(bj.pilot_url, subjob.job_description)
         self.submisssion_times.append(time.time()-st)
 
-        # store reference of subjob for further bookkeeping    
-        self.active_subjob_list.append(subjob)
-        self.subjob_bigjob_dict[subjob] = bigjob_info
         logging.debug("Subjob submission time: " + str(time.time()-st) + " sec.")
         return job
 
@@ -219,8 +229,8 @@ class many_job_service(object):
         return None        
 
     def __check_subjobs_states(self):    
-        """iterate through all sub-jobs and check state"""
-        for i in self.active_subjob_list:            
+        """iterate through all sub-jobs without state change notifications and check state"""
+        for i in self.active_subjob_list[:]:            
             try:
                 #logging.debug("get job state")
                 state = i.job.get_state()
@@ -228,10 +238,18 @@ class many_job_service(object):
                 if self.__has_finished(state) == True:
                     #logging.debug("free resources")
                     self.__free_resources(i)
+                    self.active_subjob_list.remove(i)
             except:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 traceback.print_exception(exc_type, exc_value, exc_traceback,
                                           limit=2, file=sys.stderr)
+    
+    def __subjob_state_changed(self, job_url, state):
+        """ callback for state changes of sub-jobs (called by the bigjob state monitor) """
+        if self.__has_finished(state) == True:
+            subjob = self.job_url_subjob_dict.pop(job_url, None)
+            if subjob != None:
+                self.__free_resources(subjob)
         
     def __free_resources(self, subjob):
         """free resources taken by subjob"""
@@ -379,9 +397,10 @@ class sub_job(object):
     def wait(self):
         while 1:
             try:
-                state = self.get_state()
-                logging.debug("wait: state: " + state)
-                if self.__has_finished(state) == True:
+                # wait for submission to a bigjob (see many_job_service.__run_subjob)
+                if self.job.pilot_url != None:
+                    state = self.job.wait()
+                    logging.debug("wait: state: " + state)
                     break
                 time.sleep(2)
             except (KeyboardInterrupt, SystemExit):
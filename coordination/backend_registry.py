@@ -0,0 +1,107 @@
+"""backend_registry: coordination backends by URL scheme
+
+The backend class (bigjob_coordination) for a coordination url is looked up
+by the scheme of the url, e.g. redis://localhost:6379 => redis. Backend
+modules are imported when a url with their scheme is used for the first
+time, i.e. dependencies of unused backends (SAGA, redis-py, pyzmq) are not
+imported.
+
+Other packages add backends with an entry point of the group
+"bigjob.coordination" named by the scheme, referring to the backend class or
+to a module defining bigjob_coordination, e.g. in setup.py:
+
+    entry_points = {"bigjob.coordination": ["mongodb = mypackage.coordination_mongodb"]}
+
+or at runtime with register_backend.
+"""
+
+import types
+
+from bigjob import logger
+
+ENTRY_POINT_GROUP="bigjob.coordination"
+
+# scheme => module name or class of backend (modules are replaced by the
+# class on first use)
+_backends = {
+    "advert": "coordination.bigjob_coordination_advert",
+    "sqlasyncadvert": "coordination.bigjob_coordination_advert",
+    "redis": "coordination.bigjob_coordination_redis",
+    "tcp": "coordination.bigjob_coordination_zmq",
+    "sqlite": "coordination.bigjob_coordination_sqlite",
+}
+
+# hints for backends failing to import (missing dependency)
+_requirements = {
+    "coordination.bigjob_coordination_advert": "SAGA C++ and Python bindings with advert package (http://saga-project.org)",
+    "coordination.bigjob_coordination_redis": "redis-py (http://github.com/andymccurdy/redis-py)",
+    "coordination.bigjob_coordination_zmq": "ZeroMQ (http://www.zeromq.org/intro:get-the-software) and "
+                                            + "PYZMQ (http://zeromq.github.com/pyzmq/)",
+}
+
+
+def register_backend(scheme, backend):
+    """ register backend (class or name of module defining bigjob_coordination)
+        for urls of scheme (replaces existing backend of scheme) """
+    _backends[scheme] = backend
+
+
+def get_schemes():
+    """ returns schemes of the built-in and registered backends
+        (without backends of entry points) """
+    return sorted(_backends.keys())
+
+
+def get_scheme(url):
+    """ returns scheme of coordination url, e.g. redis for redis://localhost """
+    if url.find("://") < 1:
+        raise ValueError("Invalid coordination url (no scheme): %s"%url)
+    return url.split("://", 1)[0]
+
+
+def get_backend(url):
+    """ returns backend class (bigjob_coordination) for coordination url
+        raises ValueError if no backend is registered for the scheme of url and
+        ImportError if the backend (or one of its dependencies) can not be imported
+    """
+    scheme = get_scheme(url)
+    backend = _backends.get(scheme)
+    if backend == None:
+        backend = _load_entry_point(scheme)
+        if backend == None:
+            raise ValueError("No coordination backend for %s:// urls (supported: %s)"
+                             %(scheme, ", ".join(get_schemes())))
+    if isinstance(backend, basestring):
+        backend = _import_backend(backend)
+        _backends[scheme] = backend
+    logger.debug("Utilizing %s backend: %s.%s"%(scheme, backend.__module__, backend.__name__))
+    return backend
+
+
+def _import_backend(module_name):
+    try:
+        module = __import__(module_name, globals(), locals(), ["bigjob_coordination"])
+    except ImportError, e:
+        message = "Coordination backend %s could not be loaded: %s"%(module_name, str(e))
+        if _requirements.has_key(module_name):
+            message = message + ". Please install " + _requirements[module_name]
+        logger.error(message)
+        raise ImportError(message)
+    return module.bigjob_coordination
+
+
+def _load_entry_point(scheme):
+    """ returns backend class of entry point scheme of group ENTRY_POINT_GROUP or None """
+    try:
+        # pkg_resources scans all installed distributions => only imported if
+        # scheme is not a built-in backend
+        import pkg_resources
+    except ImportError:
+        return None
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, scheme):
+        backend = entry_point.load()
+        if isinstance(backend, types.ModuleType):
+            backend = backend.bigjob_coordination
+        _backends[scheme] = backend
+        return backend
+    return None
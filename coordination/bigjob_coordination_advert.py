@@ -12,6 +12,11 @@ import saga
 import json
 import urlparse
 import logging
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python < 2.7: no LRU order (arbitrary handles are evicted)
+    OrderedDict = dict
 
 from bigjob import logger
 logger.debug("Load Advert Coordination")
@@ -27,6 +32,16 @@ APPLICATION_NAME="BigJob/BigJob"
 ADVERT_URL_SCHEME = "advert://"
 ADVERT_SERVER="advert.cct.lsu.edu"
 ADVERT_SERVER_PORT=8080
+# max. number of open advert directory/entry handles (least recently used 
+# handles are closed); every open is a round-trip to the advert database
+HANDLE_CACHE_SIZE=1024
+# max. number of queue entries read by one listing of <pilot>/new/ 
+# (entries are claimed from the local prefetch buffer)
+PREFETCH_SIZE=64
+# sleep (in sec) of dequeue_job if queue is empty: doubled on every empty 
+# listing up to DEQUEUE_MAX_SLEEP
+DEQUEUE_MIN_SLEEP=0.05
+DEQUEUE_MAX_SLEEP=1
 
 class bigjob_coordination(object):
     '''
@@ -84,6 +99,14 @@ class bigjob_coordination(object):
                       " server_connect_url: " + str(server_connect_url) )
         logger.debug("Initialized Coordination to: %s (DB: %s)"%(self.address, self.dbtype))
         self.resource_lock = threading.RLock()
+        # LRU cache of open handles: (type, url) => (handle, writable)
+        self.handles = OrderedDict()
+        self.handle_lock = threading.Lock()
+        # queue entries listed but not yet claimed: pilot url => [entry names]
+        self.prefetch_buffers = {}
+        self.dequeue_sleep = DEQUEUE_MIN_SLEEP
+        self.sequence_lock = threading.Lock()
+        self.last_sequence_number = 0
         
     
     def get_address(self):
@@ -109,17 +132,12 @@ class bigjob_coordination(object):
     # Pilot-Job State
     def set_pilot_state(self, pilot_url, new_state, stopped=False):   
         pilot_url = self.get_url(pilot_url)
-        logger.debug("create advert entry: " + pilot_url)
-        pilot_dir = saga.advert.directory(saga.url(pilot_url), saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
         logger.debug("update state of pilot job to: " + str(new_state) + " Stopped: " + str(stopped))
-        pilot_dir.set_attribute("state", str(new_state)) 
-        pilot_dir.set_attribute("stopped", str(stopped))
+        self.__set_attributes(pilot_url, {"state":str(new_state), "stopped":str(stopped)})
         
     def get_pilot_state(self, pilot_url):
         pilot_url = self.get_url(pilot_url)
-        pilot_dir = saga.advert.directory(saga.url(pilot_url), saga.advert.Read)
-        state = pilot_dir.get_attribute("state")
-        stopped = pilot_dir.get_attribute("stopped") 
+        state, stopped = self.__get_attributes(pilot_url, ["state", "stopped"])
         if stopped == "false" or stopped == "False":
             return {"state":state, "stopped":False}
         else:
@@ -129,29 +147,37 @@ class bigjob_coordination(object):
     def get_jobs_of_pilot(self, pilot_url):
         pilot_url = self.get_url(pilot_url)
         """ returns array of job_url that are associated with a pilot """
-        pilot_dir = saga.advert.directory(saga.url(pilot_url), saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
-        jobs = pilot_dir.list()        
+        jobs = self.__get_directory(pilot_url).list()        
         return jobs
     
     def delete_pilot(self, pilot_url):
         pilot_url = self.get_url(pilot_url)
-        pilot_dir = saga.advert.directory(saga.url(pilot_url), saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
+        pilot_dir = self.__get_directory(pilot_url)
+        self.__invalidate(pilot_url)
         pilot_dir.remove(pilot_url, saga.name_space.Recursive)    
     
     #####################################################################################
     # Sub-Job State    
     def set_job_state(self, job_url, new_state):   
-        self.resource_lock.acquire()     
         job_url = self.get_url(job_url)
         logger.debug("Set state of job: " + str(job_url) + " to: " + str(new_state))
-        job_dir = saga.advert.directory(saga.url(job_url), saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
-        job_dir.set_attribute("state", str(new_state))
-        self.resource_lock.release()
+        self.__set_attributes(job_url, {"state":str(new_state)})
+        
+    def set_job_states(self, job_states, acks=None):
+        """ bulk update of job states (dict job_url => state) 
+            successive updates of a job are coalesced by the caller (see 
+            job_state_buffer), i.e. every job is written once 
+            acks: acknowledged jobs (no in-flight tracking in this backend) """
+        for job_url, new_state in job_states.items():
+            self.set_job_state(job_url, new_state)
         
+    def get_job_state_changes(self, pilot_url, timeout=0):
+        """ state change stream not supported by this backend (state must be polled) """
+        return None
+    
     def get_job_state(self, job_url):        
         job_url = self.get_url(job_url)        
-        job_dir = saga.advert.directory(saga.url(job_url), saga.advert.Read)
-        state = job_dir.get_attribute("state")  
+        state = self.__get_attributes(job_url, ["state"])[0]
         #logger.debug("Get state of job: " + str(job_url) + " state: " + str(state))
         return state      
     
@@ -162,78 +188,222 @@ class bigjob_coordination(object):
         job_dir_url = self.get_url(job_url)
         job_description_url = self.get_url(job_url+"/job-description")
         logger.debug("Job URL: %s, Job Description URL: %s"%(job_dir_url, job_description_url))
-        #job_dir = saga.advert.directory(saga.url(job_dir_url), 
-        #                                saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
         # directory is recursively created
-        job_desc_entry = saga.advert.entry(saga.url(job_description_url),
-                                           saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
+        job_desc_entry = self.__get_entry(job_description_url)
         logger.debug("initialized advert entry for job: " + job_dir_url)
         job_desc_entry.store_string(json.dumps(job_dict))
-        self.set_job_state(job_url, str(saga.job.Unknown))
+        self.__set_attributes(job_dir_url, {"state":str(saga.job.Unknown)})
+        
+        
+    
+    def set_jobs(self, jobs):
+        """ bulk version of set_job: jobs is a list of (job_url, job_dict) tuples """
+        for job_url, job_dict in jobs:
+            self.set_job(job_url, job_dict)
         
+    def submit_job(self, pilot_url, job_url, job_dict):
+        """ store job description and queue job """
+        self.set_job(job_url, job_dict)
+        self.queue_job(pilot_url, job_url)
         
+    def submit_jobs(self, pilot_url, jobs):
+        """ store job descriptions and queue jobs (list of (job_url, job_dict) tuples) """
+        self.set_jobs(jobs)
+        self.queue_jobs(pilot_url, [job[0] for job in jobs])
     
     def get_job(self, job_url):
         #job_dir = saga.advert.directory(saga.url(job_url), 
         #                                saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
         job_url = self.get_url(job_url+"/job-description")
         logger.debug("Get job description from: %s"%(job_url))
-        job_desc_entry = saga.advert.entry(saga.url(job_url),
-                                           saga.advert.Read)
-        job_dict = json.loads(job_desc_entry.retrieve_string())
+        job_desc_entry = self.__get_entry(job_url, False)
+        with self.resource_lock:
+            job_dict = json.loads(job_desc_entry.retrieve_string())
         return job_dict    
     
     def delete_job(self, job_url):
         job_url = self.get_url(job_url)
-        job_dir = saga.advert.directory(saga.url(job_url), 
-                                        saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
+        job_dir = self.__get_directory(job_url)
+        self.__invalidate(job_url)
         job_dir.remove(job_url, saga.name_space.Recursive)  
     
     
     #####################################################################################
     # Distributed queue for sub-jobs
     def queue_job(self, pilot_url, job_url):
+        """ queue new job to pilot 
+            entry names start with a sequence number => sorted names are in FIFO order """
         self.resource_lock.acquire()
         #pilot_url = self.get_url(pilot_url)
         job_url = self.get_url(job_url)
-        """ queue new job to pilot """
-        new_job_url = self.get_url(pilot_url + "/new/" + str(uuid.uuid1()))
+        new_job_url = self.get_url(pilot_url + "/new/" + self.__get_entry_name())
         logger.debug("Job URL: %s Create new job entry at: %s"%(job_url,new_job_url))
+        # queue entries are opened once => not cached
         new_job_dir = saga.advert.directory(saga.url(new_job_url), 
                                             saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
         new_job_dir.set_attribute("joburl", job_url)
         self.resource_lock.release()
         
+    def queue_jobs(self, pilot_url, job_urls):
+        """ queue list of new jobs to pilot """
+        for job_url in job_urls:
+            self.queue_job(pilot_url, job_url)
+        
+    def dequeue_job_description(self, pilot_url):
+        """ dequeue new job; returns (job_url, None) 
+            (description is not read together with the queue entry by this backend) """
+        return self.dequeue_job(pilot_url), None
+        
+    def requeue_job(self, pilot_url, job_url):
+        """ return dequeued job to queue (not enough resources) """
+        self.queue_job(pilot_url, job_url)
+        
+    def ack_job(self, pilot_url, job_url):
+        """ acknowledge start of dequeued job (no in-flight tracking in this backend) """
+        pass
+    
+    def requeue_expired_jobs(self, pilot_url, timeout=None):
+        """ no in-flight tracking in this backend => nothing to requeue """
+        return 0
+    
+    def set_job_credits(self, pilot_url, credits):
+        """ jobs are pulled by dequeue_job => no flow control required """
+        pass
+    
+    def join_pilot_group(self, pilot_url, group=None):
+        """ work stealing not supported by this backend """
+        pass
+    
+    def leave_pilot_group(self, pilot_url):
+        pass
+        
     def dequeue_job(self, pilot_url):
-        """ deque to new job  of a certain pilot """
+        """ deque to new job  of a certain pilot 
+        
+            The queue directory <pilot>/new/ is listed only if the local 
+            prefetch buffer is empty. An entry is claimed by moving it to 
+            <pilot>/claimed/: if another agent claimed the entry first, the 
+            move fails and the next entry of the buffer is tried.
+        """
         self.resource_lock.acquire()
-        #pilot_url = self.get_url(pilot_url)
-        jobs = []        
+        try:
+            buffer = self.prefetch_buffers.setdefault(pilot_url, [])
+            while True:
+                if len(buffer)==0:
+                    buffer.extend(self.__list_queue(pilot_url))
+                    if len(buffer)==0:
+                        break
+                    self.dequeue_sleep = DEQUEUE_MIN_SLEEP
+                job_url = self.__claim_job(pilot_url, buffer.pop(0))
+                if job_url != None:
+                    logger.debug("Dequeued new job: " + str(job_url))
+                    return self.__remove_dbtype(job_url)
+        finally:
+            self.resource_lock.release()
+        time.sleep(self.dequeue_sleep)
+        self.dequeue_sleep = min(self.dequeue_sleep*2, DEQUEUE_MAX_SLEEP)
+        return 
+    
+    def __get_entry_name(self):
+        """ name of new queue entry: sequence number (usec since epoch, 
+            strictly increasing within this process) + unique suffix 
+            (entries of different managers) """
+        with self.sequence_lock:
+            sequence_number = max(int(time.time()*1000000), self.last_sequence_number+1)
+            self.last_sequence_number = sequence_number
+        return "%016x-%s"%(sequence_number, uuid.uuid4().hex[:8])
+    
+    def __list_queue(self, pilot_url):
+        """ returns sorted names of the first PREFETCH_SIZE entries of the queue of pilot """
         new_job_dir_url = self.get_url(pilot_url + "/new/") 
-        new_job_dir = saga.advert.directory(saga.url(new_job_dir_url), 
-                                            saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
-        new_jobs = new_job_dir.list()
-        logger.debug("Pilot Job base dir: " + new_job_dir_url + " #new jobs: " + str(len(new_jobs))
-                      + " jobs: " + str(new_jobs));
-        if len(new_jobs)>=1:
-            job_entry=new_jobs[0]     
-            job_dir_url = self.get_url(pilot_url + "/new/" + "/" + job_entry.get_string())       
-            logger.debug("Open job at " + str(job_dir_url))
-            job_dir = saga.advert.directory(saga.url(job_dir_url), 
-                                       saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite)
+        new_job_dir = self.__get_directory(new_job_dir_url)
+        new_jobs = sorted([i.get_string() for i in new_job_dir.list()])
+        logger.debug("Pilot Job base dir: " + new_job_dir_url + " #new jobs: " + str(len(new_jobs)))
+        return new_jobs[:PREFETCH_SIZE]
+    
+    def __claim_job(self, pilot_url, entry_name):
+        """ claim queue entry; returns job url or None (entry claimed by another agent) """
+        new_job_dir = self.__get_directory(self.get_url(pilot_url + "/new/"))
+        # parent directory of claimed entries must exist
+        self.__get_directory(self.get_url(pilot_url + "/claimed/"))
+        job_dir_url = self.get_url(pilot_url + "/new/" + entry_name)
+        claimed_dir_url = self.get_url(pilot_url + "/claimed/" + entry_name)
+        try:
+            # move of an advert is a single update of the advert database => 
+            # only one agent succeeds
+            new_job_dir.move(saga.url(self.__remove_dbtype(job_dir_url)), 
+                             saga.url(self.__remove_dbtype(claimed_dir_url)), 
+                             saga.name_space.Recursive)
+        except:
+            logger.debug("Queue entry %s claimed by other agent"%entry_name)
+            return None
+        logger.debug("Open job at " + str(claimed_dir_url))
+        job_dir = saga.advert.directory(saga.url(claimed_dir_url), saga.advert.ReadWrite)
+        job_url = job_dir.get_attribute("joburl")
+        #remove claimed job entry
+        job_dir.remove(self.__remove_dbtype(claimed_dir_url), saga.name_space.Recursive)
+        return job_url
             
-            #new_job_dir.open_dir(job_entry)                        
-            job_url = job_dir.get_attribute("joburl")
-            #remove old job entry
-            job_dir.remove(self.__remove_dbtype(job_dir_url), saga.name_space.Recursive)
+    def __set_attributes(self, url, attributes):
+        """ write attributes (dict) of advert directory url with one handle """
+        try:
+            directory = self.__get_directory(url)
+            with self.resource_lock:
+                for key, value in attributes.items():
+                    directory.set_attribute(key, value)
+        except:
+            # cached handle may be stale (e.g. directory deleted by other process)
+            self.__invalidate(url)
+            directory = self.__get_directory(url)
+            with self.resource_lock:
+                for key, value in attributes.items():
+                    directory.set_attribute(key, value)
                 
-            logger.debug("Dequeued new job: " + str(job_url))
-            self.resource_lock.release()
-            return self.__remove_dbtype(job_url)
+    def __get_attributes(self, url, keys):
+        try:
+            directory = self.__get_directory(url, False)
+            with self.resource_lock:
+                return [directory.get_attribute(key) for key in keys]
+        except:
+            self.__invalidate(url)
+            directory = self.__get_directory(url, False)
+            with self.resource_lock:
+                return [directory.get_attribute(key) for key in keys]
+    
+    def __get_directory(self, url, writable=True):
+        """ returns (cached) handle of advert directory url 
+            writable: directory is created if it does not exist """
+        return self.__get_handle(saga.advert.directory, url, writable)
+    
+    def __get_entry(self, url, writable=True):
+        return self.__get_handle(saga.advert.entry, url, writable)
+    
+    def __get_handle(self, handle_type, url, writable):
+        key = (handle_type, url)
+        with self.handle_lock:
+            cached = self.handles.pop(key, None)
+            if cached != None and (cached[1] or not writable):
+                self.handles[key] = cached # most recently used
+                return cached[0]
+        if writable:
+            flags = saga.advert.Create | saga.advert.CreateParents | saga.advert.ReadWrite
         else:
-            self.resource_lock.release()
-            time.sleep(1)
-            return 
+            flags = saga.advert.Read
+        handle = handle_type(saga.url(url), flags)
+        with self.handle_lock:
+            self.handles[key] = (handle, writable)
+            while len(self.handles) > HANDLE_CACHE_SIZE:
+                del self.handles[iter(self.handles).next()]
+        return handle
+    
+    def __invalidate(self, url):
+        """ remove handles of url and its children from cache (url is deleted) """
+        prefix = url.split("?")[0]
+        with self.handle_lock:
+            for key in self.handles.keys():
+                handle_url = key[1].split("?")[0]
+                if handle_url == prefix or handle_url.startswith(prefix.rstrip("/") + "/"):
+                    del self.handles[key]
             
     def __remove_dbtype(self, url):
         surl = saga.url(url)
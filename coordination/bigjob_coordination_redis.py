@@ -3,15 +3,18 @@ Encapsulates coordination and communication specifics of bigjob
 '''
 import logging
 import threading
-import datetime
 import sys
 import os
-import pickle
+import time
+import socket
 import pdb
+import hashlib
+import atexit
 
 from bigjob import logger
 sys.path.insert(0, (os.path.dirname(os.path.abspath( __file__) ) + "/../ext/redis-2.4.9/"))
 from redis import *
+from redis.exceptions import WatchError, ConnectionError, ResponseError
 
 if sys.version_info < (2, 5):
     sys.path.append(os.path.dirname( os.path.abspath( __file__) ) + "/../ext/uuid-1.30/")
@@ -25,6 +28,153 @@ import uuid
 REDIS_SERVER="localhost"
 REDIS_SERVER_PORT=6379
 REDIS_URL_SCHEME="redis://"
+# reliable queue: dequeued sub-jobs are moved atomically to a processing list 
+# of the agent and are requeued if not acknowledged (see ack_job) within 
+# VISIBILITY_TIMEOUT seconds
+RELIABLE_QUEUE=True
+VISIBILITY_TIMEOUT=300
+# optional queue metrics: number of queued/requeued/dequeued sub-jobs and time 
+# of last queue/dequeue operation are aggregated in memory and written every 
+# METRICS_FLUSH_INTERVAL seconds (by a background thread and by close) to the 
+# hash <pilot_url>:queue:metrics
+QUEUE_METRICS=False
+METRICS_FLUSH_INTERVAL=10
+# sub-job state changes of a pilot are appended to the list <pilot_url>:state_changes
+# The list is trimmed to the newest MAX_STATE_CHANGES entries (no unbounded 
+# growth if the changes are not consumed); get_job_state_changes returns the 
+# current states of all sub-jobs if changes may have been trimmed
+STATE_CHANGES_SUFFIX=":state_changes"
+MAX_STATE_CHANGES=10000
+# job urls of a pilot are indexed in the set <pilot_url>:jobs
+JOB_INDEX_SUFFIX=":jobs"
+# number of keys/list entries deleted per round-trip (see delete_pilot)
+DELETE_CHUNK_SIZE=1000
+# connection pool: max. number of connections (the agent passes the number of 
+# its threads, see bigjob_agent). A thread uses up to 2 connections at a time 
+# (requeue_expired_jobs). If all connections are in use, commands wait up to 
+# POOL_TIMEOUT seconds for a free connection
+MAX_CONNECTIONS=16
+POOL_TIMEOUT=30
+# socket timeout (in sec) => detection of broken/hanging connections; blocking 
+# commands use shorter timeouts (DEQUEUE_TIMEOUT)
+SOCKET_TIMEOUT=30
+DEQUEUE_TIMEOUT=10
+# retries of commands failing with a connection error (exponential backoff, 
+# see reconnect)
+RECONNECT_RETRIES=5
+RECONNECT_BACKOFF=0.1
+RECONNECT_MAX_BACKOFF=5
+# work stealing: pilots of a group (set PILOT_GROUP, see join_pilot_group) steal 
+# jobs from the queues of other pilots of the group if their own queue is empty. 
+# Stolen jobs keep their job url (i.e. state changes are reported to the pilot 
+# the job was submitted to). An idle agent tries to steal every STEAL_INTERVAL 
+# sec; only queues with at least STEAL_THRESHOLD jobs are stolen from
+PILOT_GROUP="bigjob:pilots"
+STEAL_INTERVAL=1
+STEAL_THRESHOLD=1
+
+# Lua script (Redis >= 2.6): claim next job of queue KEYS[1] (ARGV[2]: job already 
+# claimed), move it to processing list KEYS[2] (ARGV[1]=="1": reliable queue), 
+# mark it New (state change is appended to KEYS[3], trimmed to ARGV[3] entries) 
+# and return job url and description => dequeue of a job in one round-trip
+CLAIM_JOB_SCRIPT="""
+local job_url = ARGV[2]
+if job_url == "" then
+    if ARGV[1] == "1" then
+        job_url = redis.call("RPOPLPUSH", KEYS[1], KEYS[2])
+    else
+        job_url = redis.call("RPOP", KEYS[1])
+    end
+    if not job_url then
+        return nil
+    end
+end
+if redis.call("HGET", job_url, "state") == "Unknown" then
+    redis.call("HSET", job_url, "state", "New")
+    redis.call("RPUSH", KEYS[3], "New " .. job_url)
+    redis.call("LTRIM", KEYS[3], -tonumber(ARGV[3]), -1)
+end
+return {job_url, redis.call("HGETALL", job_url)}
+"""
+
+# Lua script: steal job from the tail (newest entry) of the longest queue of the 
+# pilots in group KEYS[1] (except pilot ARGV[1]; min. length ARGV[3]), move it to 
+# processing list KEYS[2] (ARGV[2]=="1": reliable queue), mark it New (state 
+# changes trimmed to ARGV[4] entries) and return job url and description => the victim queue is selected and popped atomically
+STEAL_JOB_SCRIPT="""
+local victim = nil
+local victim_length = tonumber(ARGV[3]) - 1
+for i, pilot_url in ipairs(redis.call("SMEMBERS", KEYS[1])) do
+    if pilot_url ~= ARGV[1] then
+        local length = redis.call("LLEN", pilot_url .. ":queue")
+        if length > victim_length then
+            victim = pilot_url
+            victim_length = length
+        end
+    end
+end
+if not victim then
+    return nil
+end
+local job_url = redis.call("LPOP", victim .. ":queue")
+if ARGV[2] == "1" then
+    redis.call("LPUSH", KEYS[2], job_url)
+end
+if redis.call("HGET", job_url, "state") == "Unknown" then
+    redis.call("HSET", job_url, "state", "New")
+    redis.call("RPUSH", victim .. ":state_changes", "New " .. job_url)
+    redis.call("LTRIM", victim .. ":state_changes", -tonumber(ARGV[4]), -1)
+end
+return {job_url, redis.call("HGETALL", job_url), victim}
+"""
+
+# Lua script: acknowledge jobs ARGV (see ack_job): remove them from processing 
+# list KEYS[1] (searched from the tail: jobs are mostly acknowledged in dequeue 
+# order) and from hash KEYS[2] (dequeue times) and re-register KEYS[1] in set 
+# KEYS[3] => one command per batch of acks (see set_job_states)
+ACK_JOBS_SCRIPT="""
+for i, job_url in ipairs(ARGV) do
+    redis.call("LREM", KEYS[1], -1, job_url)
+    redis.call("HDEL", KEYS[2], job_url)
+end
+redis.call("SADD", KEYS[3], KEYS[1])
+"""
+
+
+def reconnect(method, retry_method=None):
+    """ retries method on connection errors with exponential backoff. The 
+        failed connection is discarded and replaced by a new connection of the 
+        pool on the next attempt. 
+        A connection can fail after the server executed the commands (lost 
+        reply), i.e. only idempotent methods are retried as is. Retries of 
+        other methods call retry_method (see reconnect_write).
+        Only public methods are decorated (decorated methods do not call each 
+        other => no nested retries). """
+    def wrapper(self, *args, **kwargs):
+        backoff = RECONNECT_BACKOFF
+        attempt_method = method
+        for attempt in range(1, RECONNECT_RETRIES+1):
+            try:
+                return attempt_method(self, *args, **kwargs)
+            except ConnectionError, e:
+                logger.warn("Redis connection error in %s (attempt %d/%d): %s"
+                            %(method.__name__, attempt, RECONNECT_RETRIES, str(e)))
+                if attempt == RECONNECT_RETRIES:
+                    raise
+                time.sleep(backoff)
+                backoff = min(backoff*2, RECONNECT_MAX_BACKOFF)
+                if retry_method != None:
+                    attempt_method = retry_method
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def reconnect_write(retry_method):
+    """ reconnect for non-idempotent writes (e.g. queue_job): retries call 
+        retry_method (same arguments), which must not repeat the writes of the 
+        failed attempt that were executed by the server """
+    return lambda method: reconnect(method, retry_method)
 
 class bigjob_coordination(object):
     '''
@@ -33,7 +183,7 @@ class bigjob_coordination(object):
     '''
 
     def __init__(self, server=REDIS_SERVER, server_port=REDIS_SERVER_PORT, server_connect_url=None,
-                 username=None, password=None, dbtype=None, url_prefix=None):
+                 username=None, password=None, dbtype=None, url_prefix=None, max_connections=MAX_CONNECTIONS):
         '''
         Constructor
         '''
@@ -69,28 +219,50 @@ class bigjob_coordination(object):
         
         logger.debug("Connect to Redis: " + server + " Port: " + str(server_port))
         
-        if self.password==None:
-            self.redis = Redis(host=server, port=server_port, db=0)
-        else:
-            self.redis = Redis(host=server, port=server_port, password=self.password, db=0)
+        # thread-safe pool: every command/pipeline uses a connection of the pool 
+        # for the duration of the call. The pool blocks if all connections are 
+        # in use (no connection errors if there are more threads than connections). 
+        # Requires redis-py >= 2.10 (see setup.py)
+        self.connection_pool = BlockingConnectionPool(host=server, port=server_port, db=0, password=self.password,
+                                                      socket_timeout=SOCKET_TIMEOUT, 
+                                                      max_connections=max_connections, timeout=POOL_TIMEOUT)
+        self.redis = Redis(connection_pool=self.connection_pool)
         #self.redis_pubsub = self.redis.pubsub() # redis pubsub client       
         self.resource_lock = threading.RLock()
-        self.pipe = self.redis.pipeline()
-        try:
-            self.redis.ping()
-        except:
+        self.reliable_queue = RELIABLE_QUEUE
+        # id of this client as consumer of sub-job queues
+        self.consumer_id = "%s-%d-%s"%(socket.gethostname(), os.getpid(), str(uuid.uuid1())[:8])
+        self.consumed_queues = set() # queues this client is registered as consumer for
+        self.queue_metrics = QUEUE_METRICS
+        self.metrics = {} # queue_name => {counter/timestamp => value}
+        self.metrics_lock = threading.Lock()
+        self.metrics_thread = None # started with first metric (see __flush_metrics_loop)
+        self.metrics_stop = threading.Event()
+        self.pilot_groups = {} # pilot_url => group (work stealing)
+        # server side scripts are disabled if not supported by server (Redis < 2.6)
+        self.scripting_supported = True
+        if not self.health_check():
             logger.error("Please start Redis server!")
             raise Exception("Please start Redis server!")
         
     def get_address(self):
         return self.address
     
+    def health_check(self):
+        """ returns True if Redis server is reachable """
+        try:
+            return self.redis.ping()
+        except:
+            return False
+    
     #####################################################################################
     # Pilot-Job State
+    @reconnect
     def set_pilot_state(self, pilot_url, new_state, stopped=False):     
         logger.debug("update state of pilot job to: " + str(new_state))
         self.redis.hmset(pilot_url, {"state":str(new_state), "stopped":str(stopped)})
         
+    @reconnect
     def get_pilot_state(self, pilot_url):
         state = self.redis.hgetall(pilot_url)
         return state
@@ -101,58 +273,555 @@ class bigjob_coordination(object):
     #        return True        
     #    return state["stopped"]
     
+    @reconnect
     def get_jobs_of_pilot(self, pilot_url):
         """ returns array of job_url that are associated with a pilot """
-        return self.redis.keys(pilot_url+":jobs:*") 
+        return list(self.redis.smembers(pilot_url + JOB_INDEX_SUFFIX))
     
+    @reconnect
     def delete_pilot(self, pilot_url):
-        items = self.redis.keys(pilot_url+"*")  
-        for i in items:        
-            self.pipe.delete(i)
-        self.pipe.execute()
+        """ delete pilot and its sub-jobs in chunks of DELETE_CHUNK_SIZE 
+            (every command is O(chunk) => no long blocking of the Redis server) 
+        """
+        index_name = pilot_url + JOB_INDEX_SUFFIX
+        while True:
+            pipe = self.redis.pipeline()
+            for i in range(0, DELETE_CHUNK_SIZE):
+                pipe.spop(index_name)
+            job_urls = [i for i in pipe.execute() if i != None]
+            if len(job_urls) == 0:
+                break
+            pipe = self.redis.pipeline()
+            for job_url in job_urls:
+                pipe.delete(job_url)
+            pipe.execute()
+        queue_name = pilot_url + ":queue"
+        for processing_list in self.redis.smembers(queue_name + ":consumers"):
+            self.__delete_list(processing_list)
+        self.__delete_list(queue_name)
+        self.__delete_list(pilot_url + STATE_CHANGES_SUFFIX)
+        self.redis.delete(pilot_url, index_name, queue_name + ":consumers", 
+                          queue_name + ":claimed", queue_name + ":metrics")
+        # buffered metrics would recreate the deleted hash
+        self.metrics_lock.acquire()
+        self.metrics.pop(queue_name, None)
+        self.metrics_lock.release()
+        self.consumed_queues.discard(queue_name)
+        self.__leave_pilot_group(pilot_url)
+        
+    @reconnect
+    def join_pilot_group(self, pilot_url, group=PILOT_GROUP):
+        """ work stealing: dequeue_job_description of pilot steals jobs from 
+            other pilots of group if the queue of pilot is empty (and vice versa) """
+        self.redis.sadd(group, pilot_url)
+        self.pilot_groups[pilot_url] = group
+        
+    @reconnect
+    def leave_pilot_group(self, pilot_url):
+        self.__leave_pilot_group(pilot_url)
+        
+    def __leave_pilot_group(self, pilot_url):
+        group = self.pilot_groups.pop(pilot_url, None)
+        if group != None:
+            self.redis.srem(group, pilot_url)
+    
+    def __delete_list(self, name):
+        """ delete list in chunks of DELETE_CHUNK_SIZE entries """
+        while True:
+            pipe = self.redis.pipeline()
+            pipe.ltrim(name, DELETE_CHUNK_SIZE, -1)
+            pipe.llen(name)
+            if pipe.execute()[1] == 0:
+                break
     
     #####################################################################################
     # Sub-Job State    
+    @reconnect
     def set_job_state(self, job_url, new_state):
         #self.resource_lock.acquire()        
         logger.debug("set job state to: " + str(new_state))
-        self.redis.hset(job_url, "state", str(new_state))
+        pipe = self.redis.pipeline()
+        self.__set_job_state(pipe, job_url, new_state)
+        pipe.execute()
         #self.resource_lock.release()
         
+    @reconnect
+    def set_job_states(self, job_states, acks=None):
+        """ bulk update of job states (dict job_url => state) in one round-trip 
+            acks: list of (pilot_url, job_url) of dequeued jobs acknowledged in 
+            the same round-trip (see ack_job) """
+        pipe = self.redis.pipeline()
+        for job_url, new_state in job_states.items():
+            self.__set_job_state(pipe, job_url, new_state)
+        if acks != None and self.reliable_queue:
+            acked_jobs = {} # pilot_url => job urls
+            for pilot_url, job_url in acks:
+                acked_jobs.setdefault(pilot_url, []).append(job_url)
+            for pilot_url, job_urls in acked_jobs.items():
+                self.__ack_jobs(pipe, pilot_url, job_urls)
+        pipe.execute()
+        
+    @reconnect
     def get_job_state(self, job_url):
         return self.redis.hget(job_url, "state")      
     
+    @reconnect
+    def get_job_state_changes(self, pilot_url, timeout=0):
+        """ returns list of (job_url, state) tuples for all state changes of the 
+            sub-jobs of pilot since the last call (in order of the changes). 
+            Blocks up to timeout (max. DEQUEUE_TIMEOUT) seconds if no state change 
+            is available.
+            State changes are consumed, i.e. there should be only one consumer 
+            per pilot (the manager).
+            If MAX_STATE_CHANGES changes were read, older changes may have been 
+            trimmed => the current states of all sub-jobs of the pilot are 
+            appended (i.e. the consumer recovers without further calls).
+        """
+        name = pilot_url + STATE_CHANGES_SUFFIX
+        pipe = self.redis.pipeline()
+        pipe.lrange(name, 0, -1)
+        pipe.delete(name)
+        changes = pipe.execute()[0]
+        if len(changes)==0 and timeout > 0:
+            change = self.redis.blpop(name, int(min(max(timeout, 1), DEQUEUE_TIMEOUT)))
+            if change != None:
+                changes = [change[1]]
+        changes = [tuple(i.split(" ", 1)[::-1]) for i in changes]
+        if len(changes) >= MAX_STATE_CHANGES:
+            logger.warn("State changes of %s may have been trimmed - reading all sub-job states"%pilot_url)
+            job_urls = list(self.redis.smembers(pilot_url + JOB_INDEX_SUFFIX))
+            pipe = self.redis.pipeline(transaction=False)
+            for job_url in job_urls:
+                pipe.hget(job_url, "state")
+            changes.extend([i for i in zip(job_urls, pipe.execute()) if i[1] != None])
+        return changes
+    
+    def __set_job_state(self, pipe, job_url, new_state):
+        """ update state and append state change to stream of the pilot (trimmed 
+            to MAX_STATE_CHANGES entries) """
+        name = self.__get_pilot_url(job_url) + STATE_CHANGES_SUFFIX
+        pipe.hset(job_url, "state", str(new_state))
+        pipe.rpush(name, str(new_state) + " " + job_url)
+        pipe.ltrim(name, -MAX_STATE_CHANGES, -1)
+    
     
     #####################################################################################
     # Sub-Job Description
+    @reconnect
     def set_job(self, job_url, job_dict):
-        self.redis.hmset(job_url, job_dict)
+        pipe = self.redis.pipeline()
+        pipe.hmset(job_url, job_dict)
+        pipe.sadd(self.__get_pilot_url(job_url) + JOB_INDEX_SUFFIX, job_url)
+        pipe.execute()
     
+    @reconnect
+    def set_jobs(self, jobs):
+        """ bulk version of set_job: jobs is a list of (job_url, job_dict) tuples 
+            all descriptions are written in one round-trip 
+        """
+        pipe = self.redis.pipeline()
+        for job_url, job_dict in jobs:
+            pipe.hmset(job_url, job_dict)
+            pipe.sadd(self.__get_pilot_url(job_url) + JOB_INDEX_SUFFIX, job_url)
+        pipe.execute()
+    
+    def submit_job(self, pilot_url, job_url, job_dict):
+        """ store job description and queue job with one round-trip (transaction) """
+        self.submit_jobs(pilot_url, [(job_url, job_dict)])
+    
+    def __resubmit_jobs(self, pilot_url, jobs):
+        """ retry of submit_jobs: jobs of the failed attempt that are in the job 
+            index of pilot were queued (same transaction) => not submitted again """
+        pipe = self.redis.pipeline(transaction=False)
+        for job_url, job_dict in jobs:
+            pipe.sismember(pilot_url + JOB_INDEX_SUFFIX, job_url)
+        submitted = pipe.execute()
+        self.__submit_jobs(pilot_url, [jobs[i] for i in range(0, len(jobs)) if not submitted[i]])
+    
+    @reconnect_write(__resubmit_jobs)
+    def submit_jobs(self, pilot_url, jobs):
+        """ store job descriptions and queue jobs (list of (job_url, job_dict) 
+            tuples) with one round-trip (transaction) """
+        self.__submit_jobs(pilot_url, jobs)
+        
+    def __submit_jobs(self, pilot_url, jobs):
+        if len(jobs)==0:
+            return
+        queue_name = pilot_url + ":queue"
+        pipe = self.redis.pipeline()
+        for job_url, job_dict in jobs:
+            pipe.hmset(job_url, job_dict)
+            pipe.sadd(pilot_url + JOB_INDEX_SUFFIX, job_url)
+            pipe.lpush(queue_name, job_url)
+        pipe.execute()
+        self.__update_metrics(queue_name, "queued", len(jobs), "last_in")
+    
+    @reconnect
     def get_job(self, job_url):
         return self.redis.hgetall(job_url)    
     
+    @reconnect
     def delete_job(self, job_url):
-        self.redis.delete(job_url+"*")
+        pipe = self.redis.pipeline()
+        pipe.delete(job_url)
+        pipe.srem(self.__get_pilot_url(job_url) + JOB_INDEX_SUFFIX, job_url)
+        pipe.execute()
+    
+    def __get_pilot_url(self, job_url):
+        """ job urls have the form <pilot_url>:jobs:<job id> """
+        return job_url.rsplit(":jobs:", 1)[0]
     
     
     #####################################################################################
     # Distributed queue for sub-jobs
+    def __requeue_jobs(self, pilot_url, job_urls, head=False):
+        """ retry of queue_job(s) (head=False) and requeue_job (head=True): job 
+            urls are removed from the queue before they are pushed (same 
+            transaction), i.e. jobs queued by the failed attempt are not queued 
+            twice. Jobs dequeued between the attempts are queued again (agents 
+            skip jobs that were started already) """
+        queue_name = pilot_url + ":queue"
+        pipe = self.redis.pipeline()
+        for job_url in job_urls:
+            self.__lrem(pipe, queue_name, job_url)
+            if head:
+                if self.reliable_queue:
+                    self.__lrem(pipe, self.__get_processing_list(queue_name), job_url)
+                    pipe.hdel(queue_name + ":claimed", job_url)
+                pipe.rpush(queue_name, job_url)
+            else:
+                pipe.lpush(queue_name, job_url)
+        pipe.execute()
+        
+    def __retry_queue_job(self, pilot_url, job_url):
+        self.__requeue_jobs(pilot_url, [job_url])
+        
+    def __retry_requeue_job(self, pilot_url, job_url):
+        self.__requeue_jobs(pilot_url, [job_url], head=True)
+        
+    @reconnect_write(__retry_queue_job)
     def queue_job(self, pilot_url, job_url):
         """ queue new job to pilot """
         queue_name = pilot_url + ":queue"
-        self.redis.set(queue_name + ':last_in', pickle.dumps(datetime.datetime.now()))
         self.redis.lpush(queue_name, job_url)
+        self.__update_metrics(queue_name, "queued", 1, "last_in")
                 
         
-    def dequeue_job(self, pilot_url):
-        """ deque to new job  of a certain pilot """
+    @reconnect_write(__requeue_jobs)
+    def queue_jobs(self, pilot_url, job_urls):
+        """ queue list of new jobs to pilot in one round-trip """
+        queue_name = pilot_url + ":queue"
+        pipe = self.redis.pipeline()
+        for job_url in job_urls:
+            pipe.lpush(queue_name, job_url)
+        pipe.execute()
+        self.__update_metrics(queue_name, "queued", len(job_urls), "last_in")
+        
+        
+    @reconnect_write(__retry_requeue_job)
+    def requeue_job(self, pilot_url, job_url):
+        """ return dequeued job to the head of the queue (i.e. the job keeps 
+            its position in FIFO order) """
+        queue_name = pilot_url + ":queue"
+        pipe = self.redis.pipeline()
+        if self.reliable_queue:
+            self.__lrem(pipe, self.__get_processing_list(queue_name), job_url)
+            pipe.hdel(queue_name + ":claimed", job_url)
+        pipe.rpush(queue_name, job_url)
+        pipe.execute()
+        self.__update_metrics(queue_name, "requeued", 1, "last_in")
+        
+        
+    @reconnect
+    def dequeue_job(self, pilot_url, timeout=DEQUEUE_TIMEOUT):
+        """ deque to new job  of a certain pilot 
+            reliable queue: the job is moved atomically to the processing list 
+            of this consumer and must be acknowledged with ack_job 
+            blocks up to timeout seconds if the queue is empty
+        """
+        return self.__dequeue_job(pilot_url, timeout)
+        
+    def __dequeue_job(self, pilot_url, timeout):
         queue_name = pilot_url + ":queue"        
-        logger.debug("Dequeue sub-job from: " + queue_name 
-                      + " number queued items: " + str(self.redis.llen(queue_name)))
-        self.redis.set(queue_name + ':last_out', pickle.dumps(datetime.datetime.now()))
-        job_url = self.redis.brpop(queue_name, 120)
+        logger.debug("Dequeue sub-job from: " + queue_name)
+        if self.reliable_queue:
+            processing_list = self.__register_consumer(queue_name)
+            job_url = self.redis.brpoplpush(queue_name, processing_list, timeout)
+        else:
+            job_url = self.redis.brpop(queue_name, timeout)
+            if job_url!=None:
+                job_url = job_url[1]
         if job_url==None:
             return job_url
         logger.debug("Dequeued: " + str(job_url))
-        return job_url[1]
+        self.__update_metrics(queue_name, "dequeued", 1, "last_out")
+        return job_url
+    
+    
+    @reconnect
+    def dequeue_job_description(self, pilot_url):
+        """ dequeue new job of pilot, mark it New and return (job_url, job description)
+            Claim, state update and read of the description are done with one 
+            round-trip by a server side script. If the queue is empty, a job is 
+            stolen from another pilot of the group of pilot (see join_pilot_group).
+            Blocks up to DEQUEUE_TIMEOUT (STEAL_INTERVAL) seconds if the queue is 
+            empty; returns (None, None) if no job was dequeued
+        """
+        queue_name = pilot_url + ":queue"
+        timeout = DEQUEUE_TIMEOUT
+        if self.scripting_supported:
+            result = self.__claim_job(pilot_url, "")
+            if result != None:
+                self.__update_metrics(queue_name, "dequeued", 1, "last_out")
+                return result
+            if self.pilot_groups.has_key(pilot_url):
+                result = self.__steal_job(pilot_url)
+                if result != None:
+                    return result
+                timeout = STEAL_INTERVAL
+        # queue empty => blocking wait for next job
+        job_url = self.__dequeue_job(pilot_url, timeout)
+        if job_url == None:
+            return None, None
+        if self.scripting_supported:
+            result = self.__claim_job(pilot_url, job_url)
+            if result != None:
+                return result
+        return job_url, self.redis.hgetall(job_url)
+    
+    
+    @reconnect
+    def ack_job(self, pilot_url, job_url):
+        """ acknowledge start of dequeued job (removes job from processing list) """
+        if not self.reliable_queue:
+            return
+        pipe = self.redis.pipeline()
+        self.__ack_jobs(pipe, pilot_url, [job_url])
+        pipe.execute()
+        
+        
+    def __ack_jobs(self, pipe, pilot_url, job_urls):
+        queue_name = pilot_url + ":queue"
+        processing_list = self.__get_processing_list(queue_name)
+        # consumer registrations with empty processing lists are removed by 
+        # requeue_expired_jobs => re-register
+        keys = [processing_list, queue_name + ":claimed", queue_name + ":consumers"]
+        if self.scripting_supported:
+            pipe.execute_command("EVAL", ACK_JOBS_SCRIPT, len(keys), *(keys + job_urls))
+            return
+        for job_url in job_urls:
+            pipe.execute_command("LREM", processing_list, -1, job_url)
+        pipe.hdel(keys[1], *job_urls)
+        pipe.sadd(keys[2], processing_list)
+        
+        
+    def set_job_credits(self, pilot_url, credits):
+        """ jobs are pulled by dequeue_job => no flow control required """
+        pass
+        
+        
+    @reconnect
+    def requeue_expired_jobs(self, pilot_url, timeout=VISIBILITY_TIMEOUT):
+        """ requeue jobs that were dequeued but not acknowledged within timeout 
+            seconds (e.g. agent crashed). 
+            The dequeue time of a job is recorded by the first call that finds 
+            the job in a processing list, i.e. jobs are requeued after timeout 
+            to timeout + calling interval seconds.
+            returns number of requeued jobs
+        """
+        if not self.reliable_queue:
+            return 0
+        queue_name = pilot_url + ":queue"
+        claimed_name = queue_name + ":claimed"
+        now = time.time()
+        number_requeued = 0
+        claimed = self.redis.hgetall(claimed_name)
+        for processing_list in self.redis.smembers(queue_name + ":consumers"):
+            pipe = self.redis.pipeline()
+            try:
+                # requeue is aborted if processing list is modified concurrently (e.g. ack)
+                pipe.watch(processing_list)
+                job_urls = pipe.lrange(processing_list, 0, -1)
+                if len(job_urls)==0:
+                    pipe.unwatch()
+                    if processing_list != self.__get_processing_list(queue_name):
+                        self.redis.srem(queue_name + ":consumers", processing_list)
+                    continue
+                expired = []
+                unclaimed = {}
+                for job_url in job_urls:
+                    if not claimed.has_key(job_url):
+                        unclaimed[job_url] = str(now)
+                    elif now - float(claimed[job_url]) > timeout:
+                        expired.append(job_url)
+                if len(unclaimed)>0:
+                    self.redis.hmset(claimed_name, unclaimed)
+                if len(expired)==0:
+                    pipe.unwatch()
+                    continue
+                state_pipe = self.redis.pipeline(transaction=False)
+                for job_url in expired:
+                    state_pipe.hget(job_url, "state")
+                states = state_pipe.execute()
+                requeued = 0
+                pipe.multi()
+                for job_url, state in zip(expired, states):
+                    self.__lrem(pipe, processing_list, job_url)
+                    pipe.hdel(claimed_name, job_url)
+                    # jobs that were started already are not requeued (ack lost)
+                    if state==None or state=="Unknown" or state=="New":
+                        logger.debug("Requeue expired job: " + job_url)
+                        pipe.rpush(queue_name, job_url)
+                        requeued = requeued + 1
+                pipe.execute()
+                number_requeued = number_requeued + requeued
+            except WatchError:
+                logger.debug("Processing list %s modified - retry requeue later"%processing_list)
+            finally:
+                pipe.reset()
+        return number_requeued
+    
+    
+    @reconnect
+    def get_queue_metrics(self, pilot_url):
+        """ returns queue metrics of pilot (see QUEUE_METRICS) """
+        return self.redis.hgetall(pilot_url + ":queue:metrics")
+    
+    
+    @reconnect
+    def flush_metrics(self):
+        """ write aggregated queue metrics with one round-trip """
+        self.__flush_metrics()
+        
+    def close(self):
+        """ stop the metrics thread and write buffered queue metrics (also 
+            called at exit of the process) """
+        if self.metrics_thread == None:
+            return
+        self.metrics_stop.set()
+        self.metrics_thread.join()
+        self.__flush_metrics()
+    
+    
+    def __flush_metrics(self):
+        self.metrics_lock.acquire()
+        metrics = self.metrics
+        self.metrics = {}
+        self.metrics_lock.release()
+        if len(metrics)==0:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for queue_name, queue_metrics in metrics.items():
+            for key, value in queue_metrics.items():
+                if key.startswith("last_"):
+                    pipe.hset(queue_name + ":metrics", key, str(value))
+                else:
+                    pipe.hincrby(queue_name + ":metrics", key, value)
+        pipe.execute()
+    
+    
+    def __update_metrics(self, queue_name, counter, number, timestamp):
+        if not self.queue_metrics:
+            return
+        now = time.time()
+        self.metrics_lock.acquire()
+        queue_metrics = self.metrics.setdefault(queue_name, {})
+        queue_metrics[counter] = queue_metrics.get(counter, 0) + number
+        queue_metrics[timestamp] = now
+        start_thread = self.metrics_thread == None
+        if start_thread:
+            self.metrics_thread = threading.Thread(target=self.__flush_metrics_loop)
+            self.metrics_thread.daemon = True
+        self.metrics_lock.release()
+        if start_thread:
+            self.metrics_thread.start()
+            atexit.register(self.close)
+    
+    
+    def __flush_metrics_loop(self):
+        """ writes the metrics every METRICS_FLUSH_INTERVAL seconds (metrics are 
+            written independently of queue operations, i.e. also the last 
+            interval before the queue becomes idle) """
+        while not self.metrics_stop.isSet():
+            self.metrics_stop.wait(METRICS_FLUSH_INTERVAL)
+            if self.metrics_stop.isSet():
+                break
+            try:
+                self.__flush_metrics()
+            except:
+                logger.warn("Failed to write queue metrics: " + str(sys.exc_info()[1]))
+    
+    
+    def __claim_job(self, pilot_url, job_url):
+        """ returns (job_url, job description) or None if queue is empty or 
+            scripts are not supported """
+        queue_name = pilot_url + ":queue"
+        processing_list = queue_name
+        if self.reliable_queue:
+            processing_list = self.__register_consumer(queue_name)
+        try:
+            result = self.__eval_script(CLAIM_JOB_SCRIPT, 
+                                        [queue_name, processing_list, pilot_url + STATE_CHANGES_SUFFIX],
+                                        [self.reliable_queue and "1" or "0", job_url, str(MAX_STATE_CHANGES)])
+        except ResponseError, e:
+            if str(e).lower().find("unknown command") < 0:
+                raise
+            logger.warn("Redis server does not support scripts (Redis >= 2.6 required)")
+            self.scripting_supported = False
+            return None
+        if result == None:
+            return None
+        fields = result[1]
+        return result[0], dict(zip(fields[::2], fields[1::2]))
+    
+    
+    def __steal_job(self, pilot_url):
+        """ returns (job_url, job description) stolen from the queue of another 
+            pilot of the group of pilot or None """
+        queue_name = pilot_url + ":queue"
+        processing_list = queue_name
+        if self.reliable_queue:
+            processing_list = self.__register_consumer(queue_name)
+        result = self.__eval_script(STEAL_JOB_SCRIPT, [self.pilot_groups[pilot_url], processing_list],
+                                    [pilot_url, self.reliable_queue and "1" or "0", str(STEAL_THRESHOLD), 
+                                     str(MAX_STATE_CHANGES)])
+        if result == None:
+            return None
+        logger.debug("Stole job %s from %s"%(result[0], result[2]))
+        self.__update_metrics(queue_name, "stolen", 1, "last_out")
+        self.__update_metrics(result[2] + ":queue", "lost", 1, "last_out")
+        fields = result[1]
+        return result[0], dict(zip(fields[::2], fields[1::2]))
+    
+    
+    def __eval_script(self, script, keys, args):
+        """ execute script by its SHA1 digest (script is only transferred if 
+            not cached by the server) """
+        sha = hashlib.sha1(script).hexdigest()
+        try:
+            return self.redis.execute_command("EVALSHA", sha, len(keys), *(keys + args))
+        except ResponseError, e:
+            # newer redis-py versions raise NoScriptError (without error prefix)
+            if not str(e).startswith("NOSCRIPT") and e.__class__.__name__ != "NoScriptError":
+                raise
+        return self.redis.execute_command("EVAL", script, len(keys), *(keys + args))
+    
+    
+    def __register_consumer(self, queue_name):
+        """ register processing list of this client as consumer of queue 
+            returns name of processing list """
+        processing_list = self.__get_processing_list(queue_name)
+        if not queue_name in self.consumed_queues:
+            self.redis.sadd(queue_name + ":consumers", processing_list)
+            self.consumed_queues.add(queue_name)
+        return processing_list
+    
+    
+    def __get_processing_list(self, queue_name):
+        return queue_name + ":processing:" + self.consumer_id
+    
+    
+    def __lrem(self, pipe, name, value):
+        # argument order of lrem differs between redis-py versions
+        pipe.execute_command("LREM", name, 0, value)
     
@@ -0,0 +1,509 @@
+'''
+Encapsulates coordination and communication specifics of bigjob
+'''
+import logging
+import threading
+import sys
+import os
+import time
+import socket
+import json
+import urlparse
+import sqlite3
+
+from bigjob import logger
+
+if sys.version_info < (2, 5):
+    sys.path.append(os.path.dirname( os.path.abspath( __file__) ) + "/../ext/uuid-1.30/")
+    sys.stderr.write("Warning: Using unsupported Python version\n")
+
+logging.debug(str(sys.path))
+import uuid
+
+
+SQLITE_URL_SCHEME="sqlite://"
+# database file (relative to the working directory of the manager) if the
+# coordination url contains no path, e.g. sqlite://
+SQLITE_DATABASE="bigjob.db"
+# journal mode of the database (overridden by the url query, e.g.
+# sqlite:///shared/bigjob.db?journal_mode=delete): WAL (concurrent readers and
+# one writer without blocking) requires shared memory between all processes
+# accessing the database, i.e. is only supported if manager and agents run on
+# one host. Shared file systems (NFS, Lustre, ...) require journal_mode=delete.
+JOURNAL_MODE="WAL"
+# max. time (in sec) a transaction waits for the lock of the database
+BUSY_TIMEOUT=30
+# number of prepared statements cached per connection
+STATEMENT_CACHE_SIZE=64
+# reliable queue: dequeued sub-jobs stay in the queue table (claimed by the
+# agent) and are requeued if not acknowledged (see ack_job) within
+# VISIBILITY_TIMEOUT seconds
+RELIABLE_QUEUE=True
+VISIBILITY_TIMEOUT=300
+# blocking operations (dequeue, state changes) poll the database: the poll
+# interval is doubled from POLL_INTERVAL up to MAX_POLL_INTERVAL (sec) while
+# nothing is found; max. blocking time DEQUEUE_TIMEOUT
+POLL_INTERVAL=0.005
+MAX_POLL_INTERVAL=0.1
+DEQUEUE_TIMEOUT=10
+# work stealing (see join_pilot_group): an idle agent tries to steal every
+# STEAL_INTERVAL sec; only queues with at least STEAL_THRESHOLD jobs are
+# stolen from
+PILOT_GROUP="bigjob:pilots"
+STEAL_INTERVAL=1
+STEAL_THRESHOLD=1
+# state changes of a pilot older than the newest MAX_STATE_CHANGES changes (of
+# all pilots) are deleted (no unbounded growth if the changes are not consumed).
+# A trim is recorded by a marker row (job_url NULL): get_job_state_changes then
+# returns the current states of all sub-jobs of the pilot
+MAX_STATE_CHANGES=10000
+
+SCHEMA="""
+CREATE TABLE IF NOT EXISTS pilots (url TEXT PRIMARY KEY, state TEXT, stopped TEXT);
+CREATE TABLE IF NOT EXISTS jobs (url TEXT PRIMARY KEY, pilot_url TEXT, state TEXT, description TEXT);
+CREATE INDEX IF NOT EXISTS jobs_pilot_index ON jobs (pilot_url);
+CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY, pilot_url TEXT, job_url TEXT,
+                                  consumer TEXT, claim_time REAL);
+CREATE INDEX IF NOT EXISTS queue_index ON queue (pilot_url, consumer, id);
+CREATE INDEX IF NOT EXISTS queue_job_index ON queue (job_url);
+CREATE TABLE IF NOT EXISTS state_changes (id INTEGER PRIMARY KEY, pilot_url TEXT, job_url TEXT, state TEXT);
+CREATE INDEX IF NOT EXISTS state_changes_index ON state_changes (pilot_url, id);
+CREATE TABLE IF NOT EXISTS pilot_groups (pilot_url TEXT PRIMARY KEY, group_name TEXT);
+"""
+
+# next unclaimed entry (head of queue: smallest id) of a pilot
+SELECT_QUEUE_HEAD="SELECT id, job_url FROM queue WHERE pilot_url=? AND consumer IS NULL ORDER BY id LIMIT 1"
+# longest queue of the pilots of a group (except the stealing pilot)
+SELECT_VICTIM="""SELECT q.pilot_url, COUNT(*) AS length FROM queue q JOIN pilot_groups g ON g.pilot_url=q.pilot_url
+WHERE g.group_name=? AND q.pilot_url<>? AND q.consumer IS NULL GROUP BY q.pilot_url HAVING length>=?
+ORDER BY length DESC LIMIT 1"""
+SELECT_QUEUE_TAIL="SELECT id, job_url FROM queue WHERE pilot_url=? AND consumer IS NULL ORDER BY id DESC LIMIT 1"
+INSERT_STATE_CHANGE="INSERT INTO state_changes (pilot_url, job_url, state) VALUES (?, ?, ?)"
+
+
+def transaction(method):
+    """ executes method in one write transaction on the connection of the
+        calling thread. BEGIN IMMEDIATE locks the database for writing at the
+        start of the transaction (no deadlock of two readers upgrading to
+        writers). Nested calls are part of the outer transaction. """
+    def wrapper(self, *args, **kwargs):
+        connection = self.get_connection()
+        if self.local.in_transaction:
+            return method(self, *args, **kwargs)
+        connection.execute("BEGIN IMMEDIATE")
+        self.local.in_transaction = True
+        try:
+            try:
+                result = method(self, *args, **kwargs)
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+        finally:
+            self.local.in_transaction = False
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class bigjob_coordination(object):
+    '''
+    Encapsulates communication and coordination
+    Implementation based on SQLite (http://www.sqlite.org): manager and agents
+    share one database file (single host or shared file system, no server)
+    '''
+
+    def __init__(self, server=None, server_port=None, server_connect_url=None,
+                 username=None, password=None, dbtype=None, url_prefix=None):
+        '''
+        Constructor
+        '''
+        self.journal_mode = JOURNAL_MODE
+        path = ""
+        if server_connect_url!=None:
+            path = server_connect_url[len(SQLITE_URL_SCHEME):]
+            if path.find("?")!=-1:
+                path, query = path.split("?", 1)
+                options = urlparse.parse_qs(query)
+                if options.has_key("journal_mode"):
+                    self.journal_mode = options["journal_mode"][0]
+            if path.startswith("localhost/"):
+                path = path[len("localhost"):]
+        if path=="":
+            path = SQLITE_DATABASE
+        # agents run in another working directory
+        self.path = os.path.abspath(path)
+        self.address = SQLITE_URL_SCHEME + self.path
+        if self.journal_mode != JOURNAL_MODE:
+            self.address = self.address + "?journal_mode=" + self.journal_mode
+        logger.debug("Open SQLite database: " + self.path + " Journal mode: " + self.journal_mode)
+
+        # connections can not be shared between threads => one connection per thread
+        self.local = threading.local()
+        self.resource_lock = threading.RLock()
+        self.reliable_queue = RELIABLE_QUEUE
+        # id of this client as consumer of sub-job queues
+        self.consumer_id = "%s-%d-%s"%(socket.gethostname(), os.getpid(), str(uuid.uuid1())[:8])
+        self.pilot_groups = {} # pilot_url => group (work stealing)
+        self.get_connection().executescript(SCHEMA)
+
+    def get_address(self):
+        return self.address
+
+    def get_connection(self):
+        """ returns connection of the calling thread """
+        connection = getattr(self.local, "connection", None)
+        if connection == None:
+            # isolation_level None: transactions are started explicitly (see transaction)
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                         cached_statements=STATEMENT_CACHE_SIZE)
+            connection.text_factory = str
+            connection.execute("PRAGMA journal_mode=" + self.journal_mode)
+            if self.journal_mode.upper() == "WAL":
+                # commits are durable after the next checkpoint, the database is never corrupted
+                connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.in_transaction = False
+        return connection
+
+    #####################################################################################
+    # Pilot-Job State
+    def set_pilot_state(self, pilot_url, new_state, stopped=False):
+        logger.debug("update state of pilot job to: " + str(new_state))
+        self.get_connection().execute("INSERT OR REPLACE INTO pilots (url, state, stopped) VALUES (?, ?, ?)",
+                                      (pilot_url, str(new_state), str(stopped)))
+
+    def get_pilot_state(self, pilot_url):
+        row = self.get_connection().execute("SELECT state, stopped FROM pilots WHERE url=?",
+                                            (pilot_url,)).fetchone()
+        if row == None:
+            return {}
+        return {"state":row[0], "stopped":row[1]}
+
+    def get_jobs_of_pilot(self, pilot_url):
+        """ returns array of job_url that are associated with a pilot """
+        rows = self.get_connection().execute("SELECT url FROM jobs WHERE pilot_url=?", (pilot_url,))
+        return [row[0] for row in rows]
+
+    @transaction
+    def delete_pilot(self, pilot_url):
+        """ delete pilot and its sub-jobs """
+        connection = self.get_connection()
+        connection.execute("DELETE FROM jobs WHERE pilot_url=?", (pilot_url,))
+        connection.execute("DELETE FROM queue WHERE pilot_url=?", (pilot_url,))
+        connection.execute("DELETE FROM state_changes WHERE pilot_url=?", (pilot_url,))
+        connection.execute("DELETE FROM pilots WHERE url=?", (pilot_url,))
+        self.leave_pilot_group(pilot_url)
+
+    def join_pilot_group(self, pilot_url, group=PILOT_GROUP):
+        """ work stealing: dequeue_job_description of pilot steals jobs from
+            other pilots of group if the queue of pilot is empty (and vice versa) """
+        self.get_connection().execute("INSERT OR REPLACE INTO pilot_groups (pilot_url, group_name) VALUES (?, ?)",
+                                      (pilot_url, group))
+        self.pilot_groups[pilot_url] = group
+
+    def leave_pilot_group(self, pilot_url):
+        if self.pilot_groups.pop(pilot_url, None) != None:
+            self.get_connection().execute("DELETE FROM pilot_groups WHERE pilot_url=?", (pilot_url,))
+
+    #####################################################################################
+    # Sub-Job State
+    def set_job_state(self, job_url, new_state):
+        logger.debug("set job state to: " + str(new_state))
+        self.set_job_states({job_url:new_state})
+
+    @transaction
+    def set_job_states(self, job_states, acks=None):
+        """ bulk update of job states (dict job_url => state) in one transaction
+            acks: list of (pilot_url, job_url) of dequeued jobs acknowledged in
+            the same transaction (see ack_job) """
+        connection = self.get_connection()
+        connection.executemany("UPDATE jobs SET state=? WHERE url=?",
+                               [(str(new_state), job_url) for job_url, new_state in job_states.items()])
+        self.__append_state_changes([(self.__get_pilot_url(job_url), job_url, str(new_state))
+                                     for job_url, new_state in job_states.items()])
+        if acks != None and self.reliable_queue:
+            connection.executemany("DELETE FROM queue WHERE job_url=? AND consumer=?",
+                                   [(job_url, self.consumer_id) for pilot_url, job_url in acks])
+
+    def get_job_state(self, job_url):
+        row = self.get_connection().execute("SELECT state FROM jobs WHERE url=?", (job_url,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def get_job_state_changes(self, pilot_url, timeout=0):
+        """ returns list of (job_url, state) tuples for all state changes of the
+            sub-jobs of pilot since the last call (in order of the changes).
+            Blocks up to timeout (max. DEQUEUE_TIMEOUT) seconds if no state change
+            is available.
+            State changes are consumed, i.e. there should be only one consumer
+            per pilot (the manager).
+            If changes were trimmed (see MAX_STATE_CHANGES), the current states
+            of all sub-jobs of the pilot are appended (i.e. the consumer recovers
+            without further calls).
+        """
+        connection = self.get_connection()
+        end = time.time() + min(timeout, DEQUEUE_TIMEOUT)
+        poll_interval = POLL_INTERVAL
+        while True:
+            # check without lock of the database
+            if connection.execute("SELECT id FROM state_changes WHERE pilot_url=? LIMIT 1",
+                                  (pilot_url,)).fetchone() != None:
+                return self.__consume_state_changes(pilot_url)
+            if time.time() + poll_interval > end:
+                return []
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval*2, MAX_POLL_INTERVAL)
+
+    @transaction
+    def __consume_state_changes(self, pilot_url):
+        connection = self.get_connection()
+        rows = connection.execute("SELECT id, job_url, state FROM state_changes WHERE pilot_url=? ORDER BY id",
+                                  (pilot_url,)).fetchall()
+        if len(rows) > 0:
+            connection.execute("DELETE FROM state_changes WHERE pilot_url=? AND id<=?", (pilot_url, rows[-1][0]))
+        changes = [(row[1], row[2]) for row in rows if row[1] != None]
+        if len(changes) < len(rows):
+            logger.warn("State changes of %s were trimmed - reading all sub-job states"%pilot_url)
+            changes.extend([(row[0], row[1]) for row in
+                            connection.execute("SELECT url, state FROM jobs WHERE pilot_url=?", (pilot_url,))])
+        return changes
+
+    def __append_state_changes(self, changes):
+        """ insert state changes (list of (pilot_url, job_url, state) tuples) and
+            delete changes older than MAX_STATE_CHANGES (part of transaction of
+            caller) """
+        if len(changes) == 0:
+            return
+        connection = self.get_connection()
+        connection.executemany(INSERT_STATE_CHANGE, changes)
+        oldest_id = connection.execute("SELECT MAX(id) FROM state_changes").fetchone()[0] - MAX_STATE_CHANGES
+        if oldest_id <= 0:
+            return
+        for pilot_url in set([i[0] for i in changes]):
+            if connection.execute("DELETE FROM state_changes WHERE pilot_url=? AND id<=?",
+                                  (pilot_url, oldest_id)).rowcount > 0:
+                connection.execute(INSERT_STATE_CHANGE, (pilot_url, None, None))
+
+
+    #####################################################################################
+    # Sub-Job Description
+    def set_job(self, job_url, job_dict):
+        self.set_jobs([(job_url, job_dict)])
+
+    @transaction
+    def set_jobs(self, jobs):
+        """ bulk version of set_job: jobs is a list of (job_url, job_dict) tuples
+            all descriptions are written in one transaction (fields are merged
+            with the stored description)
+        """
+        connection = self.get_connection()
+        rows = []
+        for job_url, job_dict in jobs:
+            stored = self.get_job(job_url)
+            stored.update(job_dict)
+            rows.append(self.__encode_job(job_url, stored))
+        connection.executemany("INSERT OR REPLACE INTO jobs (url, pilot_url, state, description) VALUES (?, ?, ?, ?)",
+                               rows)
+
+    def submit_job(self, pilot_url, job_url, job_dict):
+        """ store job description and queue job with one transaction """
+        self.submit_jobs(pilot_url, [(job_url, job_dict)])
+
+    @transaction
+    def submit_jobs(self, pilot_url, jobs):
+        """ store job descriptions and queue jobs (list of (job_url, job_dict)
+            tuples) with one transaction """
+        connection = self.get_connection()
+        connection.executemany("INSERT OR REPLACE INTO jobs (url, pilot_url, state, description) VALUES (?, ?, ?, ?)",
+                               [self.__encode_job(job_url, job_dict) for job_url, job_dict in jobs])
+        self.queue_jobs(pilot_url, [job_url for job_url, job_dict in jobs])
+
+    def get_job(self, job_url):
+        row = self.get_connection().execute("SELECT state, description FROM jobs WHERE url=?",
+                                            (job_url,)).fetchone()
+        if row == None:
+            return {}
+        return self.__decode_job(row[0], row[1])
+
+    @transaction
+    def delete_job(self, job_url):
+        connection = self.get_connection()
+        connection.execute("DELETE FROM jobs WHERE url=?", (job_url,))
+        connection.execute("DELETE FROM queue WHERE job_url=?", (job_url,))
+
+    def __get_pilot_url(self, job_url):
+        """ job urls have the form <pilot_url>:jobs:<job id> """
+        return job_url.rsplit(":jobs:", 1)[0]
+
+    def __encode_job(self, job_url, job_dict):
+        """ returns row of jobs table; the state is stored in a separate column """
+        description = dict(job_dict)
+        state = description.pop("state", None)
+        if state != None:
+            state = str(state)
+        return (job_url, self.__get_pilot_url(job_url), state, json.dumps(description, separators=(',', ':')))
+
+    def __decode_job(self, state, description):
+        """ returns job dict (json returns unicode strings => converted to str) """
+        job_dict = {}
+        for key, value in json.loads(description).iteritems():
+            if type(value) == unicode:
+                value = value.encode("utf-8")
+            job_dict[key.encode("utf-8")] = value
+        if state != None:
+            job_dict["state"] = state
+        return job_dict
+
+
+    #####################################################################################
+    # Distributed queue for sub-jobs
+    def queue_job(self, pilot_url, job_url):
+        """ queue new job to pilot """
+        self.queue_jobs(pilot_url, [job_url])
+
+    @transaction
+    def queue_jobs(self, pilot_url, job_urls):
+        """ queue list of new jobs to pilot in one transaction """
+        self.get_connection().executemany("INSERT INTO queue (pilot_url, job_url) VALUES (?, ?)",
+                                          [(pilot_url, job_url) for job_url in job_urls])
+
+    @transaction
+    def requeue_job(self, pilot_url, job_url):
+        """ return dequeued job to the head of the queue (the queue entry keeps
+            its id, i.e. its position in FIFO order) """
+        connection = self.get_connection()
+        cursor = connection.execute("UPDATE queue SET pilot_url=?, consumer=NULL, claim_time=NULL "
+                                    + "WHERE job_url=? AND consumer IS NOT NULL", (pilot_url, job_url))
+        if cursor.rowcount == 0:
+            # not in queue (reliable queue disabled)
+            connection.execute("INSERT INTO queue (id, pilot_url, job_url) VALUES "
+                               + "((SELECT IFNULL(MIN(id), 1) - 1 FROM queue), ?, ?)", (pilot_url, job_url))
+
+    def dequeue_job(self, pilot_url, timeout=DEQUEUE_TIMEOUT):
+        """ deque to new job  of a certain pilot
+            reliable queue: the job is claimed by this consumer and must be
+            acknowledged with ack_job
+            blocks up to timeout seconds if the queue is empty
+        """
+        result = self.__wait_for_job(pilot_url, timeout, False)
+        if result == None:
+            return None
+        logger.debug("Dequeued: " + str(result[0]))
+        return result[0]
+
+    def dequeue_job_description(self, pilot_url):
+        """ dequeue new job of pilot, mark it New and return (job_url, job description)
+            Claim, state update and read of the description are done in one
+            transaction. If the queue is empty, a job is stolen from another
+            pilot of the group of pilot (see join_pilot_group).
+            Blocks up to DEQUEUE_TIMEOUT (STEAL_INTERVAL) seconds if the queue is
+            empty; returns (None, None) if no job was dequeued
+        """
+        timeout = DEQUEUE_TIMEOUT
+        if self.pilot_groups.has_key(pilot_url):
+            result = self.__claim_job(pilot_url, True)
+            if result != None:
+                return result
+            result = self.__steal_job(pilot_url)
+            if result != None:
+                return result
+            timeout = STEAL_INTERVAL
+        result = self.__wait_for_job(pilot_url, timeout, True)
+        if result == None:
+            return None, None
+        return result
+
+    def ack_job(self, pilot_url, job_url):
+        """ acknowledge start of dequeued job (removes job from queue) """
+        if not self.reliable_queue:
+            return
+        self.get_connection().execute("DELETE FROM queue WHERE job_url=? AND consumer=?",
+                                      (job_url, self.consumer_id))
+
+    def set_job_credits(self, pilot_url, credits):
+        """ jobs are pulled by dequeue_job => no flow control required """
+        pass
+
+    @transaction
+    def requeue_expired_jobs(self, pilot_url, timeout=VISIBILITY_TIMEOUT):
+        """ requeue jobs that were dequeued but not acknowledged within timeout
+            seconds (e.g. agent crashed); jobs that were started already are
+            removed from the queue (ack lost)
+            returns number of requeued jobs
+        """
+        if not self.reliable_queue:
+            return 0
+        connection = self.get_connection()
+        rows = connection.execute("SELECT q.id, j.state FROM queue q LEFT JOIN jobs j ON j.url=q.job_url "
+                                  + "WHERE q.pilot_url=? AND q.consumer IS NOT NULL AND q.claim_time<?",
+                                  (pilot_url, time.time() - timeout)).fetchall()
+        requeued = [(row[0],) for row in rows if row[1]==None or row[1]=="Unknown" or row[1]=="New"]
+        started = [(row[0],) for row in rows if not (row[1]==None or row[1]=="Unknown" or row[1]=="New")]
+        connection.executemany("UPDATE queue SET consumer=NULL, claim_time=NULL WHERE id=?", requeued)
+        connection.executemany("DELETE FROM queue WHERE id=?", started)
+        return len(requeued)
+
+    def __wait_for_job(self, pilot_url, timeout, read_description):
+        """ polls queue of pilot until a job is claimed or timeout seconds passed
+            returns (job_url, job description or None) or None """
+        connection = self.get_connection()
+        end = time.time() + timeout
+        poll_interval = POLL_INTERVAL
+        while True:
+            # check without lock of the database
+            if connection.execute(SELECT_QUEUE_HEAD, (pilot_url,)).fetchone() != None:
+                result = self.__claim_job(pilot_url, read_description)
+                if result != None:
+                    return result
+                # claimed by another consumer
+                poll_interval = POLL_INTERVAL
+                continue
+            if time.time() + poll_interval > end:
+                return None
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval*2, MAX_POLL_INTERVAL)
+
+    @transaction
+    def __claim_job(self, pilot_url, read_description):
+        """ returns (job_url, job description or None) of the head of the queue
+            or None if queue is empty """
+        row = self.get_connection().execute(SELECT_QUEUE_HEAD, (pilot_url,)).fetchone()
+        if row == None:
+            return None
+        return self.__claim_entry(pilot_url, row[0], row[1], read_description)
+
+    @transaction
+    def __steal_job(self, pilot_url):
+        """ returns (job_url, job description) stolen from the tail (newest
+            entry) of the longest queue of the other pilots of the group of pilot
+            or None """
+        connection = self.get_connection()
+        victim = connection.execute(SELECT_VICTIM, (self.pilot_groups[pilot_url], pilot_url,
+                                                    STEAL_THRESHOLD)).fetchone()
+        if victim == None:
+            return None
+        row = connection.execute(SELECT_QUEUE_TAIL, (victim[0],)).fetchone()
+        logger.debug("Stole job %s from %s"%(row[1], victim[0]))
+        return self.__claim_entry(pilot_url, row[0], row[1], True)
+
+    def __claim_entry(self, pilot_url, entry_id, job_url, read_description):
+        """ claim queue entry for this consumer (moved to queue of pilot), mark
+            job New (part of transaction of caller) """
+        connection = self.get_connection()
+        if self.reliable_queue:
+            connection.execute("UPDATE queue SET pilot_url=?, consumer=?, claim_time=? WHERE id=?",
+                               (pilot_url, self.consumer_id, time.time(), entry_id))
+        else:
+            connection.execute("DELETE FROM queue WHERE id=?", (entry_id,))
+        if not read_description:
+            return job_url, None
+        row = connection.execute("SELECT state, description FROM jobs WHERE url=?", (job_url,)).fetchone()
+        if row == None:
+            return job_url, {}
+        if row[0] == "Unknown":
+            connection.execute("UPDATE jobs SET state='New' WHERE url=?", (job_url,))
+            self.__append_state_changes([(self.__get_pilot_url(job_url), job_url, "New")])
+            return job_url, self.__decode_job("New", row[1])
+        return job_url, self.__decode_job(row[0], row[1])
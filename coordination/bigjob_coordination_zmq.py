@@ -7,15 +7,17 @@ import threading
 import datetime
 import sys
 import os
-import pickle
 import pdb
 import zmq
 import traceback
 import Queue
 import socket
 import time
-from zmq.eventloop import ioloop, zmqstream
-import zlib, cPickle as pickle
+import json
+import zlib
+import struct
+import fcntl
+import urlparse
 from bigjob import logger
 
 if sys.version_info < (2, 5):
@@ -29,6 +31,51 @@ SERVER_IP="localhost"
 SERVER_PORT=0
 
 NUMBER_RETRIES=2
+# time (in sec) a client waits for the reply to a request before retrying
+REQUEST_TIMEOUT=10
+
+# Wire format: a message is sent as multipart message [value frames, header]
+#   header: struct WIRE_HEADER (version, command, encoding of value, number of 
+#           value frames, length of key) + key + value (if str)
+#   value:  None or str: no frame; list of str: one frame per item; 
+#           dict of str: alternating key and value frames (e.g. job descriptions); 
+#           other values: one JSON frame
+# The header is the last frame, i.e. the routing envelope (ROUTER identities, 
+# request id) of a message are the frames before the value frames.
+# Value frames larger than COMPRESSION_THRESHOLD bytes in total (e.g. batches of jobs) 
+# are sent as one zlib compressed frame (frame lengths + frames). Only data is 
+# decoded, i.e. no code is executed on receipt (unlike pickle)
+WIRE_VERSION=1
+WIRE_HEADER="!BBBII"
+HEADER_SIZE=struct.calcsize(WIRE_HEADER)
+COMMANDS=["reply", "error", "STOP", "job", "set_pilot_state", "get_pilot_state", 
+          "set_job_state", "set_job_states", "get_job_state", "get_job", "queue_job", 
+          "queue_jobs", "request_jobs", "dequeue_job", "set_job", "delete_job", "ack_job", 
+          "address", "requeue_job"]
+COMMAND_IDS=dict([(command, i) for i, command in enumerate(COMMANDS)])
+VALUE_NONE=0
+VALUE_STRING=1
+VALUE_LIST=2
+VALUE_DICT=3
+VALUE_JSON=4
+VALUE_COMPRESSED=0x80 # flag
+# None disables compression
+COMPRESSION_THRESHOLD=64*1024
+# messages with frames larger than threshold (in bytes) are sent without copying
+ZERO_COPY_THRESHOLD=64*1024
+
+# Persistent state of the server (see state_store): the path prefix of the store 
+# files is set per server by the store option of the coordination url, e.g. 
+# tcp://*?store=/path/bigjob-store (or state_store_path); without store the 
+# state is kept in memory only
+STATE_STORE_OPTION="store"
+# number of log records after which a snapshot is written (and the log is compacted)
+SNAPSHOT_INTERVAL=100000
+# max. time (in sec) log records are buffered before they are synced to disk
+SYNC_INTERVAL=1
+# jobs pushed to an agent, but not acknowledged (see ack_job) within 
+# DELIVERY_TIMEOUT seconds are requeued (e.g. agent crashed after delivery)
+DELIVERY_TIMEOUT=300
 
 class message:    
     def __init__(self, command, key, value):
@@ -39,17 +86,292 @@ class message:
     def __repr__(self):
         return ("command: %s, key: %s, value: %s "%(self.command, self.key, self.value))
 
+
+def encode_message(msg):
+    """ returns frames of msg """
+    value = msg.value
+    value_type = type(value)
+    key = str(msg.key)
+    inline = ""
+    if value == None:
+        encoding, frames = VALUE_NONE, []
+    elif value_type == str:
+        encoding, frames, inline = VALUE_STRING, [], value
+    elif value_type == list and _all_str(value):
+        encoding, frames = VALUE_LIST, list(value)
+    elif value_type == dict and _all_str(value.keys()) and _all_str(value.values()):
+        encoding, frames = VALUE_DICT, [i for item in value.iteritems() for i in item]
+    else:
+        encoding, frames = VALUE_JSON, [json.dumps(value, separators=(',', ':'))]
+    if COMPRESSION_THRESHOLD != None and len(inline) + sum([len(i) for i in frames]) > COMPRESSION_THRESHOLD:
+        if encoding == VALUE_STRING:
+            frames, inline = [inline], ""
+        lengths = struct.pack("!%dI"%(len(frames)+1), len(frames), *[len(i) for i in frames])
+        encoding, frames = encoding | VALUE_COMPRESSED, [zlib.compress(lengths + "".join(frames), 1)]
+    header = struct.pack(WIRE_HEADER, WIRE_VERSION, COMMAND_IDS[msg.command], encoding, 
+                         len(frames), len(key))
+    frames.append(header + key + inline)
+    return frames
+
+
+def decode_message(frames):
+    """ returns (envelope, message) of frames (message as returned by encode_message, 
+        preceded by the envelope frames) """
+    header = frames[-1]
+    version, command_id, encoding, number_frames, key_length = struct.unpack(WIRE_HEADER, 
+                                                                           header[:HEADER_SIZE])
+    if version != WIRE_VERSION:
+        raise ValueError("Unsupported wire format version: %d"%version)
+    envelope_size = len(frames) - number_frames - 1
+    value_frames = frames[envelope_size:-1]
+    key = header[HEADER_SIZE:HEADER_SIZE+key_length]
+    if encoding & VALUE_COMPRESSED:
+        value_frames = _decompress(value_frames[0])
+        encoding = encoding & ~VALUE_COMPRESSED
+    if encoding == VALUE_NONE:
+        value = None
+    elif encoding == VALUE_STRING:
+        if len(value_frames) > 0:
+            value = value_frames[0]
+        else:
+            value = header[HEADER_SIZE+key_length:]
+    elif encoding == VALUE_LIST:
+        value = value_frames
+    elif encoding == VALUE_DICT:
+        value = dict(zip(value_frames[0::2], value_frames[1::2]))
+    elif encoding == VALUE_JSON:
+        value = _to_str(json.loads(value_frames[0]))
+    else:
+        raise ValueError("Unknown value encoding: %d"%encoding)
+    return frames[:envelope_size], message(COMMANDS[command_id], key, value)
+
+
+def _decompress(data):
+    """ returns frames of compressed frame """
+    data = zlib.decompress(data)
+    number_frames = struct.unpack("!I", data[:4])[0]
+    offset = 4*(number_frames+1)
+    frames = []
+    for length in struct.unpack("!%dI"%number_frames, data[4:offset]):
+        frames.append(data[offset:offset+length])
+        offset = offset + length
+    return frames
+
+
+def _all_str(values):
+    for i in values:
+        if type(i) != str:
+            return False
+    return True
+
+
+def _to_str(value):
+    """ json returns unicode strings => convert to str """
+    if type(value) == unicode:
+        return value.encode("utf-8")
+    elif type(value) == list:
+        return [_to_str(i) for i in value]
+    elif type(value) == dict:
+        return dict([(_to_str(k), _to_str(v)) for k, v in value.iteritems()])
+    return value
+
+
+def send_message(zmq_socket, envelope, msg, flags=0):
+    """ send msg with envelope (list of routing frames) """
+    frames = envelope + encode_message(msg)
+    copy = True
+    for frame in frames:
+        if len(frame) >= ZERO_COPY_THRESHOLD:
+            copy = False
+            break
+    zmq_socket.send_multipart(frames, flags, copy=copy)
+
+
+class state_store(object):
+    """ append-only log of the state changes of the coordination server 
+        
+        Files: <path>.snapshot (state at the begin of log generation g) and 
+        <path>.log.<g> (changes after snapshot). Records are messages (see 
+        encode_message) prefixed by the frame lengths. Writes are buffered and 
+        synced at most every SYNC_INTERVAL sec (i.e. a crash loses at most the 
+        changes of the last SYNC_INTERVAL sec). 
+        After SNAPSHOT_INTERVAL records, the state is written to a new snapshot 
+        and the logs of older generations are deleted (compaction).
+        A store is used by one server at a time (lock of <path>.lock).
+    """
+    
+    def __init__(self, path, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.generation = 0
+        self.log_file = None
+        self.lock_file = None
+        self.number_records = 0
+        self.last_sync = time.time()
+        
+        
+    def load(self):
+        """ returns records (messages) of snapshot and logs; subsequent records 
+            are appended to the log of the latest generation 
+            raises an exception if the store is used by another server """
+        self.lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise Exception("State store %s is used by another server"%self.path)
+        records = []
+        if os.path.exists(self.path + ".snapshot"):
+            snapshot_file = open(self.path + ".snapshot", "rb")
+            header = snapshot_file.read(4)
+            self.generation = struct.unpack("!I", header)[0]
+            records.extend(self.__read_records(snapshot_file))
+            snapshot_file.close()
+        generations = self.__get_log_generations()
+        for generation in generations:
+            if generation < self.generation:
+                os.remove(self.__get_log_path(generation))
+        generations = [i for i in generations if i >= self.generation]
+        offset = 0
+        for generation in generations:
+            log_file = open(self.__get_log_path(generation), "rb")
+            offset = 0
+            for record, offset in self.__read_records(log_file, True):
+                records.append(record)
+            log_file.close()
+            self.generation = generation
+        self.log_file = open(self.__get_log_path(self.generation), "ab")
+        # discard torn record at end of log (crash while writing)
+        self.log_file.truncate(offset)
+        self.number_records = len(records)
+        logger.debug("Loaded %d records from state store %s"%(len(records), self.path))
+        return records
+        
+        
+    def append(self, msg):
+        if self.log_file == None: # closed
+            return
+        frames = encode_message(msg)
+        self.log_file.write(struct.pack("!%dI"%(len(frames)+1), len(frames), *[len(i) for i in frames]) 
+                            + "".join(frames))
+        self.number_records = self.number_records + 1
+        
+        
+    def flush(self):
+        if self.log_file == None: # closed
+            return
+        self.log_file.flush()
+        if time.time() - self.last_sync >= SYNC_INTERVAL:
+            os.fsync(self.log_file.fileno())
+            self.last_sync = time.time()
+            
+            
+    def is_snapshot_due(self):
+        return self.number_records >= self.snapshot_interval
+    
+    
+    def rotate(self):
+        """ start new log generation; returns generation of the snapshot that 
+            must be written (with the state before the new log) """
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.log_file.close()
+        self.generation = self.generation + 1
+        self.log_file = open(self.__get_log_path(self.generation), "ab")
+        self.number_records = 0
+        return self.generation
+            
+    
+    def write_snapshot(self, generation, records):
+        """ write snapshot of generation (state at the begin of log generation) 
+            and delete older logs """
+        snapshot_file = open(self.path + ".snapshot.tmp", "wb")
+        snapshot_file.write(struct.pack("!I", generation))
+        for msg in records:
+            frames = encode_message(msg)
+            snapshot_file.write(struct.pack("!%dI"%(len(frames)+1), len(frames), *[len(i) for i in frames]) 
+                                + "".join(frames))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+        snapshot_file.close()
+        os.rename(self.path + ".snapshot.tmp", self.path + ".snapshot")
+        for i in self.__get_log_generations():
+            if i < generation:
+                os.remove(self.__get_log_path(i))
+        logger.debug("Wrote snapshot %d with %d records"%(generation, len(records)))
+    
+    
+    def close(self):
+        if self.log_file != None:
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.log_file.close()
+            self.log_file = None
+        if self.lock_file != None:
+            self.lock_file.close()
+            self.lock_file = None
+    
+    
+    def __read_records(self, data_file, with_offset=False):
+        """ returns records of file; stops at torn record """
+        records = []
+        data = data_file.read()
+        offset = 0
+        while offset + 4 <= len(data):
+            number_frames = struct.unpack("!I", data[offset:offset+4])[0]
+            header_end = offset + 4*(number_frames+1)
+            if header_end > len(data):
+                break
+            lengths = struct.unpack("!%dI"%number_frames, data[offset+4:header_end])
+            end = header_end + sum(lengths)
+            if end > len(data):
+                break
+            frames = []
+            position = header_end
+            for length in lengths:
+                frames.append(data[position:position+length])
+                position = position + length
+            record = decode_message(frames)[1]
+            offset = end
+            if with_offset:
+                records.append((record, offset))
+            else:
+                records.append(record)
+        return records
+    
+    
+    def __get_log_path(self, generation):
+        return "%s.log.%d"%(self.path, generation)
+    
+    
+    def __get_log_generations(self):
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        prefix = prefix + ".log."
+        generations = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                generations.append(int(name[len(prefix):]))
+        generations.sort()
+        return generations
+
+
+
 class bigjob_coordination(object):
     '''
     Encapsulates communication and coordination
     Implementation based on ZMQ 
     '''
     def __init__(self, server=SERVER_IP, server_port=SERVER_PORT, server_connect_url=None,
-                 username=None, password=None, dbtype=None, url_prefix=None):
+                 username=None, password=None, dbtype=None, url_prefix=None, 
+                 state_store_path=None):
         '''
         Constructor
         set server and server_port to create a service (server)
         set server_connect_url to connect to a service (client)
+        set state_store_path (or the store option of the url query dbtype, see 
+        STATE_STORE_OPTION) to persist the state of the service; a restarted 
+        service recovers the state (and address) from the store
         '''  
         self.stopped = False
         self.has_stopped=False        
@@ -61,12 +383,35 @@ class bigjob_coordination(object):
         self.jobs = {}
         self.job_states = {}
         self.new_job_queue = Queue.Queue()
+        # agents receiving pushed jobs: list of [delivery socket identity, credits]
+        self.job_consumers = []
+        # jobs pushed to agents, but not acknowledged: 
+        # job_url => [delivery time, delivery socket identity]
+        self.delivered_jobs = {}
+        self.store = None
+        self.store_lock = threading.Lock()
+        self.recovered_address = None
         
         # Lock for server and client to manage concurrent access
         self.resource_lock = threading.Lock()
         
-        # Client side queue
+        # client: every thread uses its own DEALER socket (ZMQ sockets must not 
+        # be shared between threads) => requests of all threads are in flight 
+        # concurrently; replies are matched by request id
+        self.request_counter = 0
+        self.request_lock = threading.Lock()
+        self.thread_local = threading.local()
+        
+        # Client side queue (jobs pushed by server)
         self.subjob_queue = Queue.Queue()
+        self.subjob_pilot_url = None
+        self.pilot_group = False # see join_pilot_group
+        # credit based flow control: the server pushes at most as many jobs as 
+        # credits were granted by the client (see dequeue_job)
+        self.job_credits = 1        # number of jobs to be delivered ahead
+        self.granted_credits = 0    # granted but not yet used credits
+        self.credit_time = 0        # time of last grant
+        self.credit_lock = threading.Lock()
             
         # set up ZMQ client / server communication
         self.context = zmq.Context()
@@ -78,6 +423,13 @@ class bigjob_coordination(object):
         logging.debug("Server: " + server)         
         if server_connect_url==None: # role = Server
             self.server_role = True
+            if state_store_path == None and dbtype != None:
+                options = urlparse.parse_qs(dbtype)
+                if options.has_key(STATE_STORE_OPTION):
+                    state_store_path = options[STATE_STORE_OPTION][0]
+            if state_store_path != None:
+                self.store = state_store(state_store_path)
+                self.__recover()
             # start eventloop
             self.startup_condition = threading.Condition()
             self.eventloop_thread=threading.Thread(target=self.__server, args=(server, server_port))
@@ -87,7 +439,11 @@ class bigjob_coordination(object):
             logging.debug("Setting up socket for notifications")
             # socket for sending notification
             self.push_socket = self.context.socket(zmq.PUSH)
-            push_port = self.push_socket.bind_to_random_port("tcp://*")    
+            if self.recovered_address != None:
+                push_port = self.recovered_address[1].split(":")[-1]
+                self.push_socket.bind("tcp://*:" + push_port)
+            else:
+                push_port = self.push_socket.bind_to_random_port("tcp://*")    
             self.push_address = "tcp://"+server+":"+str(push_port)                
             
             
@@ -97,6 +453,8 @@ class bigjob_coordination(object):
             while self.address == None:
                 self.startup_condition.wait()
             self.startup_condition.release()                       
+            if self.store != None:
+                self.__record(message("address", "", [self.address, self.push_address]))
         else: # role client
             urls = server_connect_url.split(",")
             self.address = urls[0]
@@ -108,21 +466,26 @@ class bigjob_coordination(object):
             
         
         logging.debug("Connect sockets to server: " + self.address + " push: " + self.push_address)
-        # connect to REP server
-        self.client_socket = self.context.socket(zmq.REQ)
-        self.client_socket.connect(self.address)
+        # requests are sent via per-thread DEALER sockets connected to the 
+        # ROUTER socket of the server (see __request)
         
         # connect to PUSH server
         self.pull_socket = self.context.socket(zmq.PULL)
         self.pull_socket.connect(self.push_address)
         
         if self.server_role==False:
-            self.notification_thread=threading.Thread(target=self.__wait_for_notifications)
-            self.notification_thread.daemon=True
-            self.notification_thread.start()
+            # jobs (and descriptions) are pushed by the server via the ROUTER socket 
+            # to the delivery socket (addressed by its identity)
+            self.delivery_identity = "bigjob-agent-" + str(uuid.uuid1())
+            self.delivery_socket = self.context.socket(zmq.DEALER)
+            self.delivery_socket.setsockopt(zmq.IDENTITY, self.delivery_identity)
+            self.delivery_socket.connect(self.address)
+            self.delivery_thread=threading.Thread(target=self.__receive_jobs)
+            self.delivery_thread.daemon=True
+            self.delivery_thread.start()
         
         
-        logging.debug("Connected to REP socket at: " + self.address + " and PUSH socket at: " + self.push_address)
+        logging.debug("Connected to ROUTER socket at: " + self.address + " and PUSH socket at: " + self.push_address)
         logging.debug("C&C ZMQ system initialized")
         
 
@@ -134,47 +497,19 @@ class bigjob_coordination(object):
     #####################################################################################
     # Pilot-Job State
     def set_pilot_state(self, pilot_url, new_state, stopped=False):     
-        logging.debug("BEGIN update state of pilot job to: " + str(new_state) 
-                       + " Lock: " + str(self.resource_lock))
-        counter = 0
-        result = None
-        while result != "SUCCESS" and counter < NUMBER_RETRIES:
-            with self.resource_lock:  
-                msg = message("set_pilot_state", pilot_url, {"state":str(new_state), "stopped":str(stopped)})
-                try:
-                    self.client_socket.send_pyobj(msg, zmq.NOBLOCK)        
-                    result = self.client_socket.recv_pyobj()
-                except:
-                    traceback.print_exc(file=sys.stderr)
-            # stop background thread running the server (if True)
-            self.stopped=stopped             
-            if result == None:
-                logging.error("RETRY set_pilot_state")
-                counter = counter + 1
-                time.sleep(1) 
+        logging.debug("BEGIN update state of pilot job to: " + str(new_state))
+        self.__request("set_pilot_state", pilot_url, {"state":str(new_state), "stopped":str(stopped)})
+        # stop background thread running the server (if True)
+        self.stopped=stopped             
         logging.debug("END update state of pilot job to: " + str(new_state))
         
     def get_pilot_state(self, pilot_url):
-        logging.debug("BEGIN get_pilot_state: %s lock: %s" % (pilot_url, str(self.resource_lock)))
-        counter = 0
-        result = None
-        while result ==None and counter < NUMBER_RETRIES:
-            with self.resource_lock:   
-                msg = message("get_pilot_state", pilot_url, " Lock: ")
-                try:
-                    self.client_socket.send_pyobj(msg, zmq.NOBLOCK)
-                    result = self.client_socket.recv_pyobj()
-                except:
-                    pass
-                  
-            logging.debug("END get_pilot_state: %s state: %s, lock: %s" % 
-                          (pilot_url, str(result.value), str(self.resource_lock)))
-            if result == None:               
-                counter = counter + 1
-                logging.error("RETRY get_pilot_state - Retry # %d"%counter)
-                time.sleep(1) 
+        logging.debug("BEGIN get_pilot_state: %s" % (pilot_url))
+        result = self.__request("get_pilot_state", pilot_url, "")
+        logging.debug("END get_pilot_state: %s state: %s" % (pilot_url, str(result)))
+        if result == None:
+            return None
         return result.value
-        logging.debug("END get_pilot_state: %s lock: %s" % (pilot_url, str(self.resource_lock)))
     
     def get_jobs_of_pilot(self, pilot_url):
         """ returns array of job_url that are associated with a pilot """
@@ -186,9 +521,10 @@ class bigjob_coordination(object):
         # stop everything
         self.stopped=True
         msg = message("STOP", pilot_url, "")        
-        self.client_socket.send_pyobj(msg, zmq.NOBLOCK)
+        self.__send(msg)
         if self.server_role == True:
-            self.push_socket.send_pyobj(msg, zmq.NOBLOCK)
+            with self.resource_lock:
+                send_message(self.push_socket, [], msg, zmq.NOBLOCK)
         #self.eventloop_thread.join()
         logging.debug("Has stopped: " + str(self.has_stopped))
         self.__shutdown()
@@ -198,61 +534,60 @@ class bigjob_coordination(object):
     # Sub-Job State    
     def set_job_state(self, job_url, new_state):
         logging.debug("Set job state: %s to %s"%(job_url, new_state))
-        counter = 0
-        result = None
-        while result == None and counter < NUMBER_RETRIES:
-            with self.resource_lock:   
-                msg = message("set_job_state", job_url, new_state)
-                try:
-                    self.client_socket.send_pyobj(msg, zmq.NOBLOCK)
-                    result = self.client_socket.recv_pyobj()
-                except:
-                    traceback.print_exc(file=sys.stderr)
-      
-            if result == None:
-                counter = counter + 1
-                logging.error("RETRY %d set_job_state %s to %s"%(counter, job_url, new_state))
-                if counter == NUMBER_RETRIES-1:
-                    self.__reset_client_socket()              
-                time.sleep(2)
-                continue # retry
-            else:
-                logging.debug("SUCCESS set_job_state (%s to %s)"%(job_url, new_state))
-            
+        if self.__request("set_job_state", job_url, new_state) != None:
+            logging.debug("SUCCESS set_job_state (%s to %s)"%(job_url, new_state))
         
+    def set_job_states(self, job_states, acks=None):
+        """ bulk update of job states (dict job_url => state) with one message 
+            acks: list of (pilot_url, job_url) of acknowledged jobs (see ack_job) """
+        logging.debug("Set %d job states"%len(job_states))
+        if len(job_states) > 0:
+            self.__request("set_job_states", "", job_states)
+        if acks != None:
+            for pilot_url, job_url in acks:
+                self.ack_job(pilot_url, job_url)
         
+    def get_job_state_changes(self, pilot_url, timeout=0):
+        """ state change stream not supported by this backend (state must be polled) """
+        return None
+    
     def get_job_state(self, job_url):
         #logging.debug("get_job_state")
-        with self.resource_lock:   
-            msg = message("get_job_state", job_url, "")
-            self.client_socket.send_pyobj(msg, zmq.NOBLOCK)
-            result = self.client_socket.recv_pyobj()            
+        result = self.__request("get_job_state", job_url, "")
         return result.value      
         
     #####################################################################################
     # Sub-Job Description
     def set_job(self, job_url, job_dict):        
         """ local only - used only by manager """
-        self.job_ids.append(job_url)
-        self.jobs[job_url] = job_dict   
-        self.job_states[job_url]="Unknown"     
+        self.__record(message("set_job", job_url, job_dict))
+    
+    def set_jobs(self, jobs):
+        """ local only - used only by manager """
+        for job_url, job_dict in jobs:
+            self.set_job(job_url, job_dict)
+    
+    def submit_job(self, pilot_url, job_url, job_dict):
+        """ store job description and queue job """
+        self.set_job(job_url, job_dict)
+        self.queue_job(pilot_url, job_url)
+        
+    def submit_jobs(self, pilot_url, jobs):
+        """ store job descriptions and queue jobs (list of (job_url, job_dict) tuples) """
+        self.set_jobs(jobs)
+        self.queue_jobs(pilot_url, [job[0] for job in jobs])
     
     def get_job(self, job_url):       
         if self.jobs.has_key(job_url)==False:
-            logging.debug("get_job: " + str(self.resource_lock))
-            with self.resource_lock: 
-                logging.debug("get_job (lock acquired): " + str(self.resource_lock))
-                msg = message("get_job", job_url, "")
-                self.client_socket.send_pyobj(msg)
-                result = self.client_socket.recv_pyobj()
-                self.jobs[job_url] = result.value
-                logging.debug("received job: "  + str(result.value))
+            logging.debug("get_job: " + job_url)
+            result = self.__request("get_job", job_url, "")
+            self.jobs[job_url] = result.value
+            logging.debug("received job: "  + str(result.value))
         return self.jobs[job_url] 
     
     def delete_job(self, job_url):
-        self.job_ids.remove(job_url)
-        del self.jobs[job_url]
-        del self.job_ids[job_url]
+        """ local only - used only by manager """
+        self.__record(message("delete_job", job_url, None))
     
     
     #####################################################################################
@@ -260,35 +595,75 @@ class bigjob_coordination(object):
     def queue_job(self, pilot_url, job_url):        
         if self.server_role == False: # just re-queue locally at client
             self.subjob_queue.put(job_url)        
-        elif self.server_role == True:
-            """ queue new job to pilot """
-            logging.debug("queue_job " + str(self.resource_lock))
-            counter = 0
-            result = None
-            success = False
-            while result ==None and counter < NUMBER_RETRIES:
-                with self.resource_lock:   
-                    msg = message("queue_job", "", job_url)
-                    try:
-                        self.client_socket.send_pyobj(msg, zmq.NOBLOCK)
-                        result = self.client_socket.recv_pyobj()
-                        success=True
-                    except:
-                        traceback.print_exc(file=sys.stderr)     
-                if result == None:
-                    counter = counter + 1
-                    logging.error("RETRY %d queue_job"%counter)
-                    if counter == NUMBER_RETRIES and success==False:
-                        self.__reset_client_socket()
-                    time.sleep(2)
-            msg2 = message("notification", "", job_url)
-            self.push_socket.send_pyobj(msg2)
-        
-        return success             
+            return True
+        """ queue new job to pilot """
+        logging.debug("queue_job " + job_url)
+        return self.__request("queue_job", "", job_url) != None
              
         
+    def queue_jobs(self, pilot_url, job_urls):
+        """ queue list of new jobs to pilot with one message and notification """
+        if self.server_role == False: # just re-queue locally at client
+            for job_url in job_urls:
+                self.subjob_queue.put(job_url)        
+            return True
+        return self.__request("queue_jobs", "", job_urls) != None
+        
+    def dequeue_job_description(self, pilot_url):
+        """ dequeue new job; returns (job_url, job description) 
+            (descriptions are pushed together with the jobs) """
+        job_url = self.dequeue_job(pilot_url)
+        return job_url, self.jobs.get(job_url)
+        
+    def requeue_job(self, pilot_url, job_url):
+        """ return dequeued job to queue (not enough resources) """
+        if self.server_role == False and self.pilot_group:
+            # return job to head of server queue => job is pushed to agents with free slots
+            if self.__request("requeue_job", pilot_url, job_url) != None:
+                return
+        self.queue_job(pilot_url, job_url)
+        
+    def join_pilot_group(self, pilot_url, group=None):
+        """ work stealing: the server queue is shared by all agents connected 
+            to the server and jobs are pushed to agents with free slots (credits). 
+            Jobs of a group member are not kept in the local queue of the agent, 
+            i.e. requeued jobs are returned to the server """
+        self.pilot_group = True
+        
+    def leave_pilot_group(self, pilot_url):
+        self.pilot_group = False
+        
+    def ack_job(self, pilot_url, job_url):
+        """ acknowledge start of dequeued job; jobs pushed to an agent, but not 
+            acknowledged are requeued after DELIVERY_TIMEOUT seconds, if the 
+            agent is not reachable anymore or if the server is restarted (state store) """
+        if self.server_role == False:
+            self.__send(message("ack_job", job_url, None))
+    
+    def requeue_expired_jobs(self, pilot_url, timeout=None):
+        """ expired jobs are requeued by the server (see DELIVERY_TIMEOUT) """
+        return 0
+        
+    def set_job_credits(self, pilot_url, credits):
+        """ number of jobs the agent can accept (e.g. free slots); up to credits 
+            jobs are pushed to the agent ahead of dequeue_job """
+        self.job_credits = credits
+        
     def dequeue_job(self, pilot_url):
-        """ dequeue to new job  of a certain pilot """
+        """ dequeue to new job  of a certain pilot 
+            jobs are pushed by the server; credits are granted to the server 
+            for the jobs still accepted by the agent
+        """
+        self.subjob_pilot_url = pilot_url
+        with self.credit_lock:
+            credits = max(self.job_credits, 1) - self.subjob_queue.qsize()
+            if credits > self.granted_credits:
+                self.granted_credits = credits
+                self.credit_time = time.time()
+            else:
+                credits = 0
+        if credits > 0 and self.__grant_credits(pilot_url, credits) == False:
+            return None
         return self.subjob_queue.get()
         
     
@@ -296,54 +671,232 @@ class bigjob_coordination(object):
     
     #####################################################################################
     # Private functions    
-    def __server_handler(self, messageList):
-        """ server for managing job / pilot job states via ZMQ """
-        msg = pickle.loads(messageList[0])
-        logging.debug("Message received: " + str(msg))
-        self.__handle_message(msg, self.stream)
-        
+    def __request(self, command, key, value):
+        """ send request to server and wait for reply 
+            Requests of different threads are in flight concurrently. A reply 
+            that is not received within REQUEST_TIMEOUT seconds is retried with 
+            a new socket (only the socket of the calling thread is reset). 
+            returns None if no reply was received after NUMBER_RETRIES attempts
+        """
+        msg = message(command, key, value)
+        for attempt in range(1, NUMBER_RETRIES+1):
+            request_id = self.__get_request_id()
+            client_socket = self.__get_client_socket()
+            try:
+                send_message(client_socket, [request_id], msg)
+                deadline = time.time() + REQUEST_TIMEOUT
+                while True:
+                    timeout = deadline - time.time()
+                    if timeout <= 0 or client_socket.poll(timeout*1000) == 0:
+                        break
+                    envelope, reply = decode_message(client_socket.recv_multipart())
+                    # replies to timed out requests are discarded
+                    if envelope == [request_id]:
+                        if reply.command == "error":
+                            return None
+                        return reply
+            except:
+                traceback.print_exc(file=sys.stderr)
+            logging.error("RETRY %d %s"%(attempt, command))
+            self.__reset_client_socket()
+        logging.error("No reply for %s (key: %s)"%(command, key))
+        return None
     
-    def __handle_message(self, msg, reply_socket):
-        try:
-            command = msg.command        
-            if command == "set_pilot_state":
-                self.pilot_states[msg.key] = msg.value
-                reply_socket.send_pyobj("SUCCESS")
-                #self.service_socket.send("")            
-            elif command == "get_pilot_state":
-                result = message ("", "", self.pilot_states[msg.key])
-                reply_socket.send_pyobj(result, zmq.NOBLOCK)                
-            elif command == "set_job_state":
-                self.job_states[msg.key] = msg.value
-                reply_socket.send_pyobj("SUCCESS", zmq.NOBLOCK)       
-            elif command == "get_job_state":
-                result=message("", "", self.job_states[msg.key])
-                reply_socket.send_pyobj(result, zmq.NOBLOCK)            
-            elif command == "get_job":
-                result = message("","", self.jobs[msg.key])
-                reply_socket.send_pyobj(result, zmq.NOBLOCK)
-            elif command == "queue_job":                
-                self.new_job_queue.put(msg.value)
-                reply_socket.send_pyobj("SUCCESS", zmq.NOBLOCK)                       
-            elif command == "dequeue_job":
-                new_job=None
-                try:
-                    new_job = self.new_job_queue.get(False)
-                except:                
-                    pass
-                result = message("","", new_job)
-                reply_socket.send_pyobj(result, zmq.NOBLOCK)
+    
+    def __grant_credits(self, pilot_url, credits):
+        """ client: server pushes up to credits jobs to the delivery socket """
+        if self.__request("request_jobs", pilot_url, [self.delivery_identity, str(credits)]) == None:
+            with self.credit_lock:
+                self.granted_credits = 0
+            return False
+        return True
+    
+    
+    def __send(self, msg):
+        """ send message to server without waiting for a reply """
+        send_message(self.__get_client_socket(), [""], msg)
+    
+    
+    def __get_request_id(self):
+        with self.request_lock:
+            self.request_counter = self.request_counter + 1
+            return str(self.request_counter)
+    
+    
+    def __get_client_socket(self):
+        """ returns DEALER socket of calling thread """
+        client_socket = getattr(self.thread_local, "client_socket", None)
+        if client_socket == None:
+            client_socket = self.context.socket(zmq.DEALER)
+            client_socket.connect(self.address)
+            self.thread_local.client_socket = client_socket
+        return client_socket
+    
+    
+    def __reset_client_socket(self):
+        """ close socket of calling thread (pending replies are dropped) """
+        client_socket = getattr(self.thread_local, "client_socket", None)
+        self.thread_local.client_socket = None
+        if client_socket != None:
+            try:
+                client_socket.setsockopt(zmq.LINGER, 0)
+                client_socket.close()
+            except:
+                traceback.print_exc(file=sys.stderr)
+    
+    
+    def __receive_all(self, zmq_socket):
+        """ returns all messages available at zmq_socket (non-blocking) """
+        messages = []
+        while True:
+            try:
+                messages.append(zmq_socket.recv_multipart(zmq.NOBLOCK))
+            except zmq.ZMQError, e:
+                if e.errno == zmq.EAGAIN:
+                    return messages
+                raise
+    
+    
+    def __handle_message(self, msg):
+        """ returns reply to msg """
+        command = msg.command        
+        if command in ["set_pilot_state", "set_job_state", "set_job_states", "queue_job", 
+                       "queue_jobs", "ack_job", "requeue_job"]:
+            self.__record(msg)
+            return "SUCCESS"
+        elif command == "get_pilot_state":
+            return message ("reply", "", self.pilot_states[msg.key])
+        elif command == "get_job_state":
+            return message("reply", "", self.job_states[msg.key])
+        elif command == "get_job":
+            return message("reply","", self.jobs[msg.key])
+        elif command == "request_jobs":
+            delivery_identity, credits = msg.value[0], int(msg.value[1])
+            for consumer in self.job_consumers:
+                if consumer[0] == delivery_identity:
+                    consumer[1] = credits
+                    break
             else:
-                logging.debug("sending default reply")
-                reply_socket.send_pyobj("", zmq.NOBLOCK)
-        except:
-            traceback.print_exc(file=sys.stderr)
+                self.job_consumers.append([delivery_identity, credits])
+            return "SUCCESS"
+        elif command == "dequeue_job":
+            new_job=None
+            try:
+                new_job = self.new_job_queue.get(False)
+                self.__record(message("job", new_job, None))
+            except Queue.Empty:                
+                pass
+            return message("reply","", new_job)
+        else:
+            logging.debug("sending default reply")
+            return ""
+    
+    
+    def __record(self, msg):
+        """ apply state change (message) and append it to the state store """
+        if self.store == None:
+            self.__apply(msg)
+            return
+        with self.store_lock:
+            self.store.append(msg)
+            self.__apply(msg)
+    
+    
+    def __apply(self, msg):
+        command = msg.command
+        if command == "set_pilot_state":
+            self.pilot_states[msg.key] = msg.value
+        elif command == "set_job_state":
+            self.job_states[msg.key] = msg.value
+        elif command == "set_job_states":
+            self.job_states.update(msg.value)
+        elif command == "set_job":
+            if not self.jobs.has_key(msg.key):
+                self.job_ids.append(msg.key)
+            self.jobs[msg.key] = msg.value
+            self.job_states[msg.key] = "Unknown"
+        elif command == "delete_job":
+            if self.jobs.has_key(msg.key):
+                self.job_ids.remove(msg.key)
+                del self.jobs[msg.key]
+            self.job_states.pop(msg.key, None)
+            self.delivered_jobs.pop(msg.key, None)
+        elif command == "queue_job":
+            self.new_job_queue.put(msg.value)
+        elif command == "queue_jobs":
+            for job_url in msg.value:
+                self.new_job_queue.put(job_url)
+        elif command == "job": # pushed to agent (value: delivery socket identity)
+            self.delivered_jobs[msg.key] = [time.time(), msg.value]
+        elif command == "ack_job":
+            self.delivered_jobs.pop(msg.key, None)
+        elif command == "requeue_job":
+            self.delivered_jobs.pop(msg.value, None)
+            self.new_job_queue.queue.appendleft(msg.value)
+        elif command == "address":
+            self.recovered_address = msg.value
+    
+    
+    def __recover(self):
+        """ server: recover state from state store """
+        for msg in self.store.load():
+            if msg.command == "job":
+                try:
+                    self.new_job_queue.queue.remove(msg.key)
+                except ValueError:
+                    pass # requeued after restart
+            self.__apply(msg)
+        # jobs pushed, but not acknowledged by the agent (e.g. lost with the 
+        # connection) are delivered again
+        self.new_job_queue.queue.extendleft(reversed(self.delivered_jobs.keys()))
+        self.delivered_jobs = {}
+        logging.debug("Recovered %d jobs (%d queued)"%(len(self.jobs), self.new_job_queue.qsize()))
+    
+    
+    def __sync_store(self):
+        """ server: flush state store; writes snapshot (compaction) if due """
+        if self.store == None:
+            return
+        with self.store_lock:
+            self.store.flush()
+            if not self.store.is_snapshot_due():
+                return
+            generation = self.store.rotate()
+            records = self.__get_snapshot_records()
+        self.store.write_snapshot(generation, records)
+    
+    
+    def __get_snapshot_records(self):
+        """ returns messages that restore the current state """
+        records = [message("set_job", job_url, self.jobs[job_url]) for job_url in self.job_ids]
+        records.append(message("set_job_states", "", self.job_states.copy()))
+        for pilot_url, pilot_state in self.pilot_states.items():
+            records.append(message("set_pilot_state", pilot_url, pilot_state))
+        delivered_jobs = self.delivered_jobs.keys()
+        records.append(message("queue_jobs", "", delivered_jobs))
+        records.extend([message("job", job_url, None) for job_url in delivered_jobs])
+        records.append(message("queue_jobs", "", list(self.new_job_queue.queue)))
+        if self.recovered_address != None:
+            records.append(message("address", "", self.recovered_address))
+        return records
     
     
     def __server(self, server, server_port):
-        """ server for managing job / pilot job states via ZMQ """
-        service_socket = self.context.socket(zmq.REP)
-        if SERVER_PORT==0: # random port
+        """ server for managing job / pilot job states via ZMQ 
+            The ROUTER socket interleaves the requests of all clients (no 
+            lock-step request/reply per client). Requests are handled in memory 
+            by this thread, i.e. without locking of the server state.
+        """
+        service_socket = self.context.socket(zmq.ROUTER)
+        if hasattr(zmq, "ROUTER_MANDATORY"): # ZMQ >= 3.2
+            # messages to unknown identities (e.g. disconnected agents) fail with 
+            # EHOSTUNREACH instead of being dropped silently
+            service_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        if self.recovered_address != None: # restart => same port
+            self.server_address = "tcp://*:" + self.recovered_address[0].split(":")[-1]
+            self.address = "tcp://"+server+":"+self.recovered_address[0].split(":")[-1]
+            service_socket.bind(self.server_address)
+        elif SERVER_PORT==0: # random port
             server_port = service_socket.bind_to_random_port("tcp://*")    
             self.address = "tcp://"+server+":"+str(server_port)                
         elif server == "localhost":
@@ -359,84 +912,126 @@ class bigjob_coordination(object):
         self.startup_condition.notifyAll()   
         self.startup_condition.release()
         logging.debug("Startup condition signaled")
+        poller = zmq.Poller()
+        poller.register(service_socket, zmq.POLLIN)
         while self.stopped == False:
-            #logging.debug("Waiting for messages...")
             try:
-                msg = service_socket.recv_pyobj()            
-                #logging.debug("Message received: " + str(msg))
-                self.__handle_message(msg, service_socket)
+                if len(poller.poll(1000)) == 0:
+                    self.__requeue_expired_jobs()
+                    self.__sync_store()
+                    continue
+                for frames in self.__receive_all(service_socket):
+                    # frames: routing envelope (client identity, proxies, request id), message
+                    envelope, msg = decode_message(frames)
+                    try:
+                        reply = self.__handle_message(msg)
+                        if not isinstance(reply, message):
+                            reply = message("reply", "", reply)
+                    except:
+                        traceback.print_exc(file=sys.stderr)
+                        reply = message("error", "", None)
+                    if envelope[-1] != "": # request id "": no reply expected
+                        try:
+                            send_message(service_socket, envelope, reply, zmq.NOBLOCK)
+                        except zmq.ZMQError, e:
+                            # client disconnected (EHOSTUNREACH) or not reading replies 
+                            # (EAGAIN) => reply is dropped, the client retries
+                            logging.warning("Reply to %s not sent: %s"%(msg.command, str(e)))
+                self.__push_jobs(service_socket)
+                self.__sync_store()
             except:
-                pass
-            #logging.debug("Message handled: " + str(msg) + " stopped = " + str(self.stopped))
-            #pdb.set_trace()
+                traceback.print_exc(file=sys.stderr)
+        if self.store != None:
+            with self.store_lock:
+                self.store.close()
         logging.debug("__server thread stopped: " + str(self.stopped))
         self.has_stopped = True
         #service_socket.close()
-            
-    def __loop(self):
-        self.loop = ioloop.IOLoop.instance()
-        #self.loop.add_handler(self.service_socket, self.__server_handler, zmq.POLLIN)
-        self.stream = zmqstream.ZMQStream(self.service_socket, self.loop)
-        self.stream.on_recv(self.__server_handler)
-        logging.debug("Start event loop")
-        self.loop.start()
         
-    def __reset_client_socket(self):
-        logging.error("RESETING client socket")
-        with self.resource_lock: 
-            try:
-                self.client_socket.close()
-            except:
-                traceback.print_exc(file=sys.stderr)
-            self.client_socket = self.context.socket(zmq.REQ)
-            self.client_socket.connect(self.address)
         
-    def __wait_for_notifications(self):
-        """ waits for notifications and puts new jobs into queue """    
-        #while result==None and counter < NUMBER_RETRIES:
+    def __push_jobs(self, service_socket):
+        """ server: push queued jobs (with description) round-robin to agents 
+            with credits. Pushed jobs are in flight until acknowledged (ack_job). 
+            Agents that are not reachable anymore are removed; their jobs are 
+            requeued. """
+        while not self.new_job_queue.empty():
+            consumers = [consumer for consumer in self.job_consumers if consumer[1] > 0]
+            if len(consumers) == 0:
+                return
+            for consumer in consumers:
+                try:
+                    job_url = self.new_job_queue.get(False)
+                except Queue.Empty:
+                    return
+                msg = message("job", job_url, self.jobs.get(job_url))
+                try:
+                    send_message(service_socket, [consumer[0]], msg, zmq.NOBLOCK)
+                except zmq.ZMQError, e:
+                    # job was not sent => back to the head of the queue
+                    self.new_job_queue.queue.appendleft(job_url)
+                    if e.errno != zmq.EHOSTUNREACH:
+                        return # EAGAIN: agent does not receive => push later
+                    logging.warning("Agent %s not reachable: removed from consumers"%consumer[0])
+                    self.job_consumers.remove(consumer)
+                    self.__requeue_jobs_of_consumer(consumer[0])
+                    break
+                consumer[1] = consumer[1] - 1
+                self.__record(message("job", job_url, consumer[0]))
+        
+        
+    def __requeue_jobs_of_consumer(self, delivery_identity):
+        """ server: requeue jobs pushed to agent, but not acknowledged """
+        for job_url, delivery in self.delivered_jobs.items():
+            if delivery[1] == delivery_identity:
+                self.__record(message("requeue_job", "", job_url))
+        
+        
+    def __requeue_expired_jobs(self):
+        """ server: requeue jobs not acknowledged within DELIVERY_TIMEOUT seconds 
+            jobs that were started already (ack lost) are not requeued """
+        expiry_time = time.time() - DELIVERY_TIMEOUT
+        for job_url, delivery in self.delivered_jobs.items():
+            if delivery[0] >= expiry_time:
+                continue
+            state = self.job_states.get(job_url)
+            if state==None or state=="Unknown" or state=="New":
+                logging.debug("Requeue expired job: " + job_url)
+                self.__record(message("requeue_job", "", job_url))
+            else:
+                self.__record(message("ack_job", job_url, None))
+        
+        
+    def __receive_jobs(self):
+        """ client: receives jobs pushed by the server and puts them into queue """    
+        poller = zmq.Poller()
+        poller.register(self.delivery_socket, zmq.POLLIN)
         while self.stopped == False:
-            # read object from queue
-            logging.debug(" __wait_for_notifications: polling for new jobs - stopped: " + str(self.stopped))
-            msg = message ("dequeue_job", self.pilot_url, "")
             try:
-                with self.resource_lock: 
-                    self.client_socket.send_pyobj(msg, zmq.NOBLOCK)
-                    result = self.client_socket.recv_pyobj().value
-                logging.debug(" __wait_for_notifications: received new jobs " + str(result))
-                if result != None:
-                    self.subjob_queue.put(result)
-                    time.sleep(0.2)
-                    continue                                              
+                if len(poller.poll(1000)) == 0:
+                    # no jobs although credits were granted (e.g. server restarted 
+                    # or busy) => grant credits again
+                    with self.credit_lock:
+                        credits = self.granted_credits
+                        if time.time() - self.credit_time < REQUEST_TIMEOUT:
+                            credits = 0
+                        else:
+                            self.credit_time = time.time()
+                    if credits > 0:
+                        self.__grant_credits(self.subjob_pilot_url, credits)
+                    continue
+                for frames in self.__receive_all(self.delivery_socket):
+                    envelope, msg = decode_message(frames)
+                    logging.debug("__receive_jobs: received job " + str(msg.key))
+                    if msg.value != None:
+                        self.jobs[msg.key] = msg.value
+                    with self.credit_lock:
+                        self.granted_credits = max(self.granted_credits - 1, 0)
+                        self.credit_time = time.time()
+                    self.subjob_queue.put(msg.key)
             except:                
                 traceback.print_exc(file=sys.stderr)                    
-                logging.error("Error dequeuing job")                  
+                logging.error("Error receiving jobs")                  
                 time.sleep(1)
-                continue   
-            logging.debug(" __wait_for_notifications: End Loop - stopped " + str(self.stopped))
-                
-            #if counter == NUMBER_RETRIES-1 and success == False:
-            #    self.__reset_client_socket()              
-            #    time.sleep(2)
-            #    continue # retry
-            
-            #if counter == NUMBER_RETRIES and success == False:
-            #    return result
-            
-            logging.debug(" __wait_for_notifications: wait for notification")
-            # wait for next job notification
-            if result == None:
-                try:
-                    logging.debug("wait for notification")
-                    self.pull_socket.recv_pyobj()
-                    logging.debug("received notification")
-                except:
-                    pass
-        
-        # wait for next job notification
-        #while self.stopped == False:
-        #    logging.debug("wait for notification")
-        #    self.pull_socket.recv_pyobj()
-        #    logging.debug("received notification")
             
     def __shutdown(self):
         logging.debug("shutdown ZMQ")
@@ -0,0 +1,74 @@
+""" Benchmark of the import time of the bigjob agent
+
+    Imports bigjob.bigjob_agent (as done by the bootstrap script of the agent)
+    in a new Python process NUMBER_RUNS times and reports the median import
+    time. One additional run reports the modules imported by the agent with
+    self and cumulative import time (format of python -X importtime, which is
+    not available in Python 2): __import__ is replaced by a timing wrapper.
+
+    Usage: python benchmark_agent_import.py [number of runs] [module]
+"""
+import os
+import sys
+import subprocess
+
+ROOT_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+NUMBER_RUNS=10
+MODULE="bigjob.bigjob_agent"
+# number of modules with the highest cumulative import time listed
+NUMBER_MODULES=15
+
+TIMING_SCRIPT="""
+import sys, time
+start = time.time()
+import %s
+print "%%.6f"%%(time.time() - start)
+"""
+
+PROFILE_SCRIPT="""
+import sys, time, __builtin__
+original_import = __builtin__.__import__
+stack = [[0.0]]
+times = []
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return original_import(name, *args, **kwargs)
+    stack.append([0.0])
+    start = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        cumulative = time.time() - start
+        children = stack.pop()[0]
+        stack[-1][0] = stack[-1][0] + cumulative
+        times.append((cumulative, cumulative - children, name))
+__builtin__.__import__ = timed_import
+import %s
+__builtin__.__import__ = original_import
+for cumulative, self_time, name in sorted(times, reverse=True)[:%d]:
+    print "%%10d | %%10d | %%s"%%(self_time*1000000, cumulative*1000000, name)
+"""
+
+
+def run(script):
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.path.abspath(ROOT_DIR) + os.pathsep + environment.get("PYTHONPATH", "")
+    process = subprocess.Popen([sys.executable, "-c", script], cwd=os.path.abspath(ROOT_DIR), env=environment,
+                               stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise Exception("Import failed (exit code %d)"%process.returncode)
+    return output
+
+
+if __name__ == "__main__":
+    number_runs = NUMBER_RUNS
+    module = MODULE
+    if len(sys.argv)>1:
+        number_runs = int(sys.argv[1])
+    if len(sys.argv)>2:
+        module = sys.argv[2]
+    times = sorted([float(run(TIMING_SCRIPT%module)) for i in range(0, number_runs)])
+    print "import %s: %.1f ms (median of %d runs)"%(module, times[len(times)/2]*1000, number_runs)
+    print "%10s | %10s | %s"%("self [us]", "cumulative", "imported module")
+    sys.stdout.write(run(PROFILE_SCRIPT%(module, NUMBER_MODULES)))
@@ -0,0 +1,86 @@
+""" Benchmark of the sub-job dispatch latency of the BigJob agent
+
+    Measures 
+        - the time from submission of a sub-job (add_subjob) to state Running
+        - the time from process exit to state Done
+    
+    Requires a Redis server running at localhost (stand-in for the 
+    coordination server), e.g. started with: redis-server --port 6379
+    
+    Usage: python benchmark_agent_latency.py [number of sub-jobs] 
+"""
+import os
+import sys
+import time
+import uuid
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+COORDINATION_URL = "redis://localhost:6379"
+NUMBER_JOBS=100
+
+from bigjob.bigjob_agent import bigjob_agent
+from coordination.bigjob_coordination_redis import bigjob_coordination
+from bigjob import job_description_codec
+
+
+def print_stats(description, values):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return
+    mean = sum(values)/n
+    print "%s: mean: %.4f s median: %.4f s min: %.4f s max: %.4f s"%(description, mean, values[n/2], values[0], values[-1])
+
+
+def main():
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    
+    coordination = bigjob_coordination(server_connect_url=COORDINATION_URL)
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    coordination.set_pilot_state(pilot_url, "Unknown", False)
+    
+    agent_thread = threading.Thread(target=bigjob_agent, 
+                                    args=(["bigjob_agent.py", COORDINATION_URL, pilot_url],))
+    agent_thread.daemon=True
+    agent_thread.start()
+    
+    submit_to_running = []
+    exit_to_done = []
+    for i in range(0, number_jobs):
+        job_id = "sj-" + str(uuid.uuid1())
+        job_url = pilot_url + ":jobs:" + job_id
+        job_dict = {"Executable": "/bin/date", "Arguments": ["+%s.%N"], 
+                    "NumberOfProcesses": "1", "Output": "stdout.txt",
+                    "state": "Unknown", "job-id": job_id}
+        start = time.time()
+        # equivalent to bigjob.add_subjob
+        coordination.set_job(job_url, job_description_codec.encode(job_dict))
+        coordination.queue_job(pilot_url, job_url)
+        running = None
+        state = None
+        while state != "Done" and state != "Failed":
+            state = coordination.get_job_state(job_url)
+            if running == None and state != "Unknown" and state != "New":
+                running = time.time()
+            time.sleep(0.001)
+        done = time.time()
+        submit_to_running.append(running - start)
+        # the sub-job prints its exit time to stdout
+        output = os.path.join(os.getcwd(), job_id, "stdout.txt")
+        exit_time = float(open(output).read().strip())
+        exit_to_done.append(done - exit_time)
+    
+    print_stats("add_subjob -> Running", submit_to_running)
+    print_stats("process exit -> Done", exit_to_done)
+    
+    coordination.set_pilot_state(pilot_url, "Done", True)
+    coordination.queue_job(pilot_url, "STOP")
+    coordination.delete_pilot(pilot_url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+""" Benchmark of encoding/decoding of sub-job descriptions
+
+    Compares the versioned JSON codec (job_description_codec) with the 
+    legacy representation (Redis hash w/ vector attributes flattened to their
+    Python representation and parsed with eval() by the agent).
+    
+    Usage: python benchmark_job_description_codec.py [number of descriptions] 
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "bigjob"))
+
+import job_description_codec
+
+NUMBER_DESCRIPTIONS=1000000
+
+
+def create_job_dict(i):
+    return {"Executable": "/bin/date", "Arguments": ["-u", "+%s", str(i)],
+            "Environment": ["FOO=bar", "NUMBER=%d"%i],
+            "NumberOfProcesses": "1", "SPMDVariation": "single", 
+            "Output": "stdout.txt", "Error": "stderr.txt",
+            "state": "Unknown", "job-id": "sj-%d"%i}
+
+
+def benchmark_codec(job_dict, number):
+    start = time.time()
+    for i in xrange(number):
+        stored = job_description_codec.encode(job_dict)
+    encode_time = time.time() - start
+    start = time.time()
+    for i in xrange(number):
+        job_description_codec.decode(stored)
+    decode_time = time.time() - start
+    return encode_time, decode_time
+
+
+def benchmark_legacy(job_dict, number):
+    start = time.time()
+    for i in xrange(number):
+        # redis-py flattens all values to strings
+        stored = dict([(k, str(v)) for k, v in job_dict.items()])
+    encode_time = time.time() - start
+    start = time.time()
+    for i in xrange(number):
+        decoded = dict(stored)
+        decoded["Arguments"] = eval(stored["Arguments"])
+        decoded["Environment"] = eval(stored["Environment"])
+    decode_time = time.time() - start
+    return encode_time, decode_time
+
+
+if __name__ == "__main__":
+    number = NUMBER_DESCRIPTIONS
+    if len(sys.argv)>1:
+        number = int(sys.argv[1])
+    job_dict = create_job_dict(0)
+    for name, benchmark in [("codec", benchmark_codec), ("legacy", benchmark_legacy)]:
+        encode_time, decode_time = benchmark(job_dict, number)
+        print "%-6s %d descriptions: encode: %.2f s (%.2f us/description) decode: %.2f s (%.2f us/description)"%(
+               name, number, encode_time, encode_time*1e6/number, decode_time, decode_time*1e6/number)
@@ -0,0 +1,81 @@
+""" Benchmark of the sub-job launch rate (tasks/s) for /bin/true workloads
+
+    Compares
+        - shell: launch via /bin/bash with a command string (legacy agent path)
+        - direct: direct execution of the argv list (w/o shell)
+        - launcher: launch via a persistent launcher daemon 
+                    (started locally, i.e. w/o ssh)
+    
+    Usage: python benchmark_launch.py [number of tasks] 
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "bigjob"))
+
+from bigjob_launcher import launcher_client
+
+NUMBER_TASKS=1000
+
+
+def benchmark_shell(number_tasks, working_directory):
+    environment = os.environ.copy()
+    start = time.time()
+    processes = []
+    for i in range(0, number_tasks):
+        stdout = open(os.path.join(working_directory, "stdout"), "w")
+        command = "cd " + working_directory + "; export BENCHMARK=1; /bin/true"
+        processes.append(subprocess.Popen(args=command, executable="/bin/bash", stdout=stdout, 
+                                          stderr=subprocess.STDOUT, cwd=working_directory, 
+                                          env=environment, shell=True))
+        stdout.close()
+    for p in processes:
+        p.wait()
+    return time.time() - start
+
+
+def benchmark_direct(number_tasks, working_directory):
+    environment = os.environ.copy()
+    environment["BENCHMARK"] = "1"
+    start = time.time()
+    processes = []
+    for i in range(0, number_tasks):
+        stdout = open(os.path.join(working_directory, "stdout"), "w")
+        processes.append(subprocess.Popen(args=["/bin/true"], stdout=stdout, stderr=subprocess.STDOUT,
+                                          cwd=working_directory, env=environment))
+        stdout.close()
+    for p in processes:
+        p.wait()
+    return time.time() - start
+
+
+def benchmark_launcher(number_tasks, working_directory):
+    finished = threading.Event()
+    counter = [0]
+    def exit_callback(job_url, p):
+        counter[0] = counter[0] + 1
+        if counter[0] == number_tasks:
+            finished.set()
+    launcher = launcher_client(None, exit_callback)
+    output = os.path.join(working_directory, "stdout")
+    start = time.time()
+    for i in range(0, number_tasks):
+        launcher.launch(str(i), ["/bin/true"], {"BENCHMARK":"1"}, working_directory, output, output)
+    finished.wait()
+    runtime = time.time() - start
+    launcher.close()
+    return runtime
+
+
+if __name__ == "__main__":
+    number_tasks = NUMBER_TASKS
+    if len(sys.argv)>1:
+        number_tasks = int(sys.argv[1])
+    working_directory = os.getcwd()
+    for name, benchmark in [("shell", benchmark_shell), ("direct", benchmark_direct), 
+                            ("launcher", benchmark_launcher)]:
+        runtime = benchmark(number_tasks, working_directory)
+        print "%-8s %d tasks in %.2f s => %.1f tasks/s"%(name, number_tasks, runtime, number_tasks/runtime)
@@ -0,0 +1,73 @@
+""" Benchmark of the Redis latency while a pilot with many sub-jobs is deleted
+
+    Creates a pilot with N sub-jobs (descriptions, queue entries and state 
+    changes) and measures the latency of PING commands issued by a second 
+    client while delete_pilot removes the pilot.
+    
+    Requires a Redis server running at localhost, e.g. started with: 
+    redis-server --port 6379
+    
+    Usage: python benchmark_redis_cleanup.py [number of sub-jobs] 
+"""
+import os
+import sys
+import time
+import uuid
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+COORDINATION_URL = "redis://localhost:6379"
+NUMBER_JOBS=100000
+BATCH_SIZE=1000
+
+from coordination.bigjob_coordination_redis import bigjob_coordination
+from bigjob import job_description_codec
+
+
+def create_pilot(coordination, number_jobs):
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    coordination.set_pilot_state(pilot_url, "Running", False)
+    for i in range(0, number_jobs, BATCH_SIZE):
+        jobs = []
+        for j in range(i, min(i+BATCH_SIZE, number_jobs)):
+            job_id = "sj-" + str(j)
+            job_dict = {"Executable": "/bin/true", "Arguments": [""], "NumberOfProcesses": "1",
+                        "state": "Unknown", "job-id": job_id}
+            jobs.append((pilot_url + ":jobs:" + job_id, job_description_codec.encode(job_dict)))
+        coordination.set_jobs(jobs)
+        coordination.queue_jobs(pilot_url, [job[0] for job in jobs])
+        coordination.set_job_states(dict([(job[0], "Done") for job in jobs]))
+    return pilot_url
+
+
+def measure_latency(coordination, stop, latencies):
+    while not stop.isSet():
+        start = time.time()
+        coordination.redis.ping()
+        latencies.append(time.time() - start)
+        time.sleep(0.001)
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    coordination = bigjob_coordination(server_connect_url=COORDINATION_URL)
+    pilot_url = create_pilot(coordination, number_jobs)
+    print "Created pilot with %d sub-jobs"%len(coordination.get_jobs_of_pilot(pilot_url))
+    
+    latencies = []
+    stop = threading.Event()
+    thread = threading.Thread(target=measure_latency, 
+                              args=(bigjob_coordination(server_connect_url=COORDINATION_URL), stop, latencies))
+    thread.start()
+    start = time.time()
+    coordination.delete_pilot(pilot_url)
+    runtime = time.time() - start
+    stop.set()
+    thread.join()
+    latencies.sort()
+    print "delete_pilot: %.2f s"%runtime
+    print "PING latency during delete: median %.2f ms, 99%%: %.2f ms, max %.2f ms"%(
+        latencies[len(latencies)/2]*1000, latencies[int(len(latencies)*0.99)]*1000, latencies[-1]*1000)
@@ -0,0 +1,85 @@
+""" Benchmark of the sub-job dispatch throughput (tasks/s) of the Redis queue
+
+    Compares the plain queue (BRPOP) with the reliable queue (BRPOPLPUSH
+    into a processing list + ack_job per sub-job, sent with the batched state 
+    updates of the agent) and checks that sub-jobs
+    dequeued by a "crashed" agent (no ack) are requeued by
+    requeue_expired_jobs.
+
+    Requires a Redis server running at localhost, e.g. started with:
+    redis-server --port 6379
+
+    Usage: python benchmark_redis_queue.py [number of sub-jobs]
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+COORDINATION_URL = "redis://localhost:6379"
+NUMBER_JOBS=10000
+# modes are measured alternately; the median of NUMBER_ROUNDS runs is reported
+NUMBER_ROUNDS=5
+
+from coordination.bigjob_coordination_redis import bigjob_coordination
+from bigjob.job_state_buffer import job_state_buffer
+
+
+def queue_jobs(coordination, number_jobs):
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    job_urls = [pilot_url + ":jobs:sj-" + str(i) for i in range(0, number_jobs)]
+    coordination.queue_jobs(pilot_url, job_urls)
+    return pilot_url, job_urls
+
+
+def benchmark_dispatch(coordination, number_jobs, reliable_queue):
+    """ dequeue loop of the agent: state update (Running) and ack of every 
+        sub-job are batched by the job_state_buffer of the agent """
+    coordination.reliable_queue = reliable_queue
+    pilot_url, job_urls = queue_jobs(coordination, number_jobs)
+    job_states = job_state_buffer(coordination)
+    start = time.time()
+    for i in range(0, number_jobs):
+        job_url = coordination.dequeue_job(pilot_url)
+        job_states.set_job_state(job_url, "Running")
+        job_states.ack_job(pilot_url, job_url)
+    job_states.close()
+    runtime = time.time() - start
+    if reliable_queue:
+        assert coordination.redis.llen(pilot_url + ":queue:processing:" + coordination.consumer_id) == 0
+    coordination.delete_pilot(pilot_url)
+    return runtime
+
+
+def check_recovery(coordination, number_jobs):
+    """ dequeue jobs without ack (agent crash) and requeue them """
+    coordination.reliable_queue = True
+    pilot_url, job_urls = queue_jobs(coordination, number_jobs)
+    for i in range(0, number_jobs):
+        coordination.dequeue_job(pilot_url)
+    # first call records the dequeue time, second call requeues
+    coordination.requeue_expired_jobs(pilot_url, 0)
+    time.sleep(0.01)
+    number_requeued = coordination.requeue_expired_jobs(pilot_url, 0)
+    requeued = [coordination.dequeue_job(pilot_url) for i in range(0, number_requeued)]
+    coordination.delete_pilot(pilot_url)
+    return number_requeued, requeued==job_urls
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    coordination = bigjob_coordination(server_connect_url=COORDINATION_URL)
+    runtimes = {False:[], True:[]}
+    for i in range(0, NUMBER_ROUNDS):
+        for reliable_queue in [False, True]:
+            runtimes[reliable_queue].append(benchmark_dispatch(coordination, number_jobs, reliable_queue))
+    runtime = sorted(runtimes[False])[NUMBER_ROUNDS/2]
+    print "BRPOP:            %d sub-jobs in %.2f s => %.1f tasks/s"%(number_jobs, runtime, number_jobs/runtime)
+    runtime = sorted(runtimes[True])[NUMBER_ROUNDS/2]
+    print "BRPOPLPUSH + ack: %d sub-jobs in %.2f s => %.1f tasks/s"%(number_jobs, runtime, number_jobs/runtime)
+    number_requeued, in_order = check_recovery(coordination, 1000)
+    print "Requeued %d of 1000 unacknowledged sub-jobs (FIFO order preserved: %s)"%(number_requeued, in_order)
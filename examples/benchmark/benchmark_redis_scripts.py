@@ -0,0 +1,75 @@
+""" Benchmark of the per sub-job round-trips to the Redis coordination server
+
+    Compares
+    - submission: set_job + queue_job vs. submit_job (one transaction)
+    - dispatch: dequeue_job + get_job + set_job_state(New) vs. 
+      dequeue_job_description (one server side script, Redis >= 2.6)
+    
+    Round-trips dominate if the coordination server is far from the cluster; 
+    e.g. add WAN latency to the loopback interface with:
+    tc qdisc add dev lo root netem delay 10ms
+    
+    Requires a Redis server running at localhost, e.g. started with: 
+    redis-server --port 6379
+    
+    Usage: python benchmark_redis_scripts.py [number of sub-jobs] 
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+COORDINATION_URL = "redis://localhost:6379"
+NUMBER_JOBS=1000
+
+from coordination.bigjob_coordination_redis import bigjob_coordination
+from bigjob import job_description_codec
+
+
+def create_jobs(pilot_url, number_jobs):
+    jobs = []
+    for i in range(0, number_jobs):
+        job_id = "sj-" + str(uuid.uuid1())
+        job_dict = {"Executable": "/bin/true", "Arguments": [""], "NumberOfProcesses": "1",
+                    "state": "Unknown", "job-id": job_id}
+        jobs.append((pilot_url + ":jobs:" + job_id, job_description_codec.encode(job_dict)))
+    return jobs
+
+
+def benchmark(coordination, number_jobs, compound):
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    jobs = create_jobs(pilot_url, number_jobs)
+    start = time.time()
+    for job_url, job_dict in jobs:
+        if compound:
+            coordination.submit_job(pilot_url, job_url, job_dict)
+        else:
+            coordination.set_job(job_url, job_dict)
+            coordination.queue_job(pilot_url, job_url)
+    submission_time = time.time() - start
+    start = time.time()
+    for i in range(0, number_jobs):
+        if compound:
+            job_url, job_dict = coordination.dequeue_job_description(pilot_url)
+        else:
+            job_url = coordination.dequeue_job(pilot_url)
+            job_dict = coordination.get_job(job_url)
+            coordination.set_job_state(job_url, "New")
+        coordination.ack_job(pilot_url, job_url)
+    dispatch_time = time.time() - start
+    coordination.delete_pilot(pilot_url)
+    return submission_time, dispatch_time
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    coordination = bigjob_coordination(server_connect_url=COORDINATION_URL)
+    for compound, name in [(False, "separate commands"), (True, "transaction/script")]:
+        submission_time, dispatch_time = benchmark(coordination, number_jobs, compound)
+        print "%-20s submission: %.1f tasks/s (%.2f ms/task) dispatch: %.1f tasks/s (%.2f ms/task)"%(
+            name, number_jobs/submission_time, submission_time*1000/number_jobs,
+            number_jobs/dispatch_time, dispatch_time*1000/number_jobs)
@@ -0,0 +1,111 @@
+""" Micro-benchmark of the slot allocation of the BigJob agent
+
+    Creates a PBS-style node file with 10k cores (625 nodes with 16 cores),
+    initializes the slot allocator from it and measures the cost of 
+    allocating and freeing slots for different placement policies. 
+    For comparison the list-based allocation used by earlier versions of the 
+    agent is measured as well.
+    
+    Usage: python benchmark_slot_allocator.py [number of nodes] [cores per node]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from bigjob.slot_allocator import slot_allocator, PACK, SPREAD
+
+NUMBER_NODES=625
+CORES_PER_NODE=16
+
+
+def write_nodefile(number_nodes, cores_per_node):
+    fd, nodefile = tempfile.mkstemp(prefix="bigjob-nodefile-")
+    f = os.fdopen(fd, "w")
+    for i in range(0, number_nodes):
+        for j in range(0, cores_per_node):
+            f.write("node%04d\n"%i)
+    f.close()
+    return nodefile
+
+
+def read_nodefile(nodefile, policy):
+    slots = slot_allocator(policy)
+    node_dict = {}
+    for i in open(nodefile).readlines():
+        node_dict[i.strip()] = node_dict.get(i.strip(), 0) + 1
+    for i in node_dict.keys():
+        slots.add_host(i, node_dict[i])
+    return slots
+
+
+def benchmark_allocator(nodefile, policy, job_size, whole_node=False):
+    slots = read_nodefile(nodefile, policy)
+    allocations = []
+    start = time.time()
+    while True:
+        nodes = slots.allocate(job_size, whole_node)
+        if nodes == None:
+            break
+        allocations.append(nodes)
+    allocate_time = time.time() - start
+    start = time.time()
+    for i in allocations:
+        slots.release(i)
+    free_time = time.time() - start
+    print "%-10s job size: %4d #allocations: %5d allocate: %8.2f us/job free: %8.2f us/job"%(
+           policy + (whole_node and "+whole" or ""), job_size, len(allocations),
+           allocate_time*1e6/len(allocations), free_time*1e6/len(allocations))
+
+
+def benchmark_legacy(nodefile, job_size):
+    """ list-based allocation of earlier agent versions (w/o logging) """
+    freenodes = open(nodefile).readlines()
+    busynodes = []
+    allocations = []
+    start = time.time()
+    while len(freenodes)>=job_size:
+        number_nodes = job_size
+        nodes = []
+        for i in set(freenodes):
+            number = freenodes.count(i)
+            for j in range(0, number):
+                if number_nodes > 0:
+                    nodes.append(i)
+                    freenodes.remove(i)
+                    busynodes.append(i)
+                    number_nodes = number_nodes - 1
+                else:
+                    break
+        allocations.append(nodes)
+    allocate_time = time.time() - start
+    start = time.time()
+    for nodes in allocations:
+        for i in nodes:
+            busynodes.remove(i)
+            freenodes.append(i)
+    free_time = time.time() - start
+    print "%-10s job size: %4d #allocations: %5d allocate: %8.2f us/job free: %8.2f us/job"%(
+           "legacy", job_size, len(allocations),
+           allocate_time*1e6/len(allocations), free_time*1e6/len(allocations))
+
+
+if __name__ == "__main__":
+    number_nodes = NUMBER_NODES
+    cores_per_node = CORES_PER_NODE
+    if len(sys.argv)>2:
+        number_nodes = int(sys.argv[1])
+        cores_per_node = int(sys.argv[2])
+    nodefile = write_nodefile(number_nodes, cores_per_node)
+    print "Nodefile: %s (%d cores)"%(nodefile, number_nodes*cores_per_node)
+    try:
+        for job_size in [1, 16, 64]:
+            benchmark_allocator(nodefile, PACK, job_size)
+            benchmark_allocator(nodefile, SPREAD, job_size)
+            benchmark_allocator(nodefile, PACK, job_size, True)
+        # legacy allocation is O(slots^2) => use large sub-jobs only
+        benchmark_legacy(nodefile, 64)
+    finally:
+        os.remove(nodefile)
@@ -0,0 +1,117 @@
+""" Benchmark of the SQLite coordination backend against the Redis backend
+
+    For every backend:
+    1. submission: sub-jobs/s written by submit_jobs (batches of BATCH_SIZE)
+    2. dispatch: sub-jobs/s dequeued by an agent client (dequeue_job_description,
+       set_job_state Running/Done, ack_job) while the manager client consumes
+       the state changes
+    3. state updates/s of NUMBER_THREADS agent threads calling set_job_state
+
+    SQLite is measured with WAL journal (single host) and with rollback journal
+    (journal_mode=delete, shared file systems). The Redis backend is skipped if
+    no Redis server is running at localhost, e.g. started with:
+    redis-server --port 6379
+
+    Usage: python benchmark_sqlite_coordination.py [number of sub-jobs] [duration in sec]
+"""
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+REDIS_URL="redis://localhost:6379"
+NUMBER_JOBS=5000
+BATCH_SIZE=500
+DURATION=5
+NUMBER_THREADS=8
+JOB_DICT={"jd":"v1:{\"Executable\":\"/bin/date\",\"NumberOfProcesses\":\"1\"}", "state":"Unknown"}
+
+from coordination import bigjob_coordination_sqlite
+
+
+def benchmark_submission(coordination, pilot_url, number_jobs):
+    jobs = [(pilot_url + ":jobs:sj-%d"%i, dict(JOB_DICT)) for i in range(0, number_jobs)]
+    start = time.time()
+    for i in range(0, number_jobs, BATCH_SIZE):
+        coordination.submit_jobs(pilot_url, jobs[i:i+BATCH_SIZE])
+    return number_jobs/(time.time() - start)
+
+
+def consume_state_changes(coordination, pilot_url, number_changes):
+    received = 0
+    while received < number_changes:
+        received = received + len(coordination.get_job_state_changes(pilot_url, 1))
+
+
+def benchmark_dispatch(manager, agent, pilot_url, number_jobs):
+    monitor = threading.Thread(target=consume_state_changes, args=(manager, pilot_url, 3*number_jobs))
+    start = time.time()
+    monitor.start()
+    for i in range(0, number_jobs):
+        job_url, job_dict = agent.dequeue_job_description(pilot_url)
+        agent.set_job_state(job_url, "Running")
+        agent.ack_job(pilot_url, job_url)
+        agent.set_job_state(job_url, "Done")
+    monitor.join()
+    return number_jobs/(time.time() - start)
+
+
+def update_states(coordination, job_url, stop, counts):
+    count = 0
+    while not stop.isSet():
+        coordination.set_job_state(job_url, "Running")
+        count = count + 1
+    counts[job_url] = count
+
+
+def benchmark_updates(agent, pilot_url, duration):
+    stop = threading.Event()
+    counts = {}
+    threads = [threading.Thread(target=update_states, args=(agent, pilot_url + ":jobs:sj-%d"%i, stop, counts))
+               for i in range(0, NUMBER_THREADS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts.values())/float(duration)
+
+
+def benchmark(name, coordination_class, url, number_jobs, duration):
+    manager = coordination_class(server_connect_url=url)
+    agent = coordination_class(server_connect_url=manager.get_address())
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    submission = benchmark_submission(manager, pilot_url, number_jobs)
+    dispatch = benchmark_dispatch(manager, agent, pilot_url, number_jobs)
+    updates = benchmark_updates(agent, pilot_url, duration)
+    manager.delete_pilot(pilot_url)
+    print "%-16s %12.1f %12.1f %12.1f"%(name, submission, dispatch, updates)
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    duration = DURATION
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    if len(sys.argv)>2:
+        duration = float(sys.argv[2])
+    print "%-16s %12s %12s %12s"%("backend", "submit/s", "dispatch/s", "updates/s")
+    try:
+        from coordination import bigjob_coordination_redis
+        benchmark("redis", bigjob_coordination_redis.bigjob_coordination, REDIS_URL, number_jobs, duration)
+    except Exception, e:
+        print "%-16s skipped (%s)"%("redis", str(e))
+    directory = tempfile.mkdtemp()
+    try:
+        benchmark("sqlite (wal)", bigjob_coordination_sqlite.bigjob_coordination,
+                  "sqlite://" + os.path.join(directory, "wal.db"), number_jobs, duration)
+        benchmark("sqlite (delete)", bigjob_coordination_sqlite.bigjob_coordination,
+                  "sqlite://" + os.path.join(directory, "delete.db") + "?journal_mode=delete", number_jobs, duration)
+    finally:
+        shutil.rmtree(directory)
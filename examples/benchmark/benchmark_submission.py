@@ -0,0 +1,70 @@
+""" Benchmark of the sub-job submission throughput (tasks/s)
+
+    Compares the per sub-job submission path (submit_job per sub-job, as 
+    used by bigjob.add_subjob) with the bulk submission path (submit_jobs 
+    per batch of BATCH_SIZE sub-jobs, as used by bigjob.add_subjobs).
+    
+    Requires a Redis server running at localhost (stand-in for the 
+    coordination server), e.g. started with: redis-server --port 6379
+    
+    Usage: python benchmark_submission.py [number of sub-jobs] 
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+COORDINATION_URL = "redis://localhost:6379"
+NUMBER_JOBS=10000
+# batch size of bigjob.add_subjobs (SUBMISSION_BATCH_SIZE of bigjob_manager)
+BATCH_SIZE=1000
+
+from coordination.bigjob_coordination_redis import bigjob_coordination
+from bigjob import job_description_codec
+
+
+def create_jobs(pilot_url, number_jobs):
+    jobs = []
+    for i in range(0, number_jobs):
+        job_id = "sj-" + str(uuid.uuid1())
+        job_dict = {"Executable": "/bin/true", "Arguments": [""], 
+                    "NumberOfProcesses": "1", "SPMDVariation": "single",
+                    "Output": "stdout.txt", "Error": "stderr.txt",
+                    "state": "Unknown", "job-id": job_id}
+        jobs.append((pilot_url + ":jobs:" + job_id, job_description_codec.encode(job_dict)))
+    return jobs
+
+
+def benchmark_single(coordination, number_jobs):
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    jobs = create_jobs(pilot_url, number_jobs)
+    start = time.time()
+    for job_url, job_dict in jobs:
+        coordination.submit_job(pilot_url, job_url, job_dict)
+    runtime = time.time() - start
+    coordination.delete_pilot(pilot_url)
+    return runtime
+
+
+def benchmark_bulk(coordination, number_jobs):
+    pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+    jobs = create_jobs(pilot_url, number_jobs)
+    start = time.time()
+    for i in range(0, len(jobs), BATCH_SIZE):
+        coordination.submit_jobs(pilot_url, jobs[i:i+BATCH_SIZE])
+    runtime = time.time() - start
+    coordination.delete_pilot(pilot_url)
+    return runtime
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    coordination = bigjob_coordination(server_connect_url=COORDINATION_URL)
+    runtime = benchmark_single(coordination, number_jobs)
+    print "add_subjob:  %d sub-jobs in %.2f s => %.1f tasks/s"%(number_jobs, runtime, number_jobs/runtime)
+    runtime = benchmark_bulk(coordination, number_jobs)
+    print "add_subjobs: %d sub-jobs in %.2f s => %.1f tasks/s"%(number_jobs, runtime, number_jobs/runtime)
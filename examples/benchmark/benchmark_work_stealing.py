@@ -0,0 +1,97 @@
+""" Simulation of work stealing across pilots (Redis coordination backend)
+
+    NUMBER_PILOTS simulated agents with NUMBER_SLOTS slots each (one thread
+    per slot, sub-jobs "run" by sleeping for their duration) share one Redis
+    server. Sub-jobs are bound to a pilot at submission: every pilot receives
+    the same number of sub-jobs, but of a different type, i.e. with different
+    durations (heterogeneous workload). The makespan is measured with
+    static binding and with work stealing (join_pilot_group) and compared
+    to the lower bound (total duration / number of slots).
+
+    Requires a Redis server (>= 2.6) running at localhost, e.g. started with:
+    redis-server --port 6379
+
+    Usage: python benchmark_work_stealing.py [number of sub-jobs per pilot]
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+COORDINATION_URL = "redis://localhost:6379"
+NUMBER_PILOTS=4
+NUMBER_SLOTS=4
+NUMBER_JOBS=40
+# mean duration (in sec) of the sub-jobs of pilot i
+MEAN_DURATIONS=[0.05, 0.1, 0.2, 0.4]
+
+from coordination.bigjob_coordination_redis import bigjob_coordination
+
+
+def create_jobs(number_jobs):
+    """ returns list with (pilot index, durations) """
+    random.seed(1)
+    jobs = []
+    for i in range(0, NUMBER_PILOTS):
+        mean = MEAN_DURATIONS[i % len(MEAN_DURATIONS)]
+        jobs.append((i, [random.lognormvariate(0, 0.5)*mean for j in range(0, number_jobs)]))
+    return jobs
+
+
+def run_slot(coordination, pilot_url, done, counter):
+    while not done.isSet():
+        job_url, job_dict = coordination.dequeue_job_description(pilot_url)
+        if job_url == None:
+            continue
+        time.sleep(float(job_dict["duration"]))
+        coordination.set_job_state(job_url, "Done")
+        coordination.ack_job(pilot_url, job_url)
+        counter.acquire()
+        counter.count = counter.count + 1
+        if counter.count == counter.total:
+            done.set()
+        counter.release()
+
+
+def simulate(jobs, work_stealing):
+    group = "bigjob:benchmark-group-" + str(uuid.uuid1())
+    pilots = []
+    for pilot_index, durations in jobs:
+        coordination = bigjob_coordination(server_connect_url=COORDINATION_URL)
+        pilot_url = "bigjob:bj-" + str(uuid.uuid1()) + ":localhost"
+        if work_stealing:
+            coordination.join_pilot_group(pilot_url, group)
+        coordination.submit_jobs(pilot_url, [(pilot_url + ":jobs:sj-%d"%i, {"state":"Unknown", "duration":str(d)})
+                                             for i, d in enumerate(durations)])
+        pilots.append((coordination, pilot_url))
+    done = threading.Event()
+    counter = threading.Condition()
+    counter.count = 0
+    counter.total = sum([len(durations) for pilot_index, durations in jobs])
+    start = time.time()
+    for coordination, pilot_url in pilots:
+        for i in range(0, NUMBER_SLOTS):
+            thread = threading.Thread(target=run_slot, args=(coordination, pilot_url, done, counter))
+            thread.daemon = True
+            thread.start()
+    done.wait()
+    makespan = time.time() - start
+    for coordination, pilot_url in pilots:
+        coordination.delete_pilot(pilot_url)
+    return makespan
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    jobs = create_jobs(number_jobs)
+    total_duration = sum([sum(durations) for pilot_index, durations in jobs])
+    print "%d pilots x %d slots, %d sub-jobs, lower bound: %.2f s"%(NUMBER_PILOTS, NUMBER_SLOTS,
+        NUMBER_PILOTS*number_jobs, total_duration/(NUMBER_PILOTS*NUMBER_SLOTS))
+    print "static binding: makespan %.2f s"%simulate(jobs, False)
+    print "work stealing:  makespan %.2f s"%simulate(jobs, True)
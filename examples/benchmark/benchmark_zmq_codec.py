@@ -0,0 +1,61 @@
+""" Micro-benchmark of the wire format of the ZMQ coordination backend
+
+    Compares encoding + decoding time and size of typical messages with the
+    frame based codec (encode_message/decode_message) and with pickle (wire
+    format of earlier BigJob versions).
+
+    Usage: python benchmark_zmq_codec.py [number of iterations]
+"""
+import os
+import sys
+import time
+import cPickle as pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+NUMBER_ITERATIONS=10000
+PILOT_URL="bigjob:bj-a1b2c3d4-0000-11e1-8000-001e4f1b2c3d:localhost"
+
+from bigjob import job_description_codec
+from coordination.bigjob_coordination_zmq import message, encode_message, decode_message
+
+
+def create_messages():
+    job_url = PILOT_URL + ":jobs:sj-a1b2c3d4-0000-11e1-8000-001e4f1b2c3d"
+    job_dict = job_description_codec.encode({"Executable":"/bin/date", "Arguments":["-u", "-R"],
+                                             "NumberOfProcesses":"1", "Output":"stdout.txt",
+                                             "Error":"stderr.txt", "state":"Unknown",
+                                             "job-id":"sj-a1b2c3d4-0000-11e1-8000-001e4f1b2c3d"})
+    job_urls = [PILOT_URL + ":jobs:sj-%d"%i for i in range(0, 1000)]
+    return [("set_job_state", message("set_job_state", job_url, "Running")),
+            ("job (description)", message("job", job_url, job_dict)),
+            ("set_job_states (100)", message("set_job_states", "", dict([(i, "Done") for i in job_urls[:100]]))),
+            ("queue_jobs (1000)", message("queue_jobs", "", job_urls))]
+
+
+def benchmark(msg, encode, decode, number_iterations):
+    start = time.time()
+    for i in range(0, number_iterations):
+        data = encode(msg)
+        decode(data)
+    return (time.time() - start)/number_iterations*1000000, len("".join(encode(msg)))
+
+
+def encode_pickle(msg):
+    return [pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)]
+
+
+def decode_pickle(frames):
+    return pickle.loads(frames[0])
+
+
+if __name__ == "__main__":
+    number_iterations = NUMBER_ITERATIONS
+    if len(sys.argv)>1:
+        number_iterations = int(sys.argv[1])
+    print "%-22s %20s %20s"%("message", "pickle", "frames")
+    for name, msg in create_messages():
+        iterations = max(number_iterations/len(str(msg.value)), 10) * 10
+        pickle_time, pickle_size = benchmark(msg, encode_pickle, decode_pickle, iterations)
+        codec_time, codec_size = benchmark(msg, encode_message, decode_message, iterations)
+        print "%-22s %8.1f us %6d B %8.1f us %6d B"%(name, pickle_time, pickle_size, codec_time, codec_size)
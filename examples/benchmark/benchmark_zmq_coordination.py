@@ -0,0 +1,109 @@
+""" Benchmark of the sub-job state updates/s of the ZMQ coordination backend
+
+    Starts a ZMQ coordination server (as done by the bigjob manager) in a 
+    separate process and a client (as used by the bigjob agent) in this 
+    process. 4, 16 and 64 client threads concurrently call set_job_state; 
+    requests of all threads are in flight at the same time (DEALER/ROUTER 
+    with request ids).
+    
+    Optionally, messages are routed through a proxy process that delays every 
+    message by latency/2 ms (i.e. RTT + latency), e.g. to emulate a coordination 
+    server far from the cluster.
+    
+    Usage: python benchmark_zmq_coordination.py [duration per run in sec] [latency in ms]
+"""
+import os
+import sys
+import time
+import heapq
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+DURATION=5
+LATENCY=0
+NUMBER_THREADS=[4, 16, 64]
+
+import zmq
+from coordination.bigjob_coordination_zmq import bigjob_coordination
+
+
+def run_server(addresses, stop):
+    server = bigjob_coordination(server="localhost")
+    addresses.put(server.get_address())
+    stop.wait()
+
+
+def run_proxy(server_address, addresses, delay):
+    """ forwards messages between clients and server after delay seconds """
+    context = zmq.Context()
+    frontend = context.socket(zmq.ROUTER)
+    port = frontend.bind_to_random_port("tcp://*")
+    backend = context.socket(zmq.DEALER)
+    backend.connect(server_address)
+    addresses.put("tcp://localhost:%d"%port)
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+    delayed = [] # (due time, sequence number, target socket, frames)
+    counter = 0
+    while True:
+        timeout = None
+        if len(delayed) > 0:
+            timeout = max(0, (delayed[0][0] - time.time())*1000)
+        for sock, event in poller.poll(timeout):
+            target = (sock == frontend) and backend or frontend
+            counter = counter + 1
+            heapq.heappush(delayed, (time.time() + delay, counter, target, sock.recv_multipart()))
+        while len(delayed) > 0 and delayed[0][0] <= time.time():
+            due, i, target, frames = heapq.heappop(delayed)
+            target.send_multipart(frames)
+
+
+def update_states(coordination, thread_id, stop, counts):
+    count = 0
+    job_url = "bigjob:bj-benchmark:localhost:jobs:sj-%d"%thread_id
+    while not stop.isSet():
+        coordination.set_job_state(job_url, "Running")
+        count = count + 1
+    counts[thread_id] = count
+
+
+def benchmark(coordination, number_threads, duration):
+    stop = threading.Event()
+    counts = {}
+    threads = [threading.Thread(target=update_states, args=(coordination, i, stop, counts)) 
+               for i in range(0, number_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts.values())/float(duration)
+
+
+if __name__ == "__main__":
+    duration = DURATION
+    latency = LATENCY
+    if len(sys.argv)>1:
+        duration = float(sys.argv[1])
+    if len(sys.argv)>2:
+        latency = float(sys.argv[2])
+    addresses = multiprocessing.Queue()
+    server_stop = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=run_server, args=(addresses, server_stop))]
+    processes[0].start()
+    server_address, push_address = addresses.get().split(",")
+    if latency > 0:
+        processes.append(multiprocessing.Process(target=run_proxy, args=(server_address, addresses, latency/2000.0)))
+        processes[1].daemon = True
+        processes[1].start()
+        server_address = addresses.get()
+    client = bigjob_coordination(server_connect_url=server_address + "," + push_address)
+    print "Latency: %.1f ms"%latency
+    for number_threads in NUMBER_THREADS:
+        print "%3d threads: %.1f state updates/s"%(number_threads, benchmark(client, number_threads, duration))
+    server_stop.set()
+    processes[0].join()
@@ -0,0 +1,65 @@
+""" Benchmark of the sub-job delivery throughput (jobs/s) of the ZMQ coordination backend
+
+    Starts a ZMQ coordination server (as done by the bigjob manager) in a
+    separate process, which submits the sub-jobs, and an agent client in this
+    process, which dequeues the sub-jobs together with their descriptions
+    (as done by the bigjob agent). The run is repeated for different numbers
+    of credits (free slots of the agent), i.e. number of sub-jobs pushed to
+    the agent ahead of dequeue.
+
+    Usage: python benchmark_zmq_delivery.py [number of sub-jobs]
+"""
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+NUMBER_JOBS=5000
+CREDITS=[1, 16, 256]
+JOB_DESCRIPTION={"Executable":"/bin/date", "Arguments":"['-u']", "NumberOfProcesses":"1",
+                 "state":"Unknown"}
+
+from coordination.bigjob_coordination_zmq import bigjob_coordination
+
+
+def run_server(addresses, submit, stop):
+    server = bigjob_coordination(server="localhost")
+    addresses.put(server.get_address())
+    while True:
+        pilot_url, number_jobs = submit.get()
+        if pilot_url == None:
+            break
+        jobs = [(pilot_url + ":jobs:sj-%d"%i, dict(JOB_DESCRIPTION)) for i in range(0, number_jobs)]
+        server.submit_jobs(pilot_url, jobs)
+    stop.wait()
+
+
+def benchmark(client, submit, number_jobs, credits):
+    pilot_url = "bigjob:bj-benchmark-%d:localhost"%credits
+    client.set_job_credits(pilot_url, credits)
+    start = time.time()
+    submit.put((pilot_url, number_jobs))
+    for i in range(0, number_jobs):
+        job_url, job_dict = client.dequeue_job_description(pilot_url)
+        if job_dict == None:
+            job_dict = client.get_job(job_url)
+    return number_jobs/(time.time() - start)
+
+
+if __name__ == "__main__":
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        number_jobs = int(sys.argv[1])
+    addresses = multiprocessing.Queue()
+    submit = multiprocessing.Queue()
+    server_stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server, args=(addresses, submit, server_stop))
+    server.start()
+    client = bigjob_coordination(server_connect_url=addresses.get())
+    for credits in CREDITS:
+        print "%3d credits: %.1f jobs/s"%(credits, benchmark(client, submit, number_jobs, credits))
+    submit.put((None, 0))
+    server_stop.set()
+    server.join()
@@ -0,0 +1,117 @@
+""" Benchmark of the persistent state store of the ZMQ coordination server
+
+    1. state updates/s (16 client threads calling set_job_state) of a server
+       keeping its state in memory and of a server with state store
+    2. restart: a server with state store submits sub-jobs; an agent client
+       dequeues half of them, the server process is killed and restarted with
+       the same store; the agent (without reconnect) dequeues the remaining
+       sub-jobs, which are not submitted again.
+
+    Usage: python benchmark_zmq_store.py [duration in sec] [number of sub-jobs]
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+DURATION=5
+NUMBER_JOBS=10000
+NUMBER_THREADS=16
+PILOT_URL="bigjob:bj-benchmark:localhost"
+
+from coordination.bigjob_coordination_zmq import bigjob_coordination
+
+
+def run_server(addresses, state_store_path, number_jobs):
+    server = bigjob_coordination(server="localhost", state_store_path=state_store_path)
+    if number_jobs > 0:
+        jobs = [(PILOT_URL + ":jobs:sj-%d"%i, {"jd":"v1:{}", "state":"Unknown"})
+                for i in range(0, number_jobs)]
+        server.submit_jobs(PILOT_URL, jobs)
+    addresses.put(server.get_address())
+    while True:
+        time.sleep(1)
+
+
+def start_server(state_store_path, number_jobs=0):
+    addresses = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_server, args=(addresses, state_store_path, number_jobs))
+    process.start()
+    return process, addresses.get()
+
+
+def update_states(coordination, thread_id, stop, counts):
+    count = 0
+    job_url = PILOT_URL + ":jobs:sj-%d"%thread_id
+    while not stop.isSet():
+        coordination.set_job_state(job_url, "Running")
+        count = count + 1
+    counts[thread_id] = count
+
+
+def benchmark_updates(state_store_path, duration):
+    process, address = start_server(state_store_path)
+    client = bigjob_coordination(server_connect_url=address)
+    stop = threading.Event()
+    counts = {}
+    threads = [threading.Thread(target=update_states, args=(client, i, stop, counts))
+               for i in range(0, NUMBER_THREADS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    return sum(counts.values())/float(duration)
+
+
+def benchmark_restart(state_store_path, number_jobs):
+    process, address = start_server(state_store_path, number_jobs)
+    client = bigjob_coordination(server_connect_url=address)
+    received = set()
+    for i in range(0, number_jobs/2):
+        job_url = client.dequeue_job(PILOT_URL)
+        client.ack_job(PILOT_URL, job_url)
+        received.add(job_url)
+    time.sleep(0.5) # acks are sent asynchronously
+    os.kill(process.pid, signal.SIGKILL) # crash
+    process.join()
+    start = time.time()
+    process, restart_address = start_server(state_store_path)
+    recovery_time = time.time() - start
+    duplicates = 0
+    while len(received) < number_jobs:
+        job_url = client.dequeue_job(PILOT_URL)
+        if job_url in received:
+            duplicates = duplicates + 1
+        client.ack_job(PILOT_URL, job_url)
+        received.add(job_url)
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    return restart_address == address, recovery_time, duplicates
+
+
+if __name__ == "__main__":
+    duration = DURATION
+    number_jobs = NUMBER_JOBS
+    if len(sys.argv)>1:
+        duration = float(sys.argv[1])
+    if len(sys.argv)>2:
+        number_jobs = int(sys.argv[2])
+    directory = tempfile.mkdtemp()
+    try:
+        print "in memory:   %.1f state updates/s"%benchmark_updates(None, duration)
+        print "state store: %.1f state updates/s"%benchmark_updates(os.path.join(directory, "updates"), duration)
+        same_address, recovery_time, duplicates = benchmark_restart(os.path.join(directory, "restart"), number_jobs)
+        print "restart: all %d sub-jobs received (same address: %s, recovery: %.2f s, delivered twice: %d)"%(
+            number_jobs, same_address, recovery_time, duplicates)
+    finally:
+        shutil.rmtree(directory)
@@ -38,7 +38,7 @@ setup(name='BigJob',
 #        '': ['README', 'README'],
 #        '': ['VERSION', 'VERSION']
 #      },
-      install_requires=['paramiko-on-pypi', 'uuid', 'threadpool', 'virtualenv', 'redis==2.2.4', 'bliss'],
+      install_requires=['paramiko-on-pypi', 'uuid', 'threadpool', 'virtualenv', 'redis>=2.10', 'bliss'],
       entry_points = {
         'console_scripts': [
             'test-bigjob = examples.example_local_single:main',